@@ -0,0 +1,218 @@
+"""
+Offline benchmark of the indexing pipeline.
+
+A synthetic corpus is generated in a working folder, then indexed with Qdrant running
+in-process (QDRANT_URL=:memory:) and a small embedding model. No server is needed, and once the
+model has been downloaded, no network access either.
+
+The results are written as JSON: per-stage timings of the pipeline, files/s, chunks/s, peak RSS
+and the distribution of the latency of the files, from their submission to the end of their upsert.
+
+Usage:
+
+    python benchmarks/bench_indexing.py --output bench.json --txt 50 --pdf 20 --pages 5
+
+Any setting of the indexer can be overridden with --set, e.g. --set EMBEDDING_BACKEND=onnx.
+The configuration is read when ragindexer is imported, so this has to be a standalone script.
+
+"""
+
+import argparse
+import json
+import os
+from pathlib import Path
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from corpus import WRITERS, generate_corpus
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--output", type=Path, help="JSON file for the results (default: stdout)")
+    parser.add_argument("--workdir", type=Path, help="Folder for the corpus and the state DB")
+    parser.add_argument("--keep", action="store_true", help="Do not remove the working folder")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the corpus generator")
+    parser.add_argument("--pages", type=int, default=3, help="Pages per file")
+    parser.add_argument("--sentences", type=int, default=40, help="Sentences per page")
+    parser.add_argument(
+        "--model",
+        default="sentence-transformers/all-MiniLM-L6-v2",
+        help="Embedding model used for the benchmark",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=["pipeline", "sequential"],
+        default="pipeline",
+        help="pipeline: all files submitted at once, like the initial scan. "
+        "sequential: one file after the other, like the watcher",
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Overrides a setting of the indexer",
+    )
+    defaults = {"txt": 20, "md": 20, "docx": 10, "xlsx": 10, "pdf": 10, "scan.pdf": 2}
+    for kind, nb in defaults.items():
+        parser.add_argument(
+            f"--{kind.replace('.', '-')}",
+            dest=kind.replace(".", "_"),
+            type=int,
+            default=nb,
+            help=f"Number of {kind} files (default: {nb})",
+        )
+    return parser.parse_args(argv)
+
+
+def set_environment(args: argparse.Namespace, workdir: Path):
+    # Has to be done before ragindexer is imported
+    env = {
+        "LOGLEVEL": "warning",
+        "QDRANT_URL": ":memory:",
+        "QDRANT_QUERY_LIMIT": "10",
+        "QDRANT_API_KEY": "",
+        "DOCS_PATH": str(workdir / "docs"),
+        "EMAILS_PATH": str(workdir / "emails"),
+        "STATE_DB_PATH": str(workdir / "state" / "index_state.db"),
+        "COLLECTION_NAME": "benchmark",
+        "DAV_ROOT": str(workdir / "docs"),
+        "EMBEDDING_MODEL": args.model,
+        "EMBEDDING_MODEL_TRUST_REMOTE_CODE": "false",
+        "MIN_EXPECTED_CHAR": "100",
+        "CHUNK_SIZE": "1000",
+        "CHUNK_OVERLAP": "200",
+        "OCR_LANG": "fra",
+        "TORCH_NUM_THREADS": str(os.cpu_count() or 1),
+    }
+    for item in args.set:
+        key, _, value = item.partition("=")
+        env[key] = value
+    os.environ.update(env)
+
+
+def peak_rss_mb() -> dict:
+    # ru_maxrss is in kB on Linux
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return {"self": self_rss, "children": children_rss}
+
+
+def latencies(values: list) -> dict:
+    if not values:
+        return {}
+    return {
+        "min": float(np.min(values)),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(np.max(values)),
+    }
+
+
+def run(args: argparse.Namespace, workdir: Path) -> dict:
+    nb_files = {kind: getattr(args, kind.replace(".", "_")) for kind in WRITERS}
+    t0 = time.perf_counter()
+    paths = generate_corpus(workdir / "docs", nb_files, args.pages, args.sentences, args.seed)
+    (workdir / "emails").mkdir(parents=True, exist_ok=True)
+    (workdir / "state").mkdir(parents=True, exist_ok=True)
+    corpus_time = time.perf_counter() - t0
+
+    set_environment(args, workdir)
+    from ragindexer.config import config
+    from ragindexer.DocumentIndexer import DocumentIndexer
+
+    t0 = time.perf_counter()
+    indexer = DocumentIndexer()
+    load_time = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    jobs = []
+    if args.mode == "pipeline":
+        with indexer.qdrant.bulk_load():
+            for file_path, modified in indexer.scanner.scan([config.DOCS_PATH]):
+                jobs.append(indexer.pipeline.submit(file_path, mtime=modified))
+            indexer.pipeline.wait_idle()
+        indexer.qdrant.flush()
+    else:
+        for file_path, modified in indexer.scanner.scan([config.DOCS_PATH]):
+            job = indexer.pipeline.submit(file_path, mtime=modified)
+            job.wait()
+            jobs.append(job)
+    elapsed = time.perf_counter() - t0
+    indexer.pipeline.stop()
+
+    nb_chunks = sum(job.nb_chunks for job in jobs)
+    file_latencies = [job.end_time - job.submit_time for job in jobs if job.end_time is not None]
+    cache = indexer.doc_factory.get_embedding_cache()
+
+    return {
+        "parameters": {
+            "mode": args.mode,
+            "model": args.model,
+            "files": nb_files,
+            "pages": args.pages,
+            "sentences": args.sentences,
+            "seed": args.seed,
+            "overrides": args.set,
+        },
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "corpus": {
+            "files": len(paths),
+            "bytes": sum(path.stat().st_size for path in paths),
+            "generation_time": corpus_time,
+        },
+        "model_load_time": load_time,
+        "elapsed": elapsed,
+        "files": len(jobs),
+        "failed": sum(job.failed for job in jobs),
+        "chunks": nb_chunks,
+        "files_per_second": len(jobs) / elapsed if elapsed > 0 else 0.0,
+        "chunks_per_second": nb_chunks / elapsed if elapsed > 0 else 0.0,
+        "latency": latencies(file_latencies),
+        "stages": indexer.pipeline.stats(),
+        "batcher": indexer.doc_factory.get_batcher().stats(),
+        "chunker": indexer.doc_factory.get_chunker().stats(),
+        "embedding_cache": cache.stats() if cache is not None else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if args.workdir is None:
+        workdir = Path(tempfile.mkdtemp(prefix="ragindexer-bench-"))
+    else:
+        workdir = args.workdir
+        if workdir.exists():
+            shutil.rmtree(workdir)
+        workdir.mkdir(parents=True)
+
+    try:
+        result = run(args, workdir)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(result, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+"""
+Offline benchmark of the search service under concurrent traffic.
+
+A synthetic corpus is generated and indexed with Qdrant running in-process, then the search
+service is started on a local port. Concurrent clients send queries over HTTP, drawn with
+repetitions from a pool of distinct queries, like users of a chat asking similar questions.
+
+The results are written as JSON: latency percentiles seen by the clients, queries/s, and the
+statistics of the query encoder and of the caches. With --target-p99-ms, the exit code is 1 if
+the p99 latency is above the target.
+
+Usage:
+
+    python benchmarks/bench_search.py --clients 16 --queries 200 --target-p99-ms 100
+
+Any setting of the indexer can be overridden with --set, e.g. --set SEARCH_BATCH_WAIT_MS=5.
+
+"""
+
+import argparse
+import json
+import os
+from pathlib import Path
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from bench_indexing import latencies, peak_rss_mb, set_environment
+from corpus import generate_corpus, make_sentence
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--output", type=Path, help="JSON file for the results (default: stdout)")
+    parser.add_argument("--workdir", type=Path, help="Folder for the corpus and the state DB")
+    parser.add_argument("--keep", action="store_true", help="Do not remove the working folder")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the corpus and the queries")
+    parser.add_argument("--files", type=int, default=50, help="Number of txt files indexed")
+    parser.add_argument("--pages", type=int, default=3, help="Pages per file")
+    parser.add_argument("--sentences", type=int, default=40, help="Sentences per page")
+    parser.add_argument("--clients", type=int, default=16, help="Concurrent clients")
+    parser.add_argument("--queries", type=int, default=100, help="Queries sent by each client")
+    parser.add_argument("--distinct", type=int, default=200, help="Number of distinct queries")
+    parser.add_argument("--limit", type=int, default=10, help="Results per query")
+    parser.add_argument("--target-p99-ms", type=float, help="Maximum p99 latency, in ms")
+    parser.add_argument(
+        "--model",
+        default="sentence-transformers/all-MiniLM-L6-v2",
+        help="Embedding model used for the benchmark",
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Overrides a setting of the indexer",
+    )
+    return parser.parse_args(argv)
+
+
+def run_clients(url: str, args: argparse.Namespace) -> list:
+    rng = random.Random(args.seed)
+    pool = [make_sentence(rng) for _ in range(args.distinct)]
+    # A few queries are much more frequent than the others
+    weights = [1 / (k + 1) for k in range(len(pool))]
+    durations = []
+    lock = threading.Lock()
+
+    def client(k_client: int):
+        client_rng = random.Random(args.seed * 1000 + k_client)
+        queries = client_rng.choices(pool, weights=weights, k=args.queries)
+        local = []
+        for query in queries:
+            data = json.dumps({"query": query, "limit": args.limit}).encode("utf-8")
+            t0 = time.perf_counter()
+            with urllib.request.urlopen(url, data=data) as response:
+                response.read()
+            local.append(time.perf_counter() - t0)
+        with lock:
+            durations.extend(local)
+
+    threads = [threading.Thread(target=client, args=(k,)) for k in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return durations
+
+
+def run(args: argparse.Namespace, workdir: Path) -> dict:
+    nb_files = {"txt": args.files}
+    generate_corpus(workdir / "docs", nb_files, args.pages, args.sentences, args.seed)
+    (workdir / "emails").mkdir(parents=True, exist_ok=True)
+    (workdir / "state").mkdir(parents=True, exist_ok=True)
+
+    set_environment(args, workdir)
+    from ragindexer.config import config
+    from ragindexer.DocumentIndexer import DocumentIndexer
+    from ragindexer.QueryEncoder import QueryEncoder
+    from ragindexer.SearchService import SearchService, start_search_server
+
+    indexer = DocumentIndexer()
+    for file_path, modified in indexer.scanner.scan([config.DOCS_PATH]):
+        indexer.pipeline.submit(file_path, mtime=modified)
+    indexer.pipeline.wait_idle()
+    indexer.qdrant.flush()
+    indexer.pipeline.stop()
+
+    service = SearchService(indexer.qdrant, QueryEncoder(indexer.model))
+    service.start()
+    server = start_search_server(service, port=0, addr="127.0.0.1")
+    url = f"http://127.0.0.1:{server.server_address[1]}/search"
+    try:
+        t0 = time.perf_counter()
+        durations = run_clients(url, args)
+        elapsed = time.perf_counter() - t0
+    finally:
+        server.shutdown()
+        service.stop()
+
+    latency = {key: value * 1000 for key, value in latencies(durations).items()}
+    return {
+        "parameters": {
+            "model": args.model,
+            "files": args.files,
+            "clients": args.clients,
+            "queries": args.queries,
+            "distinct": args.distinct,
+            "limit": args.limit,
+            "seed": args.seed,
+            "overrides": args.set,
+        },
+        "cpus": os.cpu_count(),
+        "elapsed": elapsed,
+        "queries_per_second": len(durations) / elapsed if elapsed > 0 else 0.0,
+        "latency_ms": latency,
+        "target_p99_ms": args.target_p99_ms,
+        "service": service.stats(),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if args.workdir is None:
+        workdir = Path(tempfile.mkdtemp(prefix="ragindexer-bench-"))
+    else:
+        workdir = args.workdir
+        if workdir.exists():
+            shutil.rmtree(workdir)
+        workdir.mkdir(parents=True)
+
+    try:
+        result = run(args, workdir)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(result, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+    if args.target_p99_ms is not None and result["latency_ms"]["p99"] > args.target_p99_ms:
+        print(
+            f"p99 latency {result['latency_ms']['p99']:.1f} ms above the target of "
+            f"{args.target_p99_ms} ms",
+            file=sys.stderr,
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+"""
+Generation of a synthetic corpus of documents, for the benchmarks.
+
+The content is built from a fixed vocabulary with a seeded random generator, so that two runs
+with the same parameters produce the same files.
+
+"""
+
+from pathlib import Path
+import random
+from typing import Dict, List
+
+
+WORDS = (
+    "le la les un une des du de et est dans pour que qui sur avec par rapport contrat facture "
+    "client projet réunion résultat analyse document page tableau données système service "
+    "the of and to in is that for with report contract invoice customer project meeting result "
+    "analysis document page table data system service quarterly revenue growth budget"
+).split()
+
+
+def make_sentence(rng: random.Random) -> str:
+    words = [rng.choice(WORDS) for _ in range(rng.randint(8, 20))]
+    return " ".join(words).capitalize() + "."
+
+
+def make_page(rng: random.Random, nb_sentences: int) -> List[str]:
+    return [make_sentence(rng) for _ in range(nb_sentences)]
+
+
+def write_text(path: Path, rng: random.Random, nb_pages: int, nb_sentences: int):
+    with open(path, "w") as f:
+        for _ in range(nb_pages):
+            f.write(" ".join(make_page(rng, nb_sentences)) + "\n\n")
+
+
+def write_markdown(path: Path, rng: random.Random, nb_pages: int, nb_sentences: int):
+    with open(path, "w") as f:
+        for k in range(nb_pages):
+            f.write(f"# Section {k + 1}\n\n" + " ".join(make_page(rng, nb_sentences)) + "\n\n")
+
+
+def write_docx(path: Path, rng: random.Random, nb_pages: int, nb_sentences: int):
+    from docx import Document
+    from docx.enum.text import WD_BREAK
+
+    doc = Document()
+    for k in range(nb_pages):
+        doc.add_heading(f"Section {k + 1}", level=1)
+        sentences = make_page(rng, nb_sentences)
+        for start in range(0, len(sentences), 5):
+            doc.add_paragraph(" ".join(sentences[start : start + 5]))
+        if k < nb_pages - 1:
+            doc.add_paragraph().add_run().add_break(WD_BREAK.PAGE)
+    doc.save(path)
+
+
+def write_xlsx(path: Path, rng: random.Random, nb_pages: int, nb_sentences: int):
+    from openpyxl import Workbook
+
+    wb = Workbook()
+    wb.remove(wb.active)
+    for k in range(nb_pages):
+        ws = wb.create_sheet(f"Sheet{k + 1}")
+        ws.append(["Date", "Client", "Montant", "Commentaire"])
+        for row in range(nb_sentences):
+            ws.append(
+                [
+                    f"2024-{rng.randint(1, 12):02}-{rng.randint(1, 28):02}",
+                    rng.choice(WORDS).capitalize(),
+                    round(rng.uniform(10, 10_000), 2),
+                    make_sentence(rng),
+                ]
+            )
+    wb.save(path)
+
+
+def _pdf_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_text_pdf(path: Path, rng: random.Random, nb_pages: int, nb_sentences: int):
+    # Minimal PDF with a text layer, written by hand to avoid a dependency to a PDF writer
+    objects: List[bytes] = []
+    page_ids = []
+    font_id = 3
+    objects.append(b"<< /Type /Catalog /Pages 2 0 R >>")
+    objects.append(b"")  # Pages, written once the pages are known
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    for _ in range(nb_pages):
+        lines = []
+        line = ""
+        for word in " ".join(make_page(rng, nb_sentences)).split():
+            if len(line) + len(word) > 90:
+                lines.append(line)
+                line = ""
+            line = f"{line} {word}" if line else word
+        lines.append(line)
+
+        text_ops = "".join(f"({_pdf_escape(line)}) '\n" for line in lines[:60])
+        stream = f"BT /F1 10 Tf 12 TL 50 760 Td\n{text_ops}ET".encode("latin-1", "replace")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents %d 0 R "
+            b"/Resources << /Font << /F1 %d 0 R >> >> >>" % (content_id, font_id)
+        )
+        page_ids.append(len(objects))
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+    objects[1] = f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode("ascii")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for k, obj in enumerate(objects):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (k + 1, obj)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1,
+        xref,
+    )
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def write_image_pdf(path: Path, rng: random.Random, nb_pages: int, nb_sentences: int):
+    # Scanned document: each page is an image without text layer, so it goes through the OCR
+    from PIL import Image, ImageDraw, ImageFont
+
+    font = ImageFont.load_default(size=22)
+    images = []
+    for _ in range(nb_pages):
+        img = Image.new("L", (1240, 1754), 255)
+        draw = ImageDraw.Draw(img)
+        y = 80
+        line = ""
+        for word in " ".join(make_page(rng, nb_sentences)).split():
+            if len(line) + len(word) > 80:
+                draw.text((80, y), line, fill=0, font=font)
+                y += 32
+                line = ""
+            line = f"{line} {word}" if line else word
+        draw.text((80, y), line, fill=0, font=font)
+        images.append(img)
+    images[0].save(path, save_all=True, append_images=images[1:], resolution=150)
+
+
+WRITERS = {
+    "txt": write_text,
+    "md": write_markdown,
+    "docx": write_docx,
+    "xlsx": write_xlsx,
+    "pdf": write_text_pdf,
+    "scan.pdf": write_image_pdf,
+}
+
+
+def generate_corpus(
+    root: Path, nb_files: Dict[str, int], nb_pages: int, nb_sentences: int, seed: int = 0
+) -> List[Path]:
+    """
+    Writes a synthetic corpus
+
+    Args:
+        root: Folder where the files are written
+        nb_files: Number of files of each kind: txt, md, docx, xlsx, pdf (with a text layer)
+            and scan.pdf (image-only PDF)
+        nb_pages: Number of pages (sections for txt and md, sheets for xlsx) of each file
+        nb_sentences: Number of sentences (rows for xlsx) per page
+        seed: Seed of the random generator
+
+    Returns:
+        The list of the written files
+
+    """
+    rng = random.Random(seed)
+    paths = []
+    for kind, nb in nb_files.items():
+        folder = root / kind.replace(".", "_")
+        folder.mkdir(parents=True, exist_ok=True)
+        for k in range(nb):
+            path = folder / f"file{k:05}.{kind}"
+            WRITERS[kind](path, rng, nb_pages, nb_sentences)
+            paths.append(path)
+    return paths
@@ -1,30 +1,25 @@
 import os
-import time
+import queue
 import threading
+from contextlib import ExitStack
 from pathlib import Path
-from typing import Iterable, List, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler, FileSystemEvent
 
-from sentence_transformers import SentenceTransformer
-from qdrant_client.models import (
-    Filter,
-    FieldCondition,
-    MatchValue,
-)
-
 from .documents.DocumentFactory import DocumentFactory
 from . import logger
-from .index_database import (
-    delete_stored_file,
-    get_stored_timestamp,
-    set_stored_timestamp,
-    list_stored_files,
-)
+from .index_database import StateDB
 from .config import config
 from .QdrantIndexer import QdrantIndexer
-from .models import ChunkType, EmbeddingType
+from .IndexingPipeline import IndexingJob, IndexingPipeline
+from .FileScanner import FileScanner
+from .embedding_model import load_embedding_model
+from .metrics import WATCHER_BACKLOG
+from .WatcherQueue import WatcherQueue
+from .WorkQueue import WorkItem, WorkQueue
+from .models import ChunkType, EmbeddingBatchType
 
 
 class DocumentIndexer:
@@ -32,36 +27,56 @@ class DocumentIndexer:
     Object that reacts to filesystem events (document creation/modification/deletion)
     and updates the databases
 
+    In distributed mode (DISTRIBUTED), several indexers share the state DB and a `WorkQueue`:
+    the scans and the filesystem events queue the files, and each indexer indexes the files
+    it claims from the queue. The indexation of a file is cancelled when its lease is lost.
+
     """
 
     def __init__(self):
-        # Load embedding model
-        self.model = SentenceTransformer(
-            config.EMBEDDING_MODEL,
-            trust_remote_code=config.EMBEDDING_MODEL_TRUST_REMOTE_CODE,
-            backend="torch",
-            cache_folder=config.STATE_DB_PATH.parent / "models",
-        )
+        # Load embedding model, with the backend set by EMBEDDING_BACKEND
+        self.model, model_id = load_embedding_model()
         self.vector_size = self.model.get_sentence_embedding_dimension()
         self.doc_factory = DocumentFactory()
-        self.doc_factory.set_embedding_model(self.model)
+        self.doc_factory.set_embedding_model(self.model, model_id)
+
+        # Ensure state DB exists
+        self.state_db = StateDB()
 
-        # Initialize Qdrant
-        self.qdrant = QdrantIndexer(vector_size=self.vector_size)
+        # Initialize Qdrant. The vocabulary of the sparse vectors is kept in the state DB
+        self.qdrant = QdrantIndexer(vector_size=self.vector_size, state_db=self.state_db)
 
-        # Lock around state & indexing operations
-        self.lock = threading.Lock()
+        self.scanner = FileScanner(self.doc_factory)
+
+        # Extraction, chunking, embedding and upsert run concurrently in the pipeline
+        self.pipeline = IndexingPipeline(self.doc_factory, self.qdrant, self.state_db)
+        self.pipeline.start()
+
+        # In distributed mode, the files go through the work queue shared by the workers
+        self.work_queue: Optional[WorkQueue] = None
+        # Jobs of the files claimed from the work queue, by path and fencing token
+        self.__leased_jobs: Dict[Tuple[Path, int], IndexingJob] = {}
+        self.__leased_lock = threading.Lock()
+        if config.DISTRIBUTED:
+            self.work_queue = WorkQueue()
+            self.work_queue.add_lost_listener(self.__on_lease_lost)
+            self.work_queue.start()
+
+        # Filesystem events are debounced before being given to the pipeline
+        self.watcher_queue = WatcherQueue(self.__dispatch_event)
+        WATCHER_BACKLOG.set_function(lambda: self.watcher_queue.stats()["pending"])
 
     def extract_text(
         self, abspath: Path
-    ) -> Iterable[Tuple[int, List[ChunkType], List[EmbeddingType], dict]]:
+    ) -> Iterable[Tuple[int, List[ChunkType], EmbeddingBatchType, dict]]:
         """Extract chunks, embeddings and metadata from file path
 
         Args:
             abspath: Path to a file to analyse
 
         Yields:
-            A tuple with a list of chunks, the corresponding list of embeddings, and the file metadata
+            A tuple with a list of chunks, the corresponding embeddings (one row per chunk),
+            and the file metadata
 
         """
         for k_page, chunks, embeddings, file_metadata in self.doc_factory.processDocument(abspath):
@@ -76,92 +91,182 @@ class DocumentIndexer:
             force: True to process the file even if the database says that it has already been processed
 
         """
-        stat = os.path.getmtime(filepath)
-        stored = get_stored_timestamp(filepath)
-        if (stored is not None and stored == stat) and not force:
-            # No change
-            return
-
-        logger.info(72 * "=")
-        logger.info(f"[INDEX] Processing changed file: '{filepath}'")
-        nb_emb = 0
-        for k_page, chunks, embeddings, file_metadata in self.extract_text(filepath):
-            # Upsert into Qdrant
-            self.qdrant.record_embeddings(k_page, chunks, embeddings, file_metadata)
-            nb_emb += len(embeddings)
-
-        # Update state DB
-        set_stored_timestamp(filepath, stat)
-        logger.info(f"[INDEX] Upserted {nb_emb} vectors")
+        self.pipeline.submit(filepath, force=force).wait()
 
     def remove_file(self, filepath: Path):
         """
-        Delete all vectors whose payload.source == this file's absolute path.
-        We identify by regenerating all chunk IDs for old state—but since we store
-        last-modified in SQLite, we know it existed before; we'll iterate over state DB
-        to remove associated chunk IDs. Simpler: query by payload.source in Qdrant.
+        Delete all vectors whose payload.source == this file's absolute path,
+        with a filter on the indexed payload field, and remove the file from the state DB.
+        The deletion goes through the pipeline, so that it does not run concurrently with
+        an indexation of the same file.
 
         Args:
-            filepath: Path to the file to be analyzed, relative to DOCS_PATH
+            filepath: Path to the file to be removed
 
         """
-        logger.info(f"[DELETE] Removing file from index: '{filepath}'")
-
-        # Query Qdrant for all points with payload.source == abspath
-        # filter_ = {"must": [{"key": "source", "match": {"value": abspath}}]}
-        filter_ = Filter(must=[FieldCondition(key="source", match=MatchValue(value=str(filepath)))])
-
-        # Retrieve IDs matching that filter
-        hits = self.qdrant.search(limit=1000, query_filter=filter_)
-
-        ids_to_delete = [hit.id for hit in hits]
-        if ids_to_delete:
-            self.qdrant.delete(ids_to_delete)
-            logger.info(f"[DELETE] Removed {len(ids_to_delete)} vectors")
-
-        # Remove from state DB
-        delete_stored_file(filepath)
+        self.pipeline.submit(filepath, delete=True).wait()
 
     def initial_scan(self) -> int:
         """
         On startup, walk entire DOCS_PATH and index any new/modified files.
         Also, find any entries in state DB that no longer exist on disk, and remove them.
+        In distributed mode, the files are queued, then indexed by all the workers: the method
+        returns once the queue has been drained.
+
+        Returns:
+            The number of new or modified files found
+
         """
         logger.info("Performing initial scan of documents folder...")
 
-        # 1. Build a set of all file paths on disk
-        disk_files: list[Path] = []
-        for ext in ("*.pdf", "*.docx", "*.xlsx", "*.xlsm", "*.md", "*.txt"):
-            disk_files.extend(config.DOCS_PATH.rglob(ext))
-        for ext in ("*.pdf", "*.docx", "*.xlsx", "*.xlsm", "*.md", "*.txt"):
-            disk_files.extend(config.EMAILS_PATH.rglob(ext))
-        disk_files = [p.resolve() for p in disk_files]
-
-        # 2. For each file on disk, check timestamp vs. state DB
-        files_to_index = []
-        for file_path in disk_files:
-            stored = get_stored_timestamp(file_path)
-            modified = os.path.getmtime(str(file_path))
-            if stored is None or stored != modified:
-                files_to_index.append(file_path)
-
-        # 3. For each modified file on disk, process its chunks
-        tot_nb_files = len(files_to_index)
-        for n_file, file_path in enumerate(files_to_index):
-            logger.info(f"Initial indexation of {n_file}/{tot_nb_files} - '{file_path}'")
-            stored = get_stored_timestamp(file_path)
-            modified = os.path.getmtime(str(file_path))
-            self.process_file(file_path)
-
-        # 3. For each file in state DB, if not on disk anymore, delete from Qdrant
-        for relpath in list_stored_files():
-            abspath = config.DOCS_PATH / relpath
-            if not abspath.exists():
-                # Remove from Qdrant
-                self.remove_file(relpath)
+        # 1. Load the timestamps of the state DB in one query
+        stored_timestamps = self.state_db.load_timestamps()
+
+        # 2. Walk the folders, and feed the new or modified files to the pipeline as they are found.
+        # HNSW indexing is turned off from the first file to index until the end of the scan.
+        # In distributed mode, the files are queued by batches, so that the other workers can
+        # start on them during the scan. Bulk loading is not used, as the workers would turn
+        # the indexing of the shared collection on and off in turn
+        disk_paths = set()
+        to_queue = []
+        tot_nb_files = 0
+        with ExitStack() as bulk_load:
+            for file_path, modified in self.scanner.scan([config.DOCS_PATH, config.EMAILS_PATH]):
+                disk_paths.add(str(file_path))
+                stored = stored_timestamps.get(str(file_path))
+                if stored is None or stored != modified:
+                    if self.work_queue is not None:
+                        to_queue.append((file_path, modified))
+                        if len(to_queue) >= 256:
+                            self.work_queue.enqueue(to_queue)
+                            to_queue = []
+                    else:
+                        if tot_nb_files == 0 and config.QDRANT_BULK_LOAD:
+                            bulk_load.enter_context(self.qdrant.bulk_load())
+                        logger.info(f"Initial indexation of file {tot_nb_files} - '{file_path}'")
+                        self.pipeline.submit(file_path, mtime=modified)
+                    tot_nb_files += 1
+
+            # 3. Wait for the files to be processed
+            self.pipeline.wait_idle()
+
+        # 4. For each file in state DB, if not on disk anymore, delete from Qdrant
+        removed_files = [
+            Path(stored_path) for stored_path in stored_timestamps if stored_path not in disk_paths
+        ]
+        if self.work_queue is not None:
+            self.work_queue.enqueue(to_queue)
+            self.work_queue.enqueue([(relpath, None) for relpath in removed_files], delete=True)
+            logger.info(
+                f"[WORK] Queued {tot_nb_files} files to index, {len(removed_files)} to remove"
+            )
+            self.process_work_queue(until_drained=True)
+            return tot_nb_files
+
+        for relpath in removed_files:
+            logger.info(f"[DELETE] Removing file from index: '{relpath}'")
+            self.qdrant.delete_by_source(relpath)
+        self.state_db.delete_stored_files(removed_files)
 
         return tot_nb_files
 
+    def process_work_queue(self, until_drained: bool = False) -> int:
+        """
+        Distributed mode: claims files from the work queue, gives them to the pipeline, and
+        reports to the queue whether each file has been indexed or has failed
+
+        Args:
+            until_drained: True to return once no file is pending or leased by any worker.
+                False to keep polling the queue forever
+
+        Returns:
+            The number of files processed by this worker
+
+        """
+        finished = queue.Queue()
+        nb_in_flight = 0
+        nb_processed = 0
+        while True:
+            room = config.PIPELINE_MAX_FILES_IN_FLIGHT - nb_in_flight
+            items = self.work_queue.claim(min(config.WORK_CLAIM_BATCH, room))
+            for item in items:
+                # The modification time is read again by the pipeline, as the file may have
+                # changed since it was queued
+                job = self.pipeline.submit(
+                    item.path,
+                    delete=item.delete,
+                    lease_check=lambda item=item: self.work_queue.holds(item),
+                )
+                with self.__leased_lock:
+                    self.__leased_jobs[(item.path, item.token)] = job
+                job.add_done_callback(lambda job, item=item: finished.put((item, job)))
+            nb_in_flight += len(items)
+
+            if until_drained and nb_in_flight == 0 and not items and self.work_queue.is_drained():
+                return nb_processed
+
+            # Claim more files at once while the queue gives all the files asked for
+            block = len(items) < min(config.WORK_CLAIM_BATCH, room) or len(items) == room
+            done = []
+            try:
+                done.append(finished.get(block, config.WORK_POLL_SECONDS))
+                while True:
+                    done.append(finished.get_nowait())
+            except queue.Empty:
+                pass
+
+            for item, job in done:
+                nb_in_flight -= 1
+                with self.__leased_lock:
+                    self.__leased_jobs.pop((item.path, item.token), None)
+                if job.failed:
+                    self.work_queue.fail(item, f"Indexing of '{item.path}' failed")
+                elif self.work_queue.complete(item):
+                    nb_processed += 1
+
+    def __on_lease_lost(self, item: WorkItem):
+        # Called by the work queue: another worker may now be indexing the file
+        with self.__leased_lock:
+            job = self.__leased_jobs.pop((item.path, item.token), None)
+        if job is not None:
+            logger.warning(f"[WORK] Cancelling the indexation of '{item.path}'")
+            job.cancel()
+
+    def __dispatch_event(self, filepath: Path, deleted: bool, moved_from: Optional[Path]):
+        # Called by the watcher queue once the events on filepath have settled
+        if self.work_queue is not None:
+            self.__queue_event(filepath, deleted, moved_from)
+        elif deleted:
+            self.pipeline.submit(filepath, delete=True)
+            if moved_from is not None:
+                self.pipeline.submit(moved_from, delete=True)
+        else:
+            # A renamed directory waits for the jobs on its files, then renames them all
+            self.pipeline.submit(filepath, moved_from=moved_from)
+
+        stats = self.watcher_queue.stats()
+        logger.debug(
+            f"[WATCHER] Dispatched '{filepath}' ({stats['coalesced']} of "
+            f"{stats['events']} events coalesced so far)"
+        )
+
+    def __queue_event(self, filepath: Path, deleted: bool, moved_from: Optional[Path]):
+        # Distributed mode: renames are not applied in place, as another worker may be indexing
+        # the old paths. The old paths are removed and the new ones indexed by the workers that
+        # claim them, the embedding and OCR caches sparing most of the work
+        if moved_from is not None:
+            old_paths = set(self.state_db.find_stored_files(moved_from))
+            if not filepath.is_dir():
+                old_paths.add(moved_from)
+            self.work_queue.enqueue([(path, None) for path in old_paths], delete=True)
+
+        if deleted:
+            self.work_queue.enqueue([(filepath, None)], delete=True)
+        elif filepath.is_dir():
+            self.work_queue.enqueue(self.scanner.scan([filepath]))
+        else:
+            self.work_queue.enqueue([(filepath, os.path.getmtime(filepath))])
+
     def __on_created_or_modified(self, event: FileSystemEvent):
         if event.is_directory:
             return
@@ -170,10 +275,7 @@ class DocumentIndexer:
         if not self.doc_factory.filter_file(filepath):
             return
 
-        with self.lock:
-            # Small delay to allow file write to finish
-            time.sleep(0.5)
-            self.process_file(filepath)
+        self.watcher_queue.push(filepath)
 
     def __on_deleted(self, event: FileSystemEvent):
         if event.is_directory:
@@ -183,21 +285,25 @@ class DocumentIndexer:
         if not self.doc_factory.filter_file(filepath):
             return
 
-        with self.lock:
-            self.remove_file(filepath)
+        self.watcher_queue.push(filepath, deleted=True)
 
     def __on_moved(self, event: FileSystemEvent):
-        # TODO Implement folder and file renaming
+        srcpath = Path(event.src_path)
+        destpath = Path(event.dest_path)
         if event.is_directory:
+            # The index entries of the files of the directory are renamed in one go. The moves
+            # of the files, also reported by watchdog, then find nothing left to rename
+            self.watcher_queue.push_move(srcpath, destpath)
             return
 
-        srcpath = Path(event.src_path)
-        destpath = Path(event.dest_path)
-        if srcpath.suffix in (".pdf", ".docx", ".xlsx", ".xlsm", ".md", ".txt"):
-            with self.lock:
-                time.sleep(0.5)
-                self.remove_file(srcpath)
-                self.process_file(destpath)
+        src_indexed = self.doc_factory.filter_file(srcpath)
+        dest_indexed = self.doc_factory.filter_file(destpath)
+        if src_indexed and dest_indexed:
+            self.watcher_queue.push_move(srcpath, destpath)
+        elif src_indexed:
+            self.watcher_queue.push(srcpath, deleted=True)
+        elif dest_indexed:
+            self.watcher_queue.push(destpath)
 
     def start_watcher(self):
         """
@@ -210,6 +316,11 @@ class DocumentIndexer:
         event_handler.on_moved = self.__on_moved
         event_handler.on_deleted = self.__on_deleted
 
+        self.watcher_queue.start()
+
+        if self.work_queue is not None:
+            threading.Thread(target=self.process_work_queue, name="work-queue", daemon=True).start()
+
         # Files observer
         self.__docs_observer = Observer()
         self.__docs_observer.schedule(event_handler, path=str(config.DOCS_PATH), recursive=True)
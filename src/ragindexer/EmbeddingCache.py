@@ -0,0 +1,239 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Callable, List, Optional
+
+import numpy as np
+
+from . import logger
+from .config import config
+from .index_database import journal_mode
+from .models import ChunkType, EmbeddingBatchType, EmbeddingType
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of the chunks embeddings, keyed by the model name and the hash of the
+    chunk text. Vectors are stored as float32 blobs in a sqlite database. When the size of the
+    stored vectors exceeds max_bytes, the least recently used ones are evicted.
+
+    The cache can be shared by several processes: the size of the stored vectors is kept in the
+    database, and updated in the transactions that store or evict vectors, and the vectors are
+    ordered by the time they were last used.
+
+    Args:
+        model_name: Name of the embedding model. Embeddings of different models never collide
+        db_path: Path to the sqlite database
+        max_bytes: Maximum size of the stored vectors, in bytes
+
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        db_path: Path = config.STATE_DB_PATH.parent / "embeddings_cache.db",
+        max_bytes: int = config.EMBEDDING_CACHE_MAX_MB * 1024 * 1024,
+    ):
+        self.model_name = model_name
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(db_path.parent, exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.__conn.execute(f"PRAGMA journal_mode={journal_mode()}")
+        self.__conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key BLOB PRIMARY KEY,
+                vector BLOB,
+                last_used INTEGER
+            )
+        """
+        )
+        self.__conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        self.__conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS meta (
+                name TEXT PRIMARY KEY,
+                value INTEGER
+            )
+        """
+        )
+        # Caches created before their size was stored
+        self.__conn.execute(
+            "INSERT OR IGNORE INTO meta (name, value) "
+            "SELECT 'size', COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        )
+        self.__conn.commit()
+
+        size = self.__stored_size()
+        logger.info(f"Using embedding cache '{db_path}' ({size / 1024**2:.1f} MB)")
+
+    def __stored_size(self) -> int:
+        return self.__conn.execute("SELECT value FROM meta WHERE name = 'size'").fetchone()[0]
+
+    def __add_size(self, nb_bytes: int):
+        self.__conn.execute("UPDATE meta SET value = value + ? WHERE name = 'size'", (nb_bytes,))
+
+    def __key(self, chunk: ChunkType) -> bytes:
+        return hashlib.sha256(f"{self.model_name}\0{chunk}".encode("utf-8")).digest()
+
+    def get_many(self, chunks: List[ChunkType]) -> List[Optional[EmbeddingType]]:
+        """
+        Look up the embeddings of a list of chunks
+
+        Args:
+            chunks: List of chunks to look up
+
+        Returns:
+            The list of the cached embeddings, with None for the chunks not in the cache.
+            The embeddings are read-only arrays on the stored bytes
+
+        """
+        keys = [self.__key(chunk) for chunk in chunks]
+        found = {}
+        with self.__lock:
+            # Stay below the default limit of 999 parameters per query
+            for start in range(0, len(keys), 500):
+                sub_keys = keys[start : start + 500]
+                marks = ",".join("?" * len(sub_keys))
+                rows = self.__conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({marks})", sub_keys
+                ).fetchall()
+                found.update(rows)
+
+            if found:
+                now = time.time()
+                self.__conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found.keys()],
+                )
+                self.__conn.commit()
+
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+
+        return [
+            np.frombuffer(found[key], dtype=np.float32) if key in found else None for key in keys
+        ]
+
+    def put_many(self, chunks: List[ChunkType], embeddings: EmbeddingBatchType):
+        """
+        Store the embeddings of a list of chunks, and evict the least recently used ones
+        if the cache is full
+
+        Args:
+            chunks: List of chunks
+            embeddings: The corresponding embeddings, one per row
+
+        """
+        rows = [
+            (self.__key(chunk), np.ascontiguousarray(emb, dtype=np.float32).tobytes())
+            for chunk, emb in zip(chunks, embeddings)
+        ]
+        now = time.time()
+        with self.__lock, self.__conn:
+            # The write lock is taken first, so that the size is not changed by other processes
+            # until the end of the eviction
+            self.__conn.execute("BEGIN IMMEDIATE")
+            nb_bytes = 0
+            for key, vector in rows:
+                cur = self.__conn.execute(
+                    "INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                    (key, vector, now),
+                )
+                nb_bytes += len(vector) * cur.rowcount
+            self.__add_size(nb_bytes)
+
+            size = self.__stored_size()
+            if size > self.max_bytes:
+                self.__evict(size)
+
+    def __evict(self, size: int):
+        # Free 10% of the cache at once, so that eviction does not run on every insertion.
+        # The transaction must be open
+        target = int(self.max_bytes * 0.9)
+        freed = 0
+        while size - freed > target:
+            rows = self.__conn.execute(
+                "SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_used LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                freed = size
+                break
+
+            evicted = []
+            for key, nb_bytes in rows:
+                evicted.append((key,))
+                freed += nb_bytes
+                if size - freed <= target:
+                    break
+            self.__conn.executemany("DELETE FROM embeddings WHERE key = ?", evicted)
+            logger.debug(f"[EMBED] Evicted {len(evicted)} vectors from the embedding cache")
+        self.__add_size(-freed)
+
+    def encode(
+        self,
+        chunks: List[ChunkType],
+        encode_func: Callable[[List[ChunkType]], EmbeddingBatchType],
+    ) -> EmbeddingBatchType:
+        """
+        Get the embeddings of a list of chunks, computing only those missing from the cache
+
+        Args:
+            chunks: List of chunks
+            encode_func: Function that computes the embeddings of a list of chunks, as an array
+                with one row per chunk
+
+        Returns:
+            The array of embeddings, with one row per chunk, in the same order as chunks
+
+        """
+        cached = self.get_many(chunks)
+        # Identical chunks missing from the cache are encoded only once
+        missing_chunks = list(dict.fromkeys(c for c, emb in zip(chunks, cached) if emb is None))
+        if len(missing_chunks) == len(chunks):
+            computed = encode_func(chunks)
+            self.put_many(chunks, computed)
+            return computed
+
+        computed_rows = {}
+        if missing_chunks:
+            computed = encode_func(missing_chunks)
+            self.put_many(missing_chunks, computed)
+            computed_rows = dict(zip(missing_chunks, computed))
+
+        if missing_chunks:
+            dim = computed.shape[1]
+        else:
+            dim = len(cached[0])
+        embeddings = np.empty((len(chunks), dim), dtype=np.float32)
+        for k, (chunk, emb) in enumerate(zip(chunks, cached)):
+            embeddings[k] = computed_rows[chunk] if emb is None else emb
+
+        return embeddings
+
+    def stats(self) -> dict:
+        """
+        Usage statistics of the cache
+
+        Returns:
+            A dictionary with the number of hits, misses, the hit rate and the size in bytes
+            of the stored vectors
+
+        """
+        with self.__lock:
+            hits, misses, size = self.hits, self.misses, self.__stored_size()
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses > 0 else 0.0,
+            "size": size,
+        }
@@ -0,0 +1,98 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, List, Tuple
+
+from . import logger
+from .config import config
+from .documents.DocumentFactory import DocumentFactory
+
+
+class FileScanner:
+    """
+    Walks directory trees to find the files handled by the `DocumentFactory`.
+
+    Each tree is walked once with `os.scandir`, the subdirectories being scanned concurrently
+    by a pool of SCAN_WORKERS threads. The modification time comes from the stat result
+    of the directory entry, so each file is stat'ed only once.
+
+    Args:
+        doc_factory: Factory whose registered extensions are looked for
+
+    """
+
+    def __init__(self, doc_factory: DocumentFactory):
+        self.doc_factory = doc_factory
+
+    def scan(self, roots: List[Path]) -> Iterable[Tuple[Path, float]]:
+        """
+        Find the files in the given directory trees. Files are yielded as soon as they are
+        found, in no particular order
+
+        Args:
+            roots: Directories to walk
+
+        Yields:
+            A tuple with the absolute path of a file and its modification time
+
+        """
+        results = queue.Queue(maxsize=1024)
+        lock = threading.Lock()
+        nb_pending = 0
+        stopped = threading.Event()
+        done = object()
+
+        def scan_dir(directory: str):
+            nonlocal nb_pending
+            try:
+                if not stopped.is_set():
+                    with os.scandir(directory) as it:
+                        for entry in it:
+                            if stopped.is_set():
+                                break
+                            try:
+                                if entry.is_dir(follow_symlinks=False):
+                                    with lock:
+                                        nb_pending += 1
+                                    executor.submit(scan_dir, entry.path)
+                                elif entry.is_file():
+                                    path = Path(entry.path)
+                                    if self.doc_factory.filter_file(path):
+                                        results.put((path, entry.stat().st_mtime))
+                            except OSError as e:
+                                logger.warning(f"Cannot read '{entry.path}': {e}")
+            except OSError as e:
+                logger.warning(f"Cannot scan directory '{directory}': {e}")
+            finally:
+                with lock:
+                    nb_pending -= 1
+                    if nb_pending == 0:
+                        results.put(done)
+
+        roots = [root.resolve() for root in roots if root.exists()]
+        if not roots:
+            return
+
+        with ThreadPoolExecutor(
+            max_workers=config.SCAN_WORKERS, thread_name_prefix="scan"
+        ) as executor:
+            nb_pending = len(roots)
+            for root in roots:
+                executor.submit(scan_dir, str(root))
+
+            try:
+                while True:
+                    item = results.get()
+                    if item is done:
+                        break
+                    yield item
+            finally:
+                # The caller may stop reading before the end: unblock the workers
+                stopped.set()
+                while nb_pending > 0:
+                    try:
+                        results.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
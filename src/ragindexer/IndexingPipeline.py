@@ -0,0 +1,760 @@
+import hashlib
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from . import logger
+from .config import config
+from .documents.ADocument import ADocument
+from .documents.DocumentFactory import DocumentFactory
+from .index_database import StateDB, file_hash
+from .metrics import ERRORS, FILES
+from .QdrantIndexer import QdrantIndexer
+from .models import ChunkType
+
+
+class IndexingJob:
+    """
+    A file going through the indexing pipeline.
+    A job either indexes the file, removes it from the index when it has been deleted, or
+    transfers the index entries of a renamed file or directory to its new path. A renamed file
+    is then indexed by another job, and only extracted again if its content changed.
+    The job keeps track of the pages that have been extracted and of those that have
+    reached the end of the pipeline, so that the state DB is only updated once every page
+    of the file has been upserted.
+
+    In incremental mode, the job also holds the chunk manifest recorded for the file at the
+    previous indexation, and builds the new one.
+
+    A cancelled job stops extracting pages, drops the pages not yet upserted and finishes as
+    failed.
+
+    Args:
+        filepath: Path to the file to index
+        force: True to process the file even if the database says that it has already been processed
+        mtime: Modification time of the file, if already known
+        delete: True to remove the file from the index instead of indexing it
+        moved_from: Old path of the renamed file or directory, for a job transferring its index
+            entries
+        lease_check: Function telling if the file may still be written by this indexer, checked
+            before the state DB is updated. None if the indexer always may
+
+    """
+
+    def __init__(
+        self,
+        filepath: Path,
+        force: bool = False,
+        mtime: Optional[float] = None,
+        delete: bool = False,
+        moved_from: Optional[Path] = None,
+        lease_check: Optional[Callable[[], bool]] = None,
+    ):
+        self.filepath = filepath
+        self.force = force
+        self.mtime = mtime
+        self.delete = delete
+        self.moved_from = moved_from
+        self.lease_check = lease_check
+        self.content_hash: Optional[str] = None
+        self.document: Optional[ADocument] = None
+        self.started = False
+        self.failed = False
+        self.cancelled = False
+        self.nb_chunks = 0
+        self.nb_unchanged = 0
+        self.start_time = 0.0
+        self.submit_time = time.perf_counter()
+        self.end_time: Optional[float] = None
+        self.manifest: Dict[Tuple[int, int], Tuple[str, str]] = {}
+        self.new_manifest: Dict[Tuple[int, int], Tuple[str, str]] = {}
+
+        self.__lock = threading.Lock()
+        self.__nb_pages = 0
+        self.__nb_pages_done = 0
+        self.__extracted = False
+        self.__done = threading.Event()
+        self.__callbacks: List[Callable[["IndexingJob"], None]] = []
+
+    def cancel(self):
+        """Stops the processing of the file, which finishes as failed"""
+        self.cancelled = True
+        self.failed = True
+
+    def holds_lease(self) -> bool:
+        """
+        Tells if the result of the job may be recorded
+
+        Returns:
+            The result of lease_check, True if there is none
+
+        """
+        return self.lease_check is None or self.lease_check()
+
+    def add_page(self):
+        """Declares a new page extracted from the file"""
+        with self.__lock:
+            self.__nb_pages += 1
+
+    def diff_chunks(self, k_page: int, chunks: List[ChunkType]) -> Tuple[List[int], List[str]]:
+        """
+        Records the chunks of a page in the new manifest, and compares them with the old one
+
+        Args:
+            k_page: Page of the chunks
+            chunks: List of chunks of the page
+
+        Returns:
+            The indices of the chunks that are new or have changed, and the IDs of their points
+
+        """
+        changed_indices = []
+        point_ids = []
+        with self.__lock:
+            for idx, chunk in enumerate(chunks):
+                chunk_hash = hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+                old = self.manifest.get((k_page, idx))
+                if old is None:
+                    point_id = QdrantIndexer.point_id(self.filepath, k_page, idx)
+                else:
+                    point_id = old[0]
+                self.new_manifest[(k_page, idx)] = (point_id, chunk_hash)
+
+                if old is not None and old[1] == chunk_hash and not self.force:
+                    self.nb_unchanged += 1
+                else:
+                    changed_indices.append(idx)
+                    point_ids.append(point_id)
+
+        return changed_indices, point_ids
+
+    def stale_point_ids(self) -> List[str]:
+        """
+        Lists the points of the old manifest that are not in the new one
+
+        Returns:
+            The IDs of the points to delete
+
+        """
+        with self.__lock:
+            return [
+                point_id
+                for slot, (point_id, _) in self.manifest.items()
+                if slot not in self.new_manifest
+            ]
+
+    def page_done(self, nb_chunks: int) -> bool:
+        """
+        Declares that a page has gone through the whole pipeline
+
+        Args:
+            nb_chunks: Number of chunks recorded for the page
+
+        Returns:
+            True if this was the last page of the file
+
+        """
+        with self.__lock:
+            self.__nb_pages_done += 1
+            self.nb_chunks += nb_chunks
+            return self.__extracted and self.__nb_pages_done == self.__nb_pages
+
+    def extraction_done(self) -> bool:
+        """
+        Declares that no more pages will be extracted from the file
+
+        Returns:
+            True if all the pages have already gone through the whole pipeline
+
+        """
+        with self.__lock:
+            self.__extracted = True
+            return self.__nb_pages_done == self.__nb_pages
+
+    def finish(self):
+        """
+        Marks the job as finished, wakes up the threads waiting for it and calls the functions
+        given to `IndexingJob.add_done_callback`
+
+        """
+        self.end_time = time.perf_counter()
+        with self.__lock:
+            self.__done.set()
+            callbacks, self.__callbacks = self.__callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback: Callable[["IndexingJob"], None]):
+        """
+        Registers a function called with the job once it is finished, from the thread that
+        finishes it. If the job is already finished, the function is called immediately
+
+        Args:
+            callback: The function to call
+
+        """
+        with self.__lock:
+            if not self.__done.is_set():
+                self.__callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until the job is finished
+
+        Args:
+            timeout: Maximum time to wait, in seconds. None to wait forever
+
+        Returns:
+            True if the job is finished
+
+        """
+        return self.__done.wait(timeout)
+
+
+class _Stage:
+    """
+    A pool of worker threads reading items from a bounded queue
+
+    Args:
+        name: Name of the stage
+        func: Function called with a list of items, that returns the items for the next stage
+        nb_workers: Number of worker threads
+        input_queue: Queue the items are read from
+        output_queue: Queue the results are written to. None for the last stage
+        max_items: Maximum number of items given at once to func
+
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[list], list],
+        nb_workers: int,
+        input_queue: queue.Queue,
+        output_queue: Optional[queue.Queue],
+        max_items: int = 1,
+    ):
+        self.name = name
+        self.func = func
+        self.nb_workers = nb_workers
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.max_items = max_items
+
+        self.processed = 0
+        self.busy_time = 0.0
+        self.__stats_lock = threading.Lock()
+        self.__threads: List[threading.Thread] = []
+
+    def start(self):
+        for k in range(self.nb_workers):
+            th = threading.Thread(target=self.__run, name=f"{self.name}-{k}", daemon=True)
+            th.start()
+            self.__threads.append(th)
+
+    def stop(self):
+        for _ in self.__threads:
+            self.input_queue.put(None)
+        for th in self.__threads:
+            th.join()
+        self.__threads = []
+
+    def __run(self):
+        while True:
+            item = self.input_queue.get()
+            if item is None:
+                return
+
+            items = [item]
+            while len(items) < self.max_items:
+                try:
+                    item = self.input_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    # Give the stop signal back to the other workers, and to ourselves
+                    self.input_queue.put(None)
+                    break
+                items.append(item)
+
+            t0 = time.perf_counter()
+            try:
+                for result in self.func(items):
+                    # Blocks while the next stage is full: this is the backpressure
+                    self.output_queue.put(result)
+            except Exception as e:
+                logger.error(f"[PIPELINE] Unexpected error in stage '{self.name}': {e}")
+            with self.__stats_lock:
+                self.processed += len(items)
+                self.busy_time += time.perf_counter() - t0
+
+
+class IndexingPipeline:
+    """
+    Indexing pipeline where extraction, chunking, embedding and upsert each run in their
+    own pool of worker threads. The stages are connected by bounded queues: when a stage
+    is too slow, the previous ones block until it catches up.
+
+    Stages concurrency is set by PIPELINE_EXTRACT_WORKERS, PIPELINE_CHUNK_WORKERS,
+    PIPELINE_EMBED_WORKERS and PIPELINE_UPSERT_WORKERS. The size of the queues between stages
+    is set by PIPELINE_QUEUE_SIZE (in pages), and the number of files being processed at once
+    by PIPELINE_MAX_FILES_IN_FLIGHT.
+
+    When INCREMENTAL_REINDEX is True, a manifest of the chunks recorded in Qdrant is kept for
+    each file in the state DB. Only the chunks that changed since the previous indexation are
+    embedded and upserted, and the points of the chunks that disappeared are deleted.
+
+    In distributed mode, the jobs get the lease of their file on the work queue as lease_check,
+    checked before a file is removed from the index and before the state DB is updated, and
+    they are cancelled when the lease is lost. The points already upserted by a job whose lease
+    is lost are left in Qdrant: their IDs are derived from the path of the file and the position
+    of the chunks, so the worker now holding the file overwrites them. The check and the update
+    of the state DB are not atomic: if the lease expires between them, both workers record the
+    file, which is then indexed again only if it changed.
+
+    Args:
+        doc_factory: Factory used to read the files and to compute the embeddings
+        qdrant: Qdrant client used to record the embeddings
+        state_db: Database keeping track of the indexed files
+
+    """
+
+    def __init__(self, doc_factory: DocumentFactory, qdrant: QdrantIndexer, state_db: StateDB):
+        self.doc_factory = doc_factory
+        self.qdrant = qdrant
+        self.state_db = state_db
+
+        self.__lock = threading.Condition()
+        self.__jobs: Dict[Path, IndexingJob] = {}
+        self.__deferred: Dict[Path, IndexingJob] = {}
+        # Directories being renamed, as (old path, new path) tuples
+        self.__moves: List[Tuple[Path, Path]] = []
+        self.__slots = threading.BoundedSemaphore(config.PIPELINE_MAX_FILES_IN_FLIGHT)
+
+        files_queue = queue.Queue()
+        text_queue = queue.Queue(maxsize=config.PIPELINE_QUEUE_SIZE)
+        chunks_queue = queue.Queue(maxsize=config.PIPELINE_QUEUE_SIZE)
+        embeddings_queue = queue.Queue(maxsize=config.PIPELINE_QUEUE_SIZE)
+        self.__stages = [
+            _Stage(
+                "extract",
+                self.__extract,
+                config.PIPELINE_EXTRACT_WORKERS,
+                files_queue,
+                text_queue,
+            ),
+            _Stage(
+                "chunk",
+                self.__chunk,
+                config.PIPELINE_CHUNK_WORKERS,
+                text_queue,
+                chunks_queue,
+            ),
+            _Stage(
+                "embed",
+                self.__embed,
+                config.PIPELINE_EMBED_WORKERS,
+                chunks_queue,
+                embeddings_queue,
+                max_items=config.PIPELINE_QUEUE_SIZE,
+            ),
+            _Stage(
+                "upsert",
+                self.__upsert,
+                config.PIPELINE_UPSERT_WORKERS,
+                embeddings_queue,
+                None,
+            ),
+        ]
+
+    def start(self):
+        """Starts the worker threads of all the stages"""
+        for stage in self.__stages:
+            stage.start()
+
+    def stop(self):
+        """Waits for the submitted files to be indexed, then stops the worker threads"""
+        self.wait_idle()
+        for stage in self.__stages:
+            stage.stop()
+
+    def submit(
+        self,
+        filepath: Path,
+        force: bool = False,
+        mtime: Optional[float] = None,
+        delete: bool = False,
+        moved_from: Optional[Path] = None,
+        lease_check: Optional[Callable[[], bool]] = None,
+    ) -> IndexingJob:
+        """
+        Submits a file to the pipeline. Blocks while PIPELINE_MAX_FILES_IN_FLIGHT files are
+        already being processed.
+        Jobs on the same path never run concurrently: if the file is already waiting to be
+        processed, the waiting job is updated and returned. If it is being processed, a new job
+        is started once the current one is finished.
+        A renamed file or directory is handled in the calling thread: once the jobs on the files
+        under its old and new paths are finished, the index entries of its files are renamed.
+        The jobs submitted meanwhile on these files wait for the end of the renaming. A renamed
+        file is then submitted, to be extracted again if its content changed.
+
+        Args:
+            filepath: Path to the file to index
+            force: True to process the file even if the database says that it has already been
+                processed
+            mtime: Modification time of the file, if already known
+            delete: True to remove the file from the index instead of indexing it
+            moved_from: Old path of the file, if it has been renamed
+            lease_check: Function telling if the file may still be written by this indexer
+
+        Returns:
+            The job, that can be waited for
+
+        """
+        if moved_from is not None:
+            move_job = self.__move_paths(moved_from, filepath)
+            if filepath.is_dir():
+                return move_job
+
+        with self.__lock:
+            self.__lock.wait_for(lambda: not self.__being_moved(filepath))
+            job = self.__deferred.get(filepath) or self.__jobs.get(filepath)
+            if job is not None and not job.started:
+                job.force = job.force or force
+                job.mtime = None
+                job.delete = delete
+                job.lease_check = lease_check or job.lease_check
+                return job
+
+            new_job = IndexingJob(
+                filepath,
+                force=force,
+                mtime=mtime,
+                delete=delete,
+                lease_check=lease_check,
+            )
+            if job is not None:
+                self.__deferred[filepath] = new_job
+                return new_job
+
+        self.__slots.acquire()
+        with self.__lock:
+            self.__jobs[filepath] = new_job
+        self.__stages[0].input_queue.put(new_job)
+
+        return new_job
+
+    def __being_moved(self, path: Path) -> bool:
+        # The lock must be held
+        return any(
+            path.is_relative_to(srcpath) or path.is_relative_to(destpath)
+            for srcpath, destpath in self.__moves
+        )
+
+    def __move_paths(self, srcpath: Path, destpath: Path) -> IndexingJob:
+        job = IndexingJob(destpath, moved_from=srcpath)
+        with self.__lock:
+            self.__lock.wait_for(
+                lambda: not self.__being_moved(srcpath) and not self.__being_moved(destpath)
+            )
+            self.__moves.append((srcpath, destpath))
+            # The jobs on the files of the directory, running or waiting, are finished first
+            self.__lock.wait_for(
+                lambda: not any(
+                    path.is_relative_to(srcpath) or path.is_relative_to(destpath)
+                    for path in self.__jobs
+                )
+            )
+            job.started = True
+
+        try:
+            self.move(srcpath, destpath)
+        except Exception as e:
+            logger.error(f"[MOVE] Renaming of '{srcpath}' to '{destpath}' failed: {e}")
+            ERRORS.inc(stage="move")
+            job.failed = True
+        finally:
+            with self.__lock:
+                self.__moves.remove((srcpath, destpath))
+                self.__lock.notify_all()
+            job.finish()
+
+        return job
+
+    def move(self, srcpath: Path, destpath: Path) -> int:
+        """
+        Transfers the index entries of a renamed file, or of all the files of a renamed
+        directory: their points in Qdrant, moved to the IDs of the new paths, and their rows in
+        the state DB. Nothing is extracted nor embedded again, and the OCR cache is keyed by the
+        content of the files. The points of the files the renamed ones replace are deleted.
+        Call `IndexingPipeline.submit` with moved_from instead, so that the renaming does not
+        run concurrently with the jobs on the same paths
+
+        Args:
+            srcpath: Old path of the file or directory
+            destpath: New path of the file or directory
+
+        Returns:
+            The number of indexed files that have been renamed
+
+        """
+        renames = [
+            (stored_path, destpath / stored_path.relative_to(srcpath))
+            for stored_path in self.state_db.find_stored_files(srcpath)
+        ]
+        if renames:
+            # Files overwritten by the renaming
+            replaced = set(self.state_db.find_stored_files(destpath))
+            for _, new_path in renames:
+                if new_path in replaced:
+                    self.qdrant.delete_by_source(new_path)
+            self.qdrant.rename_sources(renames)
+            self.state_db.rename_stored_files(renames, point_id=QdrantIndexer.point_id)
+            logger.info(f"[MOVE] Renamed {len(renames)} files from '{srcpath}' to '{destpath}'")
+
+        return len(renames)
+
+    def wait_idle(self):
+        """Waits until all the submitted files have been processed"""
+        with self.__lock:
+            self.__lock.wait_for(lambda: len(self.__jobs) == 0)
+
+    def queue_depths(self) -> Dict[str, int]:
+        """
+        Number of items waiting in front of each stage
+
+        Returns:
+            A dictionary giving, for each stage name, the size of its input queue
+
+        """
+        return {stage.name: stage.input_queue.qsize() for stage in self.__stages}
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        Activity of each stage since the pipeline was created
+
+        Returns:
+            A dictionary giving, for each stage name, the number of workers, the number of
+            items processed, the time spent processing them in seconds (summed over the workers)
+            and the current queue depth
+
+        """
+        return {
+            stage.name: {
+                "workers": stage.nb_workers,
+                "processed": stage.processed,
+                "busy_time": stage.busy_time,
+                "queue_depth": stage.input_queue.qsize(),
+            }
+            for stage in self.__stages
+        }
+
+    def __extract(self, jobs: List[IndexingJob]):
+        for job in jobs:
+            with self.__lock:
+                job.started = True
+            job.start_time = time.perf_counter()
+            try:
+                yield from self.__extract_job(job)
+            except Exception as e:
+                logger.error(f"[INDEX] Extraction failed for '{job.filepath}': {e}")
+                ERRORS.inc(stage="extract")
+                job.failed = True
+
+            if job.extraction_done():
+                self.__complete(job)
+
+    def __extract_job(self, job: IndexingJob):
+        if job.cancelled:
+            return
+
+        if job.delete:
+            if not job.holds_lease():
+                logger.warning(f"[DELETE] Lease of '{job.filepath}' lost, not removing it")
+                job.failed = True
+                return
+            logger.info(f"[DELETE] Removing file from index: '{job.filepath}'")
+            self.qdrant.delete_by_source(job.filepath)
+            self.state_db.delete_stored_file(job.filepath)
+            return
+
+        if job.mtime is None:
+            job.mtime = os.path.getmtime(job.filepath)
+        stored = self.state_db.get_stored_timestamp(job.filepath)
+        if (stored is not None and stored == job.mtime) and not job.force:
+            # No change
+            return
+
+        # The modification time changed, but maybe not the content
+        job.content_hash = file_hash(job.filepath)
+        if (
+            stored is not None
+            and self.state_db.get_content_hash(job.filepath) == job.content_hash
+            and not job.force
+        ):
+            if job.holds_lease():
+                self.state_db.set_stored_timestamp(job.filepath, job.mtime, job.content_hash)
+            else:
+                job.failed = True
+            return
+
+        logger.info(72 * "=")
+        logger.info(f"[INDEX] Processing changed file: '{job.filepath}'")
+        if config.INCREMENTAL_REINDEX:
+            job.manifest = self.state_db.get_chunk_manifest(job.filepath)
+        cls = self.doc_factory.getBuild(job.filepath.suffix)
+        job.document = cls(job.filepath, job.content_hash)
+        for k_page, text, file_metadata in job.document.iterate_pages():
+            if job.cancelled:
+                break
+            # Each page gets its own copy, as pages are processed concurrently
+            file_metadata = dict(file_metadata)
+            file_metadata["abspath"] = job.filepath
+            job.add_page()
+            yield job, k_page, text, file_metadata
+
+    def __chunk(self, items: list):
+        for job, k_page, text, file_metadata in items:
+            if job.cancelled:
+                yield job, k_page, [], [], None, file_metadata
+                continue
+            try:
+                chunks = job.document.chunk_text(text, self.doc_factory.get_chunker())
+                if config.INCREMENTAL_REINDEX:
+                    chunk_indices, point_ids = job.diff_chunks(k_page, chunks)
+                    chunks = [chunks[idx] for idx in chunk_indices]
+                else:
+                    chunk_indices = list(range(len(chunks)))
+                    point_ids = None
+            except Exception as e:
+                logger.error(f"[INDEX] Chunking failed for '{job.filepath}': {e}")
+                ERRORS.inc(stage="chunk")
+                job.failed = True
+                chunks, chunk_indices, point_ids = [], [], None
+            yield job, k_page, chunks, chunk_indices, point_ids, file_metadata
+
+    def __embed(self, items: list):
+        pages = (
+            ((job, k_page, chunk_indices, point_ids, file_metadata), chunks)
+            for job, k_page, chunks, chunk_indices, point_ids, file_metadata in items
+        )
+        nb_done = 0
+        try:
+            for (
+                (job, k_page, chunk_indices, point_ids, file_metadata),
+                chunks,
+                embeddings,
+            ) in self.doc_factory.get_batcher().embed_pages(pages):
+                nb_done += 1
+                yield job, k_page, chunks, chunk_indices, point_ids, embeddings, file_metadata
+        except Exception as e:
+            logger.error(f"[INDEX] Embedding failed: {e}")
+            ERRORS.inc(stage="embed")
+            # Pages are yielded in order, so the remaining ones are those that failed
+            for job, k_page, _, _, _, file_metadata in items[nb_done:]:
+                job.failed = True
+                yield job, k_page, [], [], None, [], file_metadata
+
+    def __upsert(self, items: list):
+        for job, k_page, chunks, chunk_indices, point_ids, embeddings, file_metadata in items:
+            if job.cancelled:
+                chunks, chunk_indices, point_ids, embeddings = [], [], [], []
+            try:
+                self.qdrant.record_embeddings(
+                    k_page,
+                    chunks,
+                    embeddings,
+                    file_metadata,
+                    chunk_indices=chunk_indices,
+                    point_ids=point_ids,
+                )
+            except Exception as e:
+                logger.error(f"[INDEX] Upsert failed for '{job.filepath}': {e}")
+                ERRORS.inc(stage="upsert")
+                job.failed = True
+
+            if job.page_done(len(embeddings)):
+                self.__complete(job)
+
+        return []
+
+    def __record(self, job: IndexingJob):
+        # Records the result of an indexation in the state DB
+        if job.cancelled:
+            logger.warning(f"[INDEX] Indexing of '{job.filepath}' cancelled")
+        elif job.failed:
+            logger.error(f"[INDEX] Indexing of '{job.filepath}' failed, will retry later")
+        elif not self.qdrant.flush(job.filepath):
+            logger.error(f"[INDEX] Upsert of '{job.filepath}' failed, will retry later")
+            job.failed = True
+        elif not job.holds_lease():
+            logger.warning(f"[INDEX] Lease of '{job.filepath}' lost, not recording its indexation")
+            job.failed = True
+        else:
+            if config.INCREMENTAL_REINDEX:
+                stale_ids = job.stale_point_ids()
+                self.qdrant.delete(stale_ids)
+                self.state_db.set_chunk_manifest(job.filepath, job.new_manifest)
+                logger.info(
+                    f"[INDEX] {job.nb_unchanged} unchanged chunks skipped, "
+                    f"{len(stale_ids)} stale vectors deleted"
+                )
+
+            # Update state DB
+            self.state_db.set_stored_timestamp(job.filepath, job.mtime, job.content_hash)
+            FILES.inc()
+
+            elapsed = time.perf_counter() - job.start_time
+            batcher_stats = self.doc_factory.get_batcher().stats()
+            logger.info(
+                f"[INDEX] Upserted {job.nb_chunks} vectors for '{job.filepath}' "
+                f"in {elapsed:.1f} s ({job.nb_chunks / elapsed if elapsed > 0 else 0.0:.1f} "
+                f"chunks/s overall, {batcher_stats['chunks_per_second']:.1f} chunks/s encoding)"
+            )
+            chunker_stats = self.doc_factory.get_chunker().stats()
+            logger.info(
+                f"[INDEX] Chunker: {chunker_stats['truncated']} of {chunker_stats['chunks']} "
+                f"chunks truncated by the model ({100 * chunker_stats['truncation_rate']:.1f} %)"
+            )
+            cache = self.doc_factory.get_embedding_cache()
+            if cache is not None:
+                cache_stats = cache.stats()
+                logger.info(
+                    f"[INDEX] Embedding cache: {cache_stats['hits']} hits, "
+                    f"{cache_stats['misses']} misses ({100 * cache_stats['hit_rate']:.1f} %)"
+                )
+
+    def __complete(self, job: IndexingJob):
+        # The job is always finished, and its slot handed over, whatever fails here: otherwise
+        # the threads waiting for it would block forever
+        try:
+            if job.document is not None:
+                self.__record(job)
+        except Exception as e:
+            logger.error(f"[INDEX] Recording of '{job.filepath}' failed, will retry later: {e}")
+            ERRORS.inc(stage="complete")
+            job.failed = True
+        finally:
+            job.document = None
+            self.__finish(job)
+
+    def __finish(self, job: IndexingJob):
+        with self.__lock:
+            del self.__jobs[job.filepath]
+            next_job = self.__deferred.pop(job.filepath, None)
+            if next_job is not None:
+                self.__jobs[job.filepath] = next_job
+            self.__lock.notify_all()
+
+        job.finish()
+
+        if next_job is None:
+            self.__slots.release()
+        else:
+            # The slot of the finished job is handed over to the deferred one
+            self.__stages[0].input_queue.put(next_job)
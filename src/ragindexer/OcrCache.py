@@ -0,0 +1,246 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from . import logger
+from .config import config
+from .index_database import journal_mode
+
+
+class OcrCache:
+    """
+    Persistent cache of the OCR results, keyed by the hash of the content of the pdf file and
+    the page number, so that it survives renames and copies of the file.
+    The texts are stored as zlib-compressed blobs in a sqlite database. For each file, the cache
+    also records which pages needed OCR, so that the text layer of these pages is not probed
+    again. When the size of the stored texts exceeds max_bytes, the least recently used files
+    are evicted.
+
+    The cache can be shared by several processes: the size of the stored texts is kept in the
+    database, and updated in the transactions that store or evict texts, and the files are
+    ordered by the time they were last used.
+
+    Args:
+        db_path: Path to the sqlite database
+        max_bytes: Maximum size of the stored texts, in bytes
+
+    """
+
+    def __init__(
+        self,
+        db_path: Path = config.STATE_DB_PATH.parent / "ocr_cache.db",
+        max_bytes: int = config.OCR_CACHE_MAX_MB * 1024 * 1024,
+    ):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(db_path.parent, exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.__conn.execute(f"PRAGMA journal_mode={journal_mode()}")
+        self.__conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS documents (
+                doc_hash TEXT PRIMARY KEY,
+                ocr_pages TEXT,
+                last_used INTEGER
+            )
+        """
+        )
+        self.__conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                doc_hash TEXT,
+                page INTEGER,
+                text BLOB,
+                info TEXT,
+                PRIMARY KEY (doc_hash, page)
+            )
+        """
+        )
+        # Caches created before the OCR resolution and confidence were recorded
+        columns = [row[1] for row in self.__conn.execute("PRAGMA table_info(pages)")]
+        if "info" not in columns:
+            self.__conn.execute("ALTER TABLE pages ADD COLUMN info TEXT")
+        self.__conn.execute(
+            "CREATE INDEX IF NOT EXISTS documents_last_used ON documents (last_used)"
+        )
+        self.__conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS meta (
+                name TEXT PRIMARY KEY,
+                value INTEGER
+            )
+        """
+        )
+        # Caches created before their size was stored
+        self.__conn.execute(
+            "INSERT OR IGNORE INTO meta (name, value) "
+            "SELECT 'size', COALESCE(SUM(LENGTH(text)), 0) FROM pages"
+        )
+        self.__conn.commit()
+
+        size = self.__stored_size()
+        logger.info(f"Using OCR cache '{db_path}' ({size / 1024**2:.1f} MB)")
+
+    def __stored_size(self) -> int:
+        return self.__conn.execute("SELECT value FROM meta WHERE name = 'size'").fetchone()[0]
+
+    def __add_size(self, nb_bytes: int):
+        self.__conn.execute("UPDATE meta SET value = value + ? WHERE name = 'size'", (nb_bytes,))
+
+    def get_ocr_pages(self, doc_hash: str) -> Optional[List[int]]:
+        """
+        Get the pages of a file that needed OCR when it was last indexed
+
+        Args:
+            doc_hash: Hash of the content of the file
+
+        Returns:
+            The numbers of the pages, starting at 0, or None if the file is not in the cache
+
+        """
+        with self.__lock:
+            row = self.__conn.execute(
+                "SELECT ocr_pages FROM documents WHERE doc_hash = ?", (doc_hash,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            self.__conn.execute(
+                "UPDATE documents SET last_used = ? WHERE doc_hash = ?", (time.time(), doc_hash)
+            )
+            self.__conn.commit()
+        return json.loads(row[0])
+
+    def set_ocr_pages(self, doc_hash: str, ocr_pages: List[int]):
+        """
+        Records the pages of a file that need OCR
+
+        Args:
+            doc_hash: Hash of the content of the file
+            ocr_pages: The numbers of the pages, starting at 0
+
+        """
+        with self.__lock:
+            self.__conn.execute(
+                "INSERT OR REPLACE INTO documents (doc_hash, ocr_pages, last_used) "
+                "VALUES (?, ?, ?)",
+                (doc_hash, json.dumps(ocr_pages), time.time()),
+            )
+            self.__conn.commit()
+
+    def get_pages(self, doc_hash: str, k_pages: List[int]) -> Dict[int, Tuple[str, dict]]:
+        """
+        Look up the OCR text of pages of a file
+
+        Args:
+            doc_hash: Hash of the content of the file
+            k_pages: The numbers of the pages, starting at 0
+
+        Returns:
+            A dictionary giving, for the pages found in the cache, their text and the
+            information recorded with it
+
+        """
+        wanted = sorted(set(k_pages))
+        found = {}
+        with self.__lock:
+            # Stay below the default limit of 999 parameters per query
+            for k in range(0, len(wanted), 500):
+                batch = wanted[k : k + 500]
+                rows = self.__conn.execute(
+                    "SELECT page, text, info FROM pages WHERE doc_hash = ? AND page IN "
+                    f"({','.join('?' * len(batch))})",
+                    (doc_hash, *batch),
+                ).fetchall()
+                found.update((page, (text, info)) for page, text, info in rows)
+            self.hits += len(found)
+            self.misses += len(wanted) - len(found)
+
+        return {
+            page: (zlib.decompress(text).decode("utf-8"), json.loads(info) if info else {})
+            for page, (text, info) in found.items()
+        }
+
+    def put_page(self, doc_hash: str, k_page: int, text: str, info: Optional[dict] = None):
+        """
+        Stores the OCR text of a page, and evicts the least recently used files if the cache
+        is full
+
+        Args:
+            doc_hash: Hash of the content of the file
+            k_page: The number of the page, starting at 0
+            text: The OCR text of the page
+            info: Information about the OCR of the page, like the resolution and the confidence
+
+        """
+        blob = zlib.compress(text.encode("utf-8"))
+        with self.__lock, self.__conn:
+            # The write lock is taken first, so that the size is not changed by other processes
+            # until the end of the eviction
+            self.__conn.execute("BEGIN IMMEDIATE")
+            row = self.__conn.execute(
+                "SELECT LENGTH(text) FROM pages WHERE doc_hash = ? AND page = ?", (doc_hash, k_page)
+            ).fetchone()
+            self.__conn.execute(
+                "INSERT OR REPLACE INTO pages (doc_hash, page, text, info) VALUES (?, ?, ?, ?)",
+                (doc_hash, k_page, blob, json.dumps(info or {})),
+            )
+            self.__add_size(len(blob) - (row[0] if row is not None else 0))
+
+            size = self.__stored_size()
+            if size > self.max_bytes:
+                self.__evict(doc_hash, size)
+
+    def __evict(self, current_hash: str, size: int):
+        # Free 10% of the cache at once, so that eviction does not run on every insertion.
+        # The file being OCRed is kept. The transaction must be open
+        target = int(self.max_bytes * 0.9)
+        rows = self.__conn.execute(
+            "SELECT documents.doc_hash, COALESCE(SUM(LENGTH(pages.text)), 0) FROM documents "
+            "LEFT JOIN pages ON pages.doc_hash = documents.doc_hash WHERE documents.doc_hash != ? "
+            "GROUP BY documents.doc_hash ORDER BY documents.last_used",
+            (current_hash,),
+        ).fetchall()
+
+        evicted = []
+        freed = 0
+        for doc_hash, nb_bytes in rows:
+            if size - freed <= target:
+                break
+            evicted.append((doc_hash,))
+            freed += nb_bytes
+        self.__conn.executemany("DELETE FROM pages WHERE doc_hash = ?", evicted)
+        self.__add_size(-freed)
+        self.__conn.executemany("DELETE FROM documents WHERE doc_hash = ?", evicted)
+        logger.debug(f"[OCR] Evicted {len(evicted)} files from the OCR cache")
+
+    def close(self):
+        """Closes the connection to the database"""
+        with self.__lock:
+            self.__conn.close()
+
+    def stats(self) -> dict:
+        """
+        Usage statistics of the cache
+
+        Returns:
+            A dictionary with the number of page hits, misses, the hit rate and the size in bytes
+            of the stored texts
+
+        """
+        with self.__lock:
+            hits, misses, size = self.hits, self.misses, self.__stored_size()
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses > 0 else 0.0,
+            "size": size,
+        }
@@ -1,7 +1,7 @@
+from contextlib import contextmanager
 import hashlib
 from pathlib import Path
-import time
-from typing import Optional, List, Sequence, Union
+from typing import Callable, Iterable, Optional, List, Sequence, Set, Tuple, Union
 import uuid
 
 from qdrant_client.conversions import common_types as types
@@ -9,31 +9,120 @@ from qdrant_client import QdrantClient
 from qdrant_client.models import (
     VectorParams,
     Distance,
-    PointStruct,
     PointIdsList,
     ScoredPoint,
     Record,
+    Filter,
+    FieldCondition,
+    FilterSelector,
+    MatchValue,
+    PayloadSchemaType,
+    PointStruct,
+    HnswConfigDiff,
+    OptimizersConfigDiff,
+    VectorParamsDiff,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    BinaryQuantization,
+    BinaryQuantizationConfig,
+    Disabled,
+    SearchParams,
+    QuantizationSearchParams,
+    SparseVectorParams,
+    SparseIndexParams,
+    Modifier,
+    Prefetch,
+    FusionQuery,
+    Fusion,
 )
 import requests
 
 from . import logger
 from .config import config
-from .models import ChunkType, EmbeddingType
+from .index_database import StateDB
+from .metrics import QDRANT_REQUESTS_IN_FLIGHT
+from .models import ChunkType, EmbeddingBatchType
+from .QdrantWriter import QdrantWriter
+from .SparseEncoder import SparseEncoder
+
+
+# Metadata of the pages copied into the payload of their chunks, when the document gives them:
+# OCR settings, sheet and rows of spreadsheets, headers and footers of Word documents
+PAGE_PAYLOAD_KEYS = ("ocr_dpi", "ocr_confidence", "sheet", "rows", "headers_and_footers")
 
 
 # === Qdrant helper ===
 class QdrantIndexer:
     """Qdrant client that handles database operations based on the configuration
 
+    The layout of the collection is set by the QDRANT_* settings: quantization of the vectors
+    (QDRANT_QUANTIZATION), storage of the vectors and of the HNSW graph on disk, HNSW parameters
+    and optimizer thresholds. They are applied when the collection is created, and the ones that
+    Qdrant allows to change are updated on an existing collection.
+
+    QDRANT_URL=:memory: runs Qdrant in-process, without persistence.
+
+    With QDRANT_HYBRID=True, the collection is created with named vectors: the dense embedding
+    (QDRANT_DENSE_VECTOR_NAME) and a BM25 sparse vector (QDRANT_SPARSE_VECTOR_NAME) computed
+    by a `SparseEncoder` from the text of the chunks. Searches given the text of the query
+    then fuse the QDRANT_PREFETCH_LIMIT best dense and sparse candidates with Reciprocal Rank
+    Fusion. An existing collection keeps its layout: call `QdrantIndexer.empty_collection` to
+    apply a change of QDRANT_HYBRID.
+
+    Functions registered with `QdrantIndexer.add_change_listener` are told about the points
+    written, deleted or renamed, so that caches of search results can be invalidated.
+
     Args:
         vector_size: Size of the embedding vectors
+        state_db: The state DB, where the vocabulary of the sparse vectors is kept. Opened
+            if needed and not given
 
     """
 
-    def __init__(self, vector_size: int):
-        self.__client = QdrantClient(url=config.QDRANT_URL, api_key=config.QDRANT_API_KEY)
+    def __init__(self, vector_size: int, state_db: Optional[StateDB] = None):
+        if config.QDRANT_URL == ":memory:":
+            # In-process Qdrant, without server, used by the benchmarks
+            self.__client = QdrantClient(location=":memory:")
+        else:
+            self.__client = QdrantClient(url=config.QDRANT_URL, api_key=config.QDRANT_API_KEY)
         self.vector_size = vector_size
+        self.__state_db = state_db
+        self.__sparse_encoder: Optional[SparseEncoder] = None
+        self.__dense_name = ""
+        self.__sparse_name: Optional[str] = None
         self.__create_collection_if_missing()
+        self.__listeners: List[Callable[[Optional[Set[str]], Set[str], bool], None]] = []
+        self.__writer = QdrantWriter(
+            self.__client,
+            on_written=self.__on_written,
+            vector_name=self.__dense_name,
+            sparse_vector_name=self.__sparse_name,
+        )
+        QDRANT_REQUESTS_IN_FLIGHT.set_function(self.nb_requests_in_flight)
+
+    def add_change_listener(self, listener: Callable[[Optional[Set[str]], Set[str], bool], None]):
+        """
+        Registers a function called when points of the collection change
+
+        Args:
+            listener: Function called with the sources of the changed points (None if the whole
+                collection changed), the IDs of the changed points, and True if points may have
+                been added. Upserts are reported once acknowledged by Qdrant, from the sending
+                thread
+
+        """
+        self.__listeners.append(listener)
+
+    def __notify(self, sources: Optional[Set[str]], point_ids: Set[str], new_points: bool):
+        for listener in self.__listeners:
+            try:
+                listener(sources, point_ids, new_points)
+            except Exception as e:
+                logger.error(f"[QDRANT] Change listener failed: {e}")
+
+    def __on_written(self, ids: List[str], payloads: List[dict]):
+        self.__notify({payload["source"] for payload in payloads}, set(ids), True)
 
     def get_vector_by_id(self, vector_id: str) -> None | Record:
         hits = self.__client.retrieve(
@@ -71,8 +160,14 @@ class QdrantIndexer:
         return info
 
     def empty_collection(self):
+        self.flush()
         self.__client.delete_collection(collection_name=config.COLLECTION_NAME)
         self.__create_collection_if_missing()
+        self.__writer.vector_name = self.__dense_name
+        self.__writer.sparse_vector_name = self.__sparse_name
+        if self.__state_db is not None:
+            self.__state_db.delete_source_chunk_lengths()
+        self.__notify(None, set(), False)
 
     def search(
         self,
@@ -87,6 +182,7 @@ class QdrantIndexer:
         ] = None,
         limit: Optional[int] = 10,
         query_filter: Optional[types.Filter] = None,
+        query_text: Optional[str] = None,
     ) -> List[ScoredPoint]:
         """Search a vector in the database
         See https://qdrant.tech/documentation/concepts/search/
@@ -98,6 +194,8 @@ class QdrantIndexer:
             query_filter:
                 - Exclude vectors which doesn't fit given conditions.
                 - If `None` - search among all vectors
+            query_text: Text of the query. In a hybrid collection, the dense search is fused
+                with a search on the sparse vector of this text
 
         Returns:
             List of found close points with similarity scores.
@@ -108,26 +206,252 @@ class QdrantIndexer:
         else:
             query_vect = query_vector
 
+        search_params = None
+        if config.QDRANT_QUANTIZATION != "none":
+            search_params = SearchParams(
+                quantization=QuantizationSearchParams(
+                    rescore=config.QDRANT_RESCORE, oversampling=config.QDRANT_OVERSAMPLING
+                )
+            )
+
+        sparse_query = None
+        if self.__sparse_encoder is not None and query_text is not None:
+            sparse_query = self.__sparse_encoder.encode_query(query_text)
+            if not sparse_query.indices:
+                # None of the words of the query is in the collection
+                sparse_query = None
+
+        if sparse_query is None:
+            hits = self.__client.query_points(
+                collection_name=config.COLLECTION_NAME,
+                query=query_vect,
+                using=self.__dense_name or None,
+                limit=limit,
+                query_filter=query_filter,
+                search_params=search_params,
+                with_payload=True,
+            ).points
+            return hits
+
+        prefetch_limit = max(limit, config.QDRANT_PREFETCH_LIMIT)
         hits = self.__client.query_points(
             collection_name=config.COLLECTION_NAME,
-            query=query_vect,
+            prefetch=[
+                Prefetch(
+                    query=[float(x) for x in query_vect],
+                    using=self.__dense_name,
+                    limit=prefetch_limit,
+                    filter=query_filter,
+                    params=search_params,
+                ),
+                Prefetch(
+                    query=sparse_query,
+                    using=self.__sparse_name,
+                    limit=prefetch_limit,
+                    filter=query_filter,
+                ),
+            ],
+            query=FusionQuery(fusion=Fusion.RRF),
             limit=limit,
-            query_filter=query_filter,
             with_payload=True,
         ).points
         return hits
 
     def __create_collection_if_missing(self):
-        """Creates the collection provided in the COLLECTION_NAME environment variable, if not already created"""
+        """
+        Creates the collection provided in the COLLECTION_NAME environment variable, if not
+        already created
+
+        """
         existing = [c.name for c in self.__client.get_collections().collections]
         if config.COLLECTION_NAME not in existing:
             logger.info(f"Creating Qdrant collection : '{config.COLLECTION_NAME}'...")
+            vectors_config = VectorParams(
+                size=self.vector_size,
+                distance=Distance.COSINE,
+                on_disk=config.QDRANT_ON_DISK_VECTORS,
+            )
+            sparse_vectors_config = None
+            if config.QDRANT_HYBRID:
+                vectors_config = {config.QDRANT_DENSE_VECTOR_NAME: vectors_config}
+                # Qdrant applies the IDF of the terms, computed on the current collection
+                sparse_vectors_config = {
+                    config.QDRANT_SPARSE_VECTOR_NAME: SparseVectorParams(
+                        index=SparseIndexParams(on_disk=config.QDRANT_ON_DISK_VECTORS),
+                        modifier=Modifier.IDF,
+                    )
+                }
             self.__client.recreate_collection(
                 collection_name=config.COLLECTION_NAME,
-                vectors_config=VectorParams(size=self.vector_size, distance=Distance.COSINE),
+                vectors_config=vectors_config,
+                sparse_vectors_config=sparse_vectors_config,
+                hnsw_config=self.__hnsw_config(),
+                optimizers_config=self.__optimizers_config(),
+                quantization_config=self.__quantization_config(),
                 on_disk_payload=True,
             )
             logger.info("... Done")
+            self.__read_vector_names()
+        else:
+            self.__read_vector_names()
+            self.__update_collection()
+
+        self.__create_payload_indexes()
+
+    def __read_vector_names(self):
+        """
+        Reads the names of the vectors of the collection, and sets up the sparse encoder of a
+        hybrid collection
+
+        """
+        params = self.__client.get_collection(collection_name=config.COLLECTION_NAME).config.params
+        if isinstance(params.vectors, dict):
+            if config.QDRANT_DENSE_VECTOR_NAME in params.vectors:
+                self.__dense_name = config.QDRANT_DENSE_VECTOR_NAME
+            else:
+                self.__dense_name = next(iter(params.vectors))
+        else:
+            self.__dense_name = ""
+
+        sparse_vectors = params.sparse_vectors or {}
+        if config.QDRANT_SPARSE_VECTOR_NAME in sparse_vectors:
+            self.__sparse_name = config.QDRANT_SPARSE_VECTOR_NAME
+        else:
+            self.__sparse_name = None
+            if config.QDRANT_HYBRID:
+                logger.warning(
+                    f"[QDRANT] Collection '{config.COLLECTION_NAME}' has no sparse vector "
+                    f"'{config.QDRANT_SPARSE_VECTOR_NAME}': hybrid search is disabled until "
+                    "the collection is recreated"
+                )
+
+        if self.__sparse_name is not None and self.__sparse_encoder is None:
+            if self.__state_db is None:
+                self.__state_db = StateDB()
+            self.__sparse_encoder = SparseEncoder(self.__state_db)
+
+    @staticmethod
+    def __hnsw_config() -> HnswConfigDiff:
+        return HnswConfigDiff(
+            m=config.QDRANT_HNSW_M,
+            ef_construct=config.QDRANT_HNSW_EF_CONSTRUCT,
+            on_disk=config.QDRANT_HNSW_ON_DISK,
+        )
+
+    @staticmethod
+    def __optimizers_config(indexing_threshold: Optional[int] = None) -> OptimizersConfigDiff:
+        if indexing_threshold is None:
+            indexing_threshold = config.QDRANT_INDEXING_THRESHOLD
+        return OptimizersConfigDiff(
+            indexing_threshold=indexing_threshold,
+            default_segment_number=config.QDRANT_DEFAULT_SEGMENT_NUMBER,
+        )
+
+    @staticmethod
+    def __quantization_config() -> Union[None, ScalarQuantization, BinaryQuantization]:
+        if config.QDRANT_QUANTIZATION == "scalar":
+            return ScalarQuantization(
+                scalar=ScalarQuantizationConfig(
+                    type=ScalarType.INT8,
+                    quantile=config.QDRANT_QUANTIZATION_QUANTILE,
+                    always_ram=config.QDRANT_QUANTIZATION_ALWAYS_RAM,
+                )
+            )
+        elif config.QDRANT_QUANTIZATION == "binary":
+            return BinaryQuantization(
+                binary=BinaryQuantizationConfig(always_ram=config.QDRANT_QUANTIZATION_ALWAYS_RAM)
+            )
+        elif config.QDRANT_QUANTIZATION == "none":
+            return None
+        else:
+            raise ValueError(f"Unknown quantization '{config.QDRANT_QUANTIZATION}'")
+
+    def __update_collection(self):
+        """
+        Applies the QDRANT_* settings to an existing collection, when they differ from its
+        configuration
+
+        """
+        info = self.__client.get_collection(collection_name=config.COLLECTION_NAME)
+        current = info.config
+        changes = {}
+
+        hnsw = self.__hnsw_config()
+        if (
+            current.hnsw_config.m != hnsw.m
+            or current.hnsw_config.ef_construct != hnsw.ef_construct
+            or bool(current.hnsw_config.on_disk) != hnsw.on_disk
+        ):
+            changes["hnsw_config"] = hnsw
+
+        optimizers = self.__optimizers_config()
+        if (
+            current.optimizer_config.indexing_threshold != optimizers.indexing_threshold
+            or current.optimizer_config.default_segment_number != optimizers.default_segment_number
+        ):
+            changes["optimizers_config"] = optimizers
+
+        quantization = self.__quantization_config()
+        if quantization != current.quantization_config:
+            changes["quantization_config"] = (
+                Disabled.DISABLED if quantization is None else quantization
+            )
+
+        vectors = current.params.vectors
+        if isinstance(vectors, dict):
+            vectors = vectors.get(self.__dense_name)
+        if isinstance(vectors, VectorParams) and bool(vectors.on_disk) != (
+            config.QDRANT_ON_DISK_VECTORS
+        ):
+            changes["vectors_config"] = {
+                self.__dense_name: VectorParamsDiff(on_disk=config.QDRANT_ON_DISK_VECTORS)
+            }
+
+        if changes:
+            logger.info(
+                f"Updating Qdrant collection '{config.COLLECTION_NAME}': {', '.join(changes)}"
+            )
+            self.__client.update_collection(collection_name=config.COLLECTION_NAME, **changes)
+
+    @contextmanager
+    def bulk_load(self):
+        """Context manager that turns off the HNSW indexing of the collection while many points
+        are written, and turns it back on at the end, so that the graph is built once
+
+        """
+        logger.info("[QDRANT] Bulk load: HNSW indexing disabled")
+        self.__client.update_collection(
+            collection_name=config.COLLECTION_NAME,
+            optimizers_config=self.__optimizers_config(indexing_threshold=0),
+        )
+        try:
+            yield self
+        finally:
+            self.flush()
+            self.__client.update_collection(
+                collection_name=config.COLLECTION_NAME,
+                optimizers_config=self.__optimizers_config(),
+            )
+            logger.info("[QDRANT] Bulk load done: HNSW indexing enabled")
+
+    def __create_payload_indexes(self):
+        """
+        Indexes the payload fields used in filters, so that filtering does not scan the
+        collection
+
+        """
+        info = self.__client.get_collection(collection_name=config.COLLECTION_NAME)
+        for field_name, field_schema in (
+            ("source", PayloadSchemaType.KEYWORD),
+            ("page", PayloadSchemaType.INTEGER),
+        ):
+            if field_name not in info.payload_schema:
+                logger.info(f"Creating payload index on '{field_name}'")
+                self.__client.create_payload_index(
+                    collection_name=config.COLLECTION_NAME,
+                    field_name=field_name,
+                    field_schema=field_schema,
+                )
 
     def delete(self, ids: List[str]):
         """Deletes selected points from collection
@@ -137,42 +461,180 @@ class QdrantIndexer:
 
         """
         if ids:
+            # Points still buffered must not be written after their deletion
+            self.flush()
             pil = PointIdsList(points=ids)
             self.__client.delete(collection_name=config.COLLECTION_NAME, points_selector=pil)
+            if self.__state_db is not None:
+                self.__state_db.delete_chunk_lengths(ids)
+            self.__notify(set(), set(ids), False)
+
+    def delete_by_source(self, filepath: Path):
+        """Deletes all the points of a file, in one request whatever the number of points
+
+        Args:
+            filepath: Path to the file, as recorded in the payload of the points
+
+        """
+        filter_ = Filter(must=[FieldCondition(key="source", match=MatchValue(value=str(filepath)))])
+        # Points still buffered must not be written after their deletion
+        self.flush()
+        self.__client.delete(
+            collection_name=config.COLLECTION_NAME,
+            points_selector=FilterSelector(filter=filter_),
+        )
+        if self.__state_db is not None:
+            self.__state_db.delete_source_chunk_lengths(filepath)
+        self.__notify({str(filepath)}, set(), False)
+
+    def rename_sources(self, renames: Iterable[Tuple[Path, Path]], batch_size: int = 256):
+        """Moves the points of renamed files to their new source, without computing their vectors
+        again. The IDs of the points are derived from the path of their file (see
+        `QdrantIndexer.point_id`), so the points are copied under the IDs of the new path, with
+        their vectors, then the old points are deleted. Otherwise, a new file created at the old
+        path would overwrite the points of the renamed one.
+        The points are moved by batches of batch_size points per request
+
+        Args:
+            renames: Iterable of (old path, new path) tuples
+            batch_size: Maximum number of points moved by a request
+
+        """
+        # Points still buffered must be written with their old source before being moved
+        self.flush()
+
+        renames = list(renames)
+        old_ids = set()
+        for srcpath, destpath in renames:
+            filter_ = Filter(
+                must=[FieldCondition(key="source", match=MatchValue(value=str(srcpath)))]
+            )
+            while True:
+                # The points found are deleted, so the next request gets the following ones
+                records, _ = self.__client.scroll(
+                    collection_name=config.COLLECTION_NAME,
+                    scroll_filter=filter_,
+                    limit=batch_size,
+                    with_payload=True,
+                    with_vectors=True,
+                )
+                if not records:
+                    break
+                points = [
+                    PointStruct(
+                        id=self.point_id(
+                            destpath, record.payload["page"], record.payload["chunk_index"]
+                        ),
+                        vector=record.vector,
+                        payload={**record.payload, "source": str(destpath)},
+                    )
+                    for record in records
+                ]
+                self.__client.upsert(collection_name=config.COLLECTION_NAME, points=points)
+                ids = [record.id for record in records]
+                self.__client.delete(
+                    collection_name=config.COLLECTION_NAME,
+                    points_selector=PointIdsList(points=ids),
+                )
+                old_ids.update(str(point_id) for point_id in ids)
+                if self.__state_db is not None:
+                    self.__state_db.rename_chunk_lengths(
+                        (record.id, point.id, destpath) for record, point in zip(records, points)
+                    )
+
+        # The points now match the filters on their new source
+        sources = set()
+        for srcpath, destpath in renames:
+            sources.update((str(srcpath), str(destpath)))
+        self.__notify(sources, old_ids, True)
+
+    @staticmethod
+    def point_id(filepath: Path, k_page: int, idx: int) -> str:
+        """
+        Computes the ID of the point of a chunk, from the MD5 of path + page + chunk index
+
+        Args:
+            filepath: Path to the file the chunk comes from
+            k_page: Page of the chunk
+            idx: Index of the chunk in the page
+
+        Returns:
+            The point ID, as a UUID string
+
+        """
+        file_hash = hashlib.md5(f"{filepath}::{k_page}::{idx}".encode("utf-8")).hexdigest()
+        return str(uuid.UUID(int=int(file_hash, 16)))
 
     def record_embeddings(
         self,
         k_page: int,
         chunks: List[ChunkType],
-        embeddings: List[EmbeddingType],
+        embeddings: EmbeddingBatchType,
         file_metadata: dict,
+        chunk_indices: Optional[List[int]] = None,
+        point_ids: Optional[List[str]] = None,
     ):
         """
-        Update or insert a new chunk into the collection.
+        Update or insert a new chunk into the collection. In a hybrid collection, the sparse
+        vectors of the chunks are computed here.
+        The points are sent in the background: call `QdrantIndexer.flush` to wait for them.
 
         Args:
+            k_page: Page of the chunks
             chunks: List of chunks to record
-            embeddings: The corresponding list of vectors to record
+            embeddings: The corresponding vectors to record, one per row
             file_metadata: Original file's information
+            chunk_indices: Index of each chunk in the page. Defaults to 0, 1, ...
+            point_ids: ID of the point of each chunk. Defaults to `QdrantIndexer.point_id`
 
         """
         filepath = file_metadata["abspath"]
+        if chunk_indices is None:
+            chunk_indices = list(range(len(chunks)))
+        if point_ids is None:
+            point_ids = [self.point_id(filepath, k_page, idx) for idx in chunk_indices]
 
-        points: list[PointStruct] = []
-        # Use MD5 of path + chunk index as unique point ID
-        for idx, (chunk, emb) in enumerate(zip(chunks, embeddings)):
-            file_hash = hashlib.md5(f"{filepath}::{k_page}::{idx}".encode("utf-8")).hexdigest()
-            pid = str(uuid.UUID(int=int(file_hash, 16)))
-            payload = {
+        payloads = [
+            {
                 "source": str(filepath),
                 "chunk_index": idx,
                 "text": chunk,
                 "page": k_page,
                 "ocr_used": file_metadata.get("ocr_used", False),
+                **{key: file_metadata[key] for key in PAGE_PAYLOAD_KEYS if key in file_metadata},
             }
-            points.append(PointStruct(id=pid, vector=emb, payload=payload))
+            for idx, chunk in zip(chunk_indices, chunks)
+        ]
+
+        sparse_vectors = None
+        if self.__sparse_encoder is not None and self.__sparse_name is not None:
+            sparse_vectors = self.__sparse_encoder.encode_documents(chunks, point_ids, filepath)
+
+        # Upsert into Qdrant, in the background
+        if len(payloads) > 0:
+            self.__writer.add(point_ids, embeddings, payloads, sparse_vectors)
 
-        # Upsert into Qdrant
-        if len(points) > 0:
-            self.__client.upsert(collection_name=config.COLLECTION_NAME, points=points)
-            time.sleep(0.1)
+    def flush(self, filepath: Optional[Path] = None) -> bool:
+        """
+        Waits until the points given to record_embeddings have been written to Qdrant, and are
+        visible to the next requests
+
+        Args:
+            filepath: If given, the file whose failures are reported, then forgotten. The
+                failures of the other files are kept until their own flush
+
+        Returns:
+            False if some points (of filepath, if given) could not be written
+
+        """
+        return self.__writer.flush(None if filepath is None else str(filepath))
+
+    def nb_requests_in_flight(self) -> int:
+        """
+        Number of upsert requests being sent to Qdrant
+
+        Returns:
+            The number of batches of points not yet acknowledged by Qdrant
+
+        """
+        return self.__writer.nb_in_flight()
@@ -0,0 +1,265 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Set, Tuple
+
+import numpy as np
+from qdrant_client import QdrantClient
+from qdrant_client.models import Filter, FilterSelector, HasIdCondition, SparseVector
+
+from . import logger
+from .config import config
+from .metrics import ERRORS, UPSERT_SECONDS
+from .models import EmbeddingBatchType, EmbeddingType
+
+
+# ID, dense vector, payload and sparse vector of a point
+_Point = Tuple[str, EmbeddingType, dict, Optional[SparseVector]]
+
+
+class QdrantWriter:
+    """
+    Sends points to Qdrant from background threads.
+
+    Points added by the indexer, whatever the page or file they come from, are gathered in
+    batches of at most QDRANT_BATCH_POINTS points or QDRANT_BATCH_BYTES bytes. The vectors stay
+    float32 arrays until the client serializes them. In a collection with named vectors, the
+    dense vector of each point is written under vector_name, and its sparse vector, if any,
+    under sparse_vector_name. Each batch is upserted with wait=False
+    by a pool of QDRANT_MAX_IN_FLIGHT threads: when all of them are
+    busy, `add` blocks until a request completes. Failed requests are retried
+    QDRANT_MAX_RETRIES times with an exponential backoff.
+
+    A batch acknowledged by Qdrant may not be applied yet, and its points not visible to the
+    searches. `QdrantWriter.flush` sends a request with wait=True once the batches have been
+    acknowledged: Qdrant applies the updates of a collection in order, so the points of these
+    batches are then visible.
+
+    Args:
+        client: The Qdrant client
+        collection_name: Name of the collection the points are written to
+        on_written: Function called by `QdrantWriter.flush` with the IDs and the payloads of
+            the points it has waited for, once they are visible
+        vector_name: Name of the dense vector. "" for a collection with a single unnamed vector
+        sparse_vector_name: Name of the sparse vector
+
+    """
+
+    def __init__(
+        self,
+        client: QdrantClient,
+        collection_name: str = config.COLLECTION_NAME,
+        on_written: Optional[Callable[[List[str], List[dict]], None]] = None,
+        vector_name: str = "",
+        sparse_vector_name: Optional[str] = None,
+    ):
+        self.__client = client
+        self.collection_name = collection_name
+        self.on_written = on_written
+        self.vector_name = vector_name
+        self.sparse_vector_name = sparse_vector_name
+
+        self.__lock = threading.Condition()
+        self.__buffer: List[_Point] = []
+        self.__buffer_bytes = 0
+        self.__in_flight: Set[int] = set()
+        self.__next_batch = 0
+        self.__failed_sources: Set[str] = set()
+        # IDs and payloads of the points acknowledged by Qdrant, and maybe not applied yet
+        self.__unapplied: List[Tuple[List[str], List[dict]]] = []
+        # Held while waiting for the points to be applied
+        self.__apply_lock = threading.Lock()
+
+        self.__slots = threading.BoundedSemaphore(config.QDRANT_MAX_IN_FLIGHT)
+        self.__executor = ThreadPoolExecutor(
+            max_workers=config.QDRANT_MAX_IN_FLIGHT, thread_name_prefix="qdrant-writer"
+        )
+
+    @staticmethod
+    def __point_size(point: _Point) -> int:
+        # Rough size of the JSON request: a float takes about 10 characters
+        _, vector, payload, sparse = point
+        size = len(payload.get("text", "")) + 10 * len(vector) + 200
+        if sparse is not None:
+            size += 20 * len(sparse.indices)
+        return size
+
+    def add(
+        self,
+        ids: List[str],
+        vectors: EmbeddingBatchType,
+        payloads: List[dict],
+        sparse_vectors: Optional[List[SparseVector]] = None,
+    ):
+        """
+        Adds points to the current batch. The batch is sent as soon as it is full
+
+        Args:
+            ids: IDs of the points to upsert
+            vectors: Vectors of the points, one per row
+            payloads: Payloads of the points
+            sparse_vectors: Sparse vectors of the points, written if sparse_vector_name is set
+
+        """
+        if sparse_vectors is None:
+            sparse_vectors = [None] * len(ids)
+        for point in zip(ids, vectors, payloads, sparse_vectors):
+            batch_id, batch = None, None
+            with self.__lock:
+                self.__buffer.append(point)
+                self.__buffer_bytes += self.__point_size(point)
+                if (
+                    len(self.__buffer) >= config.QDRANT_BATCH_POINTS
+                    or self.__buffer_bytes >= config.QDRANT_BATCH_BYTES
+                ):
+                    batch_id, batch = self.__take_buffer()
+
+            if batch is not None:
+                self.__send(batch_id, batch)
+
+    def __take_buffer(self) -> Tuple[int, List[_Point]]:
+        batch_id = self.__next_batch
+        self.__next_batch += 1
+        self.__in_flight.add(batch_id)
+        batch = self.__buffer
+        self.__buffer = []
+        self.__buffer_bytes = 0
+        return batch_id, batch
+
+    def __send(self, batch_id: int, batch: List[_Point]):
+        # Blocks while QDRANT_MAX_IN_FLIGHT requests are running
+        self.__slots.acquire()
+        self.__executor.submit(self.__upsert, batch_id, batch)
+
+    def __upsert(self, batch_id: int, batch: List[_Point]):
+        ids = [point_id for point_id, _, _, _ in batch]
+        payloads = [payload for _, _, payload, _ in batch]
+        if self.vector_name:
+            vectors = []
+            for _, vector, _, sparse in batch:
+                named = {self.vector_name: np.asarray(vector, dtype=np.float32).tolist()}
+                if self.sparse_vector_name and sparse is not None:
+                    named[self.sparse_vector_name] = sparse
+                vectors.append(named)
+        else:
+            vectors = np.stack([vector for _, vector, _, _ in batch]).astype(np.float32, copy=False)
+        written = False
+        try:
+            for attempt in range(config.QDRANT_MAX_RETRIES + 1):
+                try:
+                    # The retries are handled here, not by the client
+                    t0 = time.perf_counter()
+                    self.__client.upload_collection(
+                        collection_name=self.collection_name,
+                        vectors=vectors,
+                        payload=payloads,
+                        ids=ids,
+                        batch_size=len(ids),
+                        max_retries=1,
+                        wait=False,
+                    )
+                    UPSERT_SECONDS.observe(time.perf_counter() - t0)
+                    written = True
+                    break
+                except Exception as e:
+                    if attempt == config.QDRANT_MAX_RETRIES:
+                        logger.error(f"[QDRANT] Upsert of {len(batch)} points failed: {e}")
+                        ERRORS.inc(stage="qdrant")
+                        with self.__lock:
+                            self.__failed_sources.update(
+                                payload.get("source", "") for payload in payloads
+                            )
+                    else:
+                        delay = config.QDRANT_RETRY_BACKOFF * 2**attempt
+                        logger.warning(
+                            f"[QDRANT] Upsert of {len(batch)} points failed: {e}. "
+                            f"Retrying in {delay:.1f} s"
+                        )
+                        time.sleep(delay)
+
+        finally:
+            self.__slots.release()
+            with self.__lock:
+                if written:
+                    self.__unapplied.append((ids, payloads))
+                self.__in_flight.discard(batch_id)
+                self.__lock.notify_all()
+
+    def nb_in_flight(self) -> int:
+        """
+        Number of batches being sent
+
+        Returns:
+            The number of batches that have been cut and not yet acknowledged by Qdrant
+
+        """
+        with self.__lock:
+            return len(self.__in_flight)
+
+    def flush(self, source: Optional[str] = None) -> bool:
+        """
+        Sends the current batch, and waits until it and all the batches cut before it have been
+        applied by Qdrant, so that their points are visible to the next requests. Batches cut by
+        other threads in the meantime are not waited for
+
+        Args:
+            source: If given, the source whose failures are reported. Its failures are then
+                forgotten. Without a source, the failures are kept for the flush of each source
+
+        Returns:
+            False if points of source could not be written since the previous flush for this
+            source (or if points of any source could not be written and have not been reported
+            yet, when source is None)
+
+        """
+        with self.__lock:
+            if self.__buffer:
+                batch_id, batch = self.__take_buffer()
+            else:
+                batch_id, batch = None, None
+            last_batch = self.__next_batch
+        if batch is not None:
+            self.__send(batch_id, batch)
+
+        with self.__lock:
+            self.__lock.wait_for(lambda: all(k >= last_batch for k in self.__in_flight))
+        self.__wait_applied()
+
+        with self.__lock:
+            if source is None:
+                ok = len(self.__failed_sources) == 0
+            else:
+                ok = source not in self.__failed_sources
+                self.__failed_sources.discard(source)
+
+        return ok
+
+    def __wait_applied(self):
+        # A concurrent flush may have taken the points acknowledged for this one: the lock is
+        # held until they are applied
+        with self.__apply_lock:
+            with self.__lock:
+                unapplied, self.__unapplied = self.__unapplied, []
+            if not unapplied:
+                return
+
+            try:
+                # Deletes no point, and returns once the previous updates have been applied
+                self.__client.delete(
+                    collection_name=self.collection_name,
+                    points_selector=FilterSelector(filter=Filter(must=[HasIdCondition(has_id=[])])),
+                    wait=True,
+                )
+            except Exception as e:
+                logger.error(f"[QDRANT] Waiting for the upserted points failed: {e}")
+                ERRORS.inc(stage="qdrant")
+                with self.__lock:
+                    self.__failed_sources.update(
+                        payload.get("source", "")
+                        for _, payloads in unapplied
+                        for payload in payloads
+                    )
+
+            if self.on_written is not None:
+                for ids, payloads in unapplied:
+                    self.on_written(ids, payloads)
@@ -0,0 +1,170 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, Optional
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+from . import logger
+from .config import config
+from .metrics import QUERY_BATCH_SIZE, SEARCH_CACHE
+from .models import EmbeddingType
+
+
+class QueryEncoder:
+    """
+    Encodes the search queries with the embedding model of the indexer.
+
+    Queries submitted concurrently are encoded together: once a query is waiting, the encoding
+    thread waits at most max_wait seconds for other ones, up to max_batch queries, then encodes
+    them in one forward pass. Identical queries waiting at the same time are encoded once.
+    The embeddings of the last cache_size queries are kept in an LRU cache.
+
+    Args:
+        model: The embedding model
+        max_batch: Maximum number of queries encoded in one pass
+        max_wait: Time to wait for other queries once a query is waiting, in seconds
+        cache_size: Number of query embeddings kept in cache. 0 to disable the cache
+
+    """
+
+    def __init__(
+        self,
+        model: SentenceTransformer,
+        max_batch: int = config.SEARCH_BATCH_SIZE,
+        max_wait: float = config.SEARCH_BATCH_WAIT_MS / 1000,
+        cache_size: int = config.SEARCH_QUERY_CACHE_SIZE,
+    ):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.cache_size = cache_size
+
+        self.__lock = threading.Condition()
+        self.__pending: Dict[str, Future] = {}
+        self.__cache: OrderedDict[str, EmbeddingType] = OrderedDict()
+        self.__stopped = False
+        self.__thread: Optional[threading.Thread] = None
+
+        self.hits = 0
+        self.misses = 0
+        self.nb_batches = 0
+        self.nb_encoded = 0
+
+    def start(self):
+        """Starts the encoding thread"""
+        self.__thread = threading.Thread(target=self.__run, name="query-encoder", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """Stops the encoding thread. The queries still waiting fail with a RuntimeError"""
+        with self.__lock:
+            self.__stopped = True
+            self.__lock.notify_all()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def encode(self, query: str, timeout: Optional[float] = None) -> EmbeddingType:
+        """
+        Get the embedding of a query, from the cache or from the next batch
+
+        Args:
+            query: The text of the query
+            timeout: Maximum time to wait for the embedding, in seconds. None to wait forever
+
+        Returns:
+            The embedding of the query. The array is shared with the cache, and is read-only
+
+        """
+        with self.__lock:
+            if self.__stopped:
+                raise RuntimeError("The query encoder is stopped")
+            embedding = self.__cache.get(query)
+            if embedding is not None:
+                self.__cache.move_to_end(query)
+                self.hits += 1
+                SEARCH_CACHE.inc(cache="query", result="hit")
+                return embedding
+
+            self.misses += 1
+            SEARCH_CACHE.inc(cache="query", result="miss")
+            future = self.__pending.get(query)
+            if future is None:
+                future = Future()
+                self.__pending[query] = future
+                self.__lock.notify_all()
+
+        return future.result(timeout)
+
+    def __take_batch(self) -> Optional[Dict[str, Future]]:
+        with self.__lock:
+            self.__lock.wait_for(lambda: self.__pending or self.__stopped)
+            if not self.__stopped:
+                # Wait a little for concurrent queries, to encode them in the same pass
+                deadline = time.monotonic() + self.max_wait
+                while len(self.__pending) < self.max_batch and not self.__stopped:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.__lock.wait(remaining)
+
+            if self.__stopped:
+                for future in self.__pending.values():
+                    future.set_exception(RuntimeError("The query encoder is stopped"))
+                self.__pending.clear()
+                return None
+
+            queries = list(self.__pending)[: self.max_batch]
+            return {query: self.__pending.pop(query) for query in queries}
+
+    def __run(self):
+        while True:
+            batch = self.__take_batch()
+            if batch is None:
+                return
+
+            queries = list(batch)
+            try:
+                embeddings = self.model.encode(
+                    queries, device="cpu", show_progress_bar=False, convert_to_numpy=True
+                ).astype(np.float32, copy=False)
+            except Exception as e:
+                logger.error(f"[SEARCH] Encoding of {len(queries)} queries failed: {e}")
+                for future in batch.values():
+                    future.set_exception(e)
+                continue
+            QUERY_BATCH_SIZE.set(len(queries))
+
+            with self.__lock:
+                self.nb_batches += 1
+                self.nb_encoded += len(queries)
+                for query, embedding in zip(queries, embeddings):
+                    embedding.flags.writeable = False
+                    if self.cache_size > 0:
+                        self.__cache[query] = embedding
+                while len(self.__cache) > self.cache_size:
+                    self.__cache.popitem(last=False)
+
+            for future, embedding in zip(batch.values(), embeddings):
+                future.set_result(embedding)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Activity of the encoder since it was created
+
+        Returns:
+            A dictionary with the number of cache hits and misses, the number of batches,
+            the number of encoded queries and the mean size of the batches
+
+        """
+        with self.__lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "batches": self.nb_batches,
+                "encoded": self.nb_encoded,
+                "mean_batch_size": self.nb_encoded / self.nb_batches if self.nb_batches else 0.0,
+            }
@@ -0,0 +1,298 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Set, Tuple
+
+from qdrant_client.models import FieldCondition, Filter, MatchAny, MatchValue, ScoredPoint
+
+from . import logger
+from .config import config
+from .metrics import ERRORS, SEARCH_CACHE, SEARCH_SECONDS
+from .QdrantIndexer import QdrantIndexer
+from .QueryEncoder import QueryEncoder
+
+
+def filter_sources(query_filter: Optional[Filter]) -> Optional[Set[str]]:
+    """
+    Get the files a filter restricts the search to, from its "must" conditions on the source
+
+    Args:
+        query_filter: The filter of a search
+
+    Returns:
+        The paths of the files whose points can match the filter, or None if points of any file
+        can match it
+
+    """
+    if query_filter is None or not query_filter.must:
+        return None
+
+    must = query_filter.must if isinstance(query_filter.must, list) else [query_filter.must]
+    sources = None
+    for condition in must:
+        if not isinstance(condition, FieldCondition) or condition.key != "source":
+            continue
+        if isinstance(condition.match, MatchValue):
+            allowed = {str(condition.match.value)}
+        elif isinstance(condition.match, MatchAny):
+            allowed = {str(value) for value in condition.match.any}
+        else:
+            continue
+        sources = allowed if sources is None else sources & allowed
+    return sources
+
+
+class _CachedResult:
+    """
+    Entry of the result cache of `SearchService`
+
+    Args:
+        hits: The result of the search
+        source_filter: The files the filter of the search restricts it to, None for any file
+        expires: Time (from time.monotonic) after which the entry is stale
+
+    """
+
+    def __init__(self, hits: List[ScoredPoint], source_filter: Optional[Set[str]], expires: float):
+        self.hits = hits
+        self.source_filter = source_filter
+        self.expires = expires
+        self.sources = {hit.payload.get("source") for hit in hits if hit.payload}
+        self.point_ids = {str(hit.id) for hit in hits}
+
+
+class SearchService:
+    """
+    Answers search queries with the embedding model and the Qdrant collection of the indexer.
+
+    The queries are encoded by a `QueryEncoder`, that batches concurrent queries and caches
+    their embeddings. The results are kept in an LRU cache of cache_size entries, keyed by the
+    query, the limit and the filter. An entry is dropped after ttl seconds, and as soon as the
+    indexer reports a change that may alter it: points of one of its results deleted, rewritten
+    or renamed, or points added to a file its filter can match.
+
+    Args:
+        qdrant: The Qdrant client of the indexer
+        encoder: The query encoder
+        cache_size: Number of search results kept in cache. 0 to disable the cache
+        ttl: Lifetime of the cached results, in seconds
+
+    """
+
+    def __init__(
+        self,
+        qdrant: QdrantIndexer,
+        encoder: QueryEncoder,
+        cache_size: int = config.SEARCH_RESULT_CACHE_SIZE,
+        ttl: float = config.SEARCH_RESULT_TTL,
+    ):
+        self.qdrant = qdrant
+        self.encoder = encoder
+        self.cache_size = cache_size
+        self.ttl = ttl
+
+        self.__lock = threading.Lock()
+        self.__cache: OrderedDict[Tuple[str, int, str], _CachedResult] = OrderedDict()
+        # Incremented by each invalidation, so that a search that overlaps an invalidation
+        # does not cache a result that may be stale
+        self.__generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.nb_invalidated = 0
+
+        qdrant.add_change_listener(self.invalidate)
+
+    def start(self):
+        """Starts the encoding thread"""
+        self.encoder.start()
+
+    def stop(self):
+        """Stops the encoding thread"""
+        self.encoder.stop()
+
+    def search(
+        self,
+        query: str,
+        limit: int = config.SEARCH_DEFAULT_LIMIT,
+        query_filter: Optional[Filter] = None,
+    ) -> List[ScoredPoint]:
+        """
+        Search the chunks closest to a query
+
+        Args:
+            query: The text of the query
+            limit: Maximum number of results
+            query_filter: Conditions on the payload of the points, like their source
+
+        Returns:
+            The points found, with their payload and their score
+
+        """
+        key = (query, limit, query_filter.model_dump_json() if query_filter is not None else "")
+        with SEARCH_SECONDS.time():
+            with self.__lock:
+                entry = self.__cache.get(key)
+                if entry is not None and entry.expires > time.monotonic():
+                    self.__cache.move_to_end(key)
+                    self.hits += 1
+                    SEARCH_CACHE.inc(cache="result", result="hit")
+                    return entry.hits
+                self.misses += 1
+                SEARCH_CACHE.inc(cache="result", result="miss")
+                generation = self.__generation
+
+            vector = self.encoder.encode(query)
+            hits = self.qdrant.search(
+                vector, limit=limit, query_filter=query_filter, query_text=query
+            )
+
+            if self.cache_size > 0:
+                entry = _CachedResult(
+                    hits, filter_sources(query_filter), time.monotonic() + self.ttl
+                )
+                with self.__lock:
+                    if generation == self.__generation:
+                        self.__cache[key] = entry
+                        self.__cache.move_to_end(key)
+                        while len(self.__cache) > self.cache_size:
+                            self.__cache.popitem(last=False)
+
+        return hits
+
+    def invalidate(self, sources: Optional[Set[str]], point_ids: Set[str], new_points: bool):
+        """
+        Drops the cached results that a change of the collection may alter.
+        Registered as a change listener of the `QdrantIndexer`
+
+        Args:
+            sources: Paths of the files whose points changed. None to drop all the results
+            point_ids: IDs of the changed points
+            new_points: True if points may have been added to the files
+
+        """
+        with self.__lock:
+            self.__generation += 1
+            if sources is None:
+                self.nb_invalidated += len(self.__cache)
+                self.__cache.clear()
+                return
+
+            stale = []
+            for key, entry in self.__cache.items():
+                if not entry.sources.isdisjoint(sources):
+                    stale.append(key)
+                elif not entry.point_ids.isdisjoint(point_ids):
+                    stale.append(key)
+                elif new_points and (
+                    entry.source_filter is None or not entry.source_filter.isdisjoint(sources)
+                ):
+                    stale.append(key)
+            for key in stale:
+                del self.__cache[key]
+            self.nb_invalidated += len(stale)
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        Activity of the service since it was created
+
+        Returns:
+            A dictionary with the statistics of the result cache (hits, misses, invalidated
+            entries and size) and of the query encoder
+
+        """
+        with self.__lock:
+            results = {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidated": self.nb_invalidated,
+                "size": len(self.__cache),
+            }
+        return {"results": results, "encoder": self.encoder.stats()}
+
+
+class _SearchServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 connections makes concurrent clients wait for a SYN retry
+    request_queue_size = 128
+
+
+class _SearchHandler(BaseHTTPRequestHandler):
+    # The search service is set on the server by start_search_server
+    def __send_json(self, status: int, data: dict):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/stats":
+            self.send_error(404)
+            return
+        self.__send_json(200, self.server.service.stats())
+
+    def do_POST(self):
+        if self.path.split("?")[0] != "/search":
+            self.send_error(404)
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            query = request["query"]
+            if not isinstance(query, str):
+                raise ValueError("'query' must be a string")
+            limit = min(
+                int(request.get("limit", config.SEARCH_DEFAULT_LIMIT)), config.SEARCH_MAX_LIMIT
+            )
+            query_filter = None
+            if request.get("filter") is not None:
+                query_filter = Filter.model_validate(request["filter"])
+        except Exception as e:
+            self.__send_json(400, {"error": f"Invalid request: {e}"})
+            return
+
+        try:
+            hits = self.server.service.search(query, limit=limit, query_filter=query_filter)
+        except Exception as e:
+            logger.error(f"[SEARCH] Search of '{query}' failed: {e}")
+            ERRORS.inc(stage="search")
+            self.__send_json(500, {"error": str(e)})
+            return
+
+        results = [{"id": str(hit.id), "score": hit.score, "payload": hit.payload} for hit in hits]
+        self.__send_json(200, {"results": results})
+
+    def log_message(self, format, *args):
+        # Queries are too frequent to be logged
+        pass
+
+
+def start_search_server(
+    service: SearchService, port: int = config.SEARCH_PORT, addr: str = config.SEARCH_ADDR
+) -> ThreadingHTTPServer:
+    """
+    Serves the search service on http://addr:port, from a daemon thread.
+    POST /search takes a JSON object with the query, the maximum number of results (limit)
+    and an optional Qdrant filter on the payload (filter), and returns the results.
+    GET /stats returns the statistics of the caches
+
+    Args:
+        service: The search service
+        port: Port of the HTTP server. 0 picks a free port
+        addr: Address the server listens on
+
+    Returns:
+        The HTTP server. Call its shutdown method to stop it
+
+    """
+    server = _SearchServer((addr, port), _SearchHandler)
+    server.service = service
+    thread = threading.Thread(target=server.serve_forever, name="search", daemon=True)
+    thread.start()
+    logger.info(f"[SEARCH] Serving search on http://{addr}:{server.server_address[1]}/search")
+    return server
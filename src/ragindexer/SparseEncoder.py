@@ -0,0 +1,138 @@
+import re
+import threading
+import unicodedata
+from collections import Counter
+from pathlib import Path
+from typing import List
+
+from qdrant_client.models import SparseVector
+
+from .config import config
+from .index_database import StateDB
+from .models import ChunkType
+
+
+# Words, and codes like "INV-2024/0042" or "3.14" kept as one token
+_TOKEN = re.compile(r"\w+(?:[-./]\w+)*")
+_WORD = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Splits a text into lowercase tokens, without accents. A code made of several words joined by
+    "-", "." or "/" gives a token for the whole code, and one for each of its words, so that
+    it can be found both exactly and by its parts. Single letters are dropped
+
+    Args:
+        text: The text to split
+
+    Returns:
+        The tokens, in the order of the text
+
+    """
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    tokens = []
+    for match in _TOKEN.finditer(text):
+        token = match.group()
+        words = _WORD.findall(token)
+        if len(words) > 1:
+            tokens.append(token)
+        tokens.extend(word for word in words if len(word) > 1 or word.isdigit())
+    return tokens
+
+
+class SparseEncoder:
+    """
+    Computes the BM25 sparse lexical vectors of the chunks and of the queries.
+
+    The indices of the vectors are the IDs of the tokens in a vocabulary persisted in the
+    state DB. The value of a token in the vector of a chunk is the term-frequency part of BM25,
+    with the parameters BM25_K1 and BM25_B, and the average length of the chunks of the points
+    in the collection. This average is computed from the number of tokens of each point, kept in
+    the state DB and updated by `QdrantIndexer` when points are deleted or renamed, so it is shared
+    by all the indexers using the state DB. The IDF part is applied by Qdrant at query time (IDF
+    modifier of the sparse vectors), so that it follows the current content of the collection.
+
+    Args:
+        state_db: The state DB, where the vocabulary and the statistics of the chunks are stored
+
+    """
+
+    def __init__(self, state_db: StateDB):
+        self.state_db = state_db
+
+        self.__lock = threading.Lock()
+        self.__vocabulary = state_db.load_vocabulary()
+
+    def vocabulary_size(self) -> int:
+        """
+        Number of tokens in the vocabulary
+
+        Returns:
+            The number of tokens
+
+        """
+        with self.__lock:
+            return len(self.__vocabulary)
+
+    def encode_documents(
+        self, chunks: List[ChunkType], point_ids: List[str], filepath: Path
+    ) -> List[SparseVector]:
+        """
+        Computes the sparse vectors of chunks. The new tokens are added to the vocabulary, and the
+        lengths of the chunks are recorded with the IDs of their points
+
+        Args:
+            chunks: The chunks to encode
+            point_ids: ID of the point of each chunk
+            filepath: Path to the file the chunks come from
+
+        Returns:
+            The sparse vector of each chunk
+
+        """
+        counts = [Counter(tokenize(chunk)) for chunk in chunks]
+        lengths = [sum(count.values()) for count in counts]
+
+        with self.__lock:
+            new_tokens = {token for count in counts for token in count} - self.__vocabulary.keys()
+            if new_tokens:
+                self.__vocabulary.update(self.state_db.add_tokens(sorted(new_tokens)))
+            self.state_db.set_chunk_lengths(
+                (point_id, filepath, length) for point_id, length in zip(point_ids, lengths)
+            )
+            nb_chunks, nb_tokens = self.state_db.get_lexical_stats()
+            avg_length = nb_tokens / nb_chunks if nb_chunks else 1.0
+
+            k1, b = config.BM25_K1, config.BM25_B
+            vectors = []
+            for count, length in zip(counts, lengths):
+                norm = k1 * (1 - b + b * length / max(avg_length, 1.0))
+                terms = sorted((self.__vocabulary[token], tf) for token, tf in count.items())
+                vectors.append(
+                    SparseVector(
+                        indices=[token_id for token_id, _ in terms],
+                        values=[tf * (k1 + 1) / (tf + norm) for _, tf in terms],
+                    )
+                )
+        return vectors
+
+    def encode_query(self, query: str) -> SparseVector:
+        """
+        Computes the sparse vector of a query. Each known token of the query has a weight of 1,
+        the unknown ones are ignored
+
+        Args:
+            query: The text of the query
+
+        Returns:
+            The sparse vector of the query
+
+        """
+        with self.__lock:
+            indices = {
+                self.__vocabulary[token] for token in tokenize(query) if token in self.__vocabulary
+            }
+        indices = sorted(indices)
+        return SparseVector(indices=indices, values=[1.0] * len(indices))
@@ -0,0 +1,227 @@
+import heapq
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from . import logger
+from .config import config
+
+
+class _PendingEvent:
+    """
+    Net effect of the events received for a path that has not been dispatched yet
+
+    Args:
+        deleted: True if the file has been deleted
+        deadline: Time (from time.monotonic) at which the event can be dispatched
+        signature: Size and modification time of the file when last seen
+        moved_from: Old path of the file, if it has been renamed
+
+    """
+
+    def __init__(
+        self,
+        deleted: bool,
+        deadline: float,
+        signature: Optional[Tuple[int, float]],
+        moved_from: Optional[Path] = None,
+    ):
+        self.deleted = deleted
+        self.deadline = deadline
+        self.signature = signature
+        self.moved_from = moved_from
+
+
+class WatcherQueue:
+    """
+    Queue between the filesystem watcher and the indexing pipeline.
+
+    Events are debounced per path: a path is only dispatched once no event has been received
+    for it during WATCHER_DEBOUNCE seconds, and its size and modification time have not changed
+    during that window. All the events received for a path in the meantime are collapsed into
+    their net effect: the file either has to be indexed, or has to be removed from the index.
+    A renamed path also carries the path it had before the first of its renames.
+
+    The events are dispatched, in deadline order, by a single thread that does not hold any lock
+    while the dispatch function runs.
+
+    Args:
+        dispatch: Function called with the path, True if the file has been deleted, and the
+            old path of the file if it has been renamed (None otherwise)
+        window: Debounce window, in seconds
+
+    """
+
+    def __init__(
+        self,
+        dispatch: Callable[[Path, bool, Optional[Path]], None],
+        window: float = config.WATCHER_DEBOUNCE,
+    ):
+        self.dispatch = dispatch
+        self.window = window
+
+        self.__lock = threading.Condition()
+        self.__pending: Dict[Path, _PendingEvent] = {}
+        self.__deadlines: List[Tuple[float, str]] = []
+        self.__stopped = False
+        self.__thread: Optional[threading.Thread] = None
+
+        self.nb_events = 0
+        self.nb_coalesced = 0
+        self.nb_dispatched = 0
+
+    @staticmethod
+    def __signature(path: Path) -> Optional[Tuple[int, float]]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime
+
+    def push(self, path: Path, deleted: bool = False):
+        """
+        Records an event. Does not block
+
+        Args:
+            path: Path of the file
+            deleted: True if the file has been deleted, False if it has been created or modified
+
+        """
+        signature = None if deleted else self.__signature(path)
+        deadline = time.monotonic() + self.window
+        with self.__lock:
+            self.nb_events += 1
+            event = self.__pending.get(path)
+            if event is None:
+                self.__pending[path] = _PendingEvent(deleted, deadline, signature)
+            else:
+                self.nb_coalesced += 1
+                if deleted and event.moved_from is not None:
+                    # Renamed, then deleted: the old path has to be removed from the index
+                    self.__set(event.moved_from, _PendingEvent(True, deadline, None))
+                    event.moved_from = None
+                event.deleted = deleted
+                event.deadline = deadline
+                event.signature = signature
+            heapq.heappush(self.__deadlines, (deadline, str(path)))
+            self.__lock.notify()
+
+    def push_move(self, srcpath: Path, destpath: Path):
+        """
+        Records a renaming of a file or a directory. Does not block
+
+        Args:
+            srcpath: Old path
+            destpath: New path
+
+        """
+        signature = self.__signature(destpath)
+        deadline = time.monotonic() + self.window
+        with self.__lock:
+            self.nb_events += 1
+            moved_from = srcpath
+            src_event = self.__pending.pop(srcpath, None)
+            if src_event is not None:
+                self.nb_coalesced += 1
+                if src_event.moved_from is not None:
+                    moved_from = src_event.moved_from
+            if destpath in self.__pending:
+                self.nb_coalesced += 1
+            self.__set(destpath, _PendingEvent(False, deadline, signature, moved_from))
+
+    def __set(self, path: Path, event: _PendingEvent):
+        # Replaces the pending event of a path. The lock must be held
+        self.__pending[path] = event
+        heapq.heappush(self.__deadlines, (event.deadline, str(path)))
+        self.__lock.notify()
+
+    def __next_ready(self) -> Optional[Tuple[Path, _PendingEvent]]:
+        # Returns the next event which deadline has passed, waiting for it if needed
+        with self.__lock:
+            while not self.__stopped:
+                if not self.__deadlines:
+                    self.__lock.wait()
+                    continue
+
+                deadline, path_str = self.__deadlines[0]
+                path = Path(path_str)
+                event = self.__pending.get(path)
+                if event is None or event.deadline != deadline:
+                    # Superseded by a later event on the same path
+                    heapq.heappop(self.__deadlines)
+                    continue
+
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self.__lock.wait(delay)
+                    continue
+
+                heapq.heappop(self.__deadlines)
+                return path, event
+
+        return None
+
+    def __run(self):
+        while True:
+            ready = self.__next_ready()
+            if ready is None:
+                return
+            path, event = ready
+
+            # The file may still be written to: wait until it is stable
+            if not event.deleted:
+                signature = self.__signature(path)
+                with self.__lock:
+                    if self.__pending.get(path) is not event:
+                        continue
+                    if signature is None:
+                        event.deleted = True
+                    elif signature != event.signature:
+                        event.signature = signature
+                        event.deadline = time.monotonic() + self.window
+                        heapq.heappush(self.__deadlines, (event.deadline, str(path)))
+                        continue
+
+            with self.__lock:
+                if self.__pending.get(path) is not event or event.deadline > time.monotonic():
+                    continue
+                del self.__pending[path]
+                self.nb_dispatched += 1
+
+            try:
+                self.dispatch(path, event.deleted, event.moved_from)
+            except Exception as e:
+                logger.error(f"[WATCHER] Failed to dispatch '{path}': {e}")
+
+    def start(self):
+        """Starts the dispatching thread"""
+        self.__thread = threading.Thread(target=self.__run, name="watcher-queue", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """Stops the dispatching thread. The pending events are dropped"""
+        with self.__lock:
+            self.__stopped = True
+            self.__lock.notify_all()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Activity of the queue since it was created
+
+        Returns:
+            A dictionary with the number of events received, of events collapsed into an
+            event already pending for the same path, of paths dispatched, and of paths pending
+
+        """
+        with self.__lock:
+            return {
+                "events": self.nb_events,
+                "coalesced": self.nb_coalesced,
+                "dispatched": self.nb_dispatched,
+                "pending": len(self.__pending),
+            }
@@ -0,0 +1,463 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from . import logger
+from .config import config
+from .index_database import journal_mode
+from .metrics import WORK_ITEMS
+
+
+def default_worker_id() -> str:
+    """
+    Identifier of this worker, when WORKER_ID is not set
+
+    Returns:
+        The host name and the PID of the process, as host:pid
+
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkItem:
+    """
+    A file claimed from the work queue
+
+    Args:
+        path: Path to the file
+        mtime: Modification time of the file when it was queued. None for a deletion
+        delete: True to remove the file from the index instead of indexing it
+        token: Fencing token of the lease. It changes each time the file is claimed, so that
+            a worker whose lease has expired cannot complete the file anymore
+        attempts: Number of times the file has been claimed, including this one
+
+    """
+
+    def __init__(self, path: Path, mtime: Optional[float], delete: bool, token: int, attempts: int):
+        self.path = path
+        self.mtime = mtime
+        self.delete = delete
+        self.token = token
+        self.attempts = attempts
+
+
+class WorkQueue:
+    """
+    Queue of the files to index, shared by the workers of the distributed mode through a sqlite
+    database. The database can be used by several processes, on one host or on several nodes
+    accessing it through a shared filesystem: it uses a rollback journal, and each claim is done
+    in a transaction that locks the database.
+
+    A file is in one of the states pending, leased, done or failed. A worker claims pending files
+    and gets a lease on them for lease_seconds. While started, a thread of the worker renews its
+    leases every heartbeat_seconds. A leased file whose lease has expired, because its worker
+    crashed or lost access to the database, is claimed again by the next worker. Each claim
+    increments the fencing token of the file, and a file can only be completed or failed with
+    the token of its current lease: there is a single worker allowed to write a file at a time.
+    A worker checks its lease with `WorkQueue.holds` before recording the result of its work,
+    and the functions registered with `WorkQueue.add_lost_listener` are told about the leases
+    lost, so that it stops processing these files.
+
+    A file queued again while it is leased is marked dirty, and becomes pending again when its
+    current lease is completed. A failed file is retried until it has been claimed max_attempts
+    times, then it stays failed until it is queued again.
+
+    Args:
+        db_path: Path to the sqlite database
+        worker_id: Identifier of this worker. Defaults to WORKER_ID, or to host:pid
+        lease_seconds: Duration of the leases, in seconds
+        heartbeat_seconds: Delay between two renewals of the leases, in seconds
+        max_attempts: Number of claims of a file before it is marked as failed
+
+    """
+
+    def __init__(
+        self,
+        db_path: Path = config.STATE_DB_PATH.parent / "work_queue.db",
+        worker_id: Optional[str] = None,
+        lease_seconds: float = config.WORK_LEASE_SECONDS,
+        heartbeat_seconds: float = config.WORK_HEARTBEAT_SECONDS,
+        max_attempts: int = config.WORK_MAX_ATTEMPTS,
+    ):
+        self.worker_id = worker_id or config.WORKER_ID or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.max_attempts = max_attempts
+
+        os.makedirs(db_path.parent, exist_ok=True)
+        self.__lock = threading.Condition(threading.RLock())
+        # Transactions are started explicitly, to take the write lock of the database before
+        # reading the rows to claim
+        self.__conn = sqlite3.connect(
+            db_path, timeout=30.0, isolation_level=None, check_same_thread=False
+        )
+        self.__conn.execute(f"PRAGMA journal_mode={journal_mode()}")
+        self.__conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS work (
+                path TEXT PRIMARY KEY,
+                mtime REAL,
+                deleted INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL,
+                worker TEXT,
+                token INTEGER NOT NULL DEFAULT 0,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                dirty INTEGER NOT NULL DEFAULT 0,
+                error TEXT
+            )
+        """
+        )
+        self.__conn.execute("CREATE INDEX IF NOT EXISTS work_status ON work (status)")
+
+        self.__held: Dict[str, WorkItem] = {}
+        self.__listeners: List[Callable[[WorkItem], None]] = []
+        self.__stopped = False
+        self.__thread: Optional[threading.Thread] = None
+
+        self.nb_claimed = 0
+        self.nb_reclaimed = 0
+        self.nb_completed = 0
+        self.nb_failed = 0
+        self.nb_lost = 0
+
+        logger.info(f"[WORK] Worker '{self.worker_id}' using work queue '{db_path}'")
+
+    @contextmanager
+    def __transaction(self):
+        with self.__lock:
+            self.__conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.__conn.execute("ROLLBACK")
+                raise
+            self.__conn.execute("COMMIT")
+
+    def close(self):
+        """Closes the connection to the database"""
+        with self.__lock:
+            self.__conn.close()
+
+    def add_lost_listener(self, listener: Callable[[WorkItem], None]):
+        """
+        Registers a function called with each file whose lease has been lost by this worker
+
+        Args:
+            listener: The function to call
+
+        """
+        self.__listeners.append(listener)
+
+    def start(self):
+        """Starts the thread renewing the leases"""
+        self.__thread = threading.Thread(target=self.__run, name="work-heartbeat", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """Stops the thread renewing the leases, and releases the files still leased"""
+        with self.__lock:
+            self.__stopped = True
+            self.__lock.notify_all()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        with self.__lock:
+            held = list(self.__held.values())
+        self.release(held)
+
+    def __run(self):
+        with self.__lock:
+            while not self.__stopped:
+                self.__lock.wait(self.heartbeat_seconds)
+                if self.__stopped:
+                    return
+                try:
+                    self.heartbeat()
+                except sqlite3.Error as e:
+                    logger.error(f"[WORK] Renewal of the leases failed: {e}")
+
+    def enqueue(self, files: Iterable[Tuple[Path, Optional[float]]], delete: bool = False) -> int:
+        """
+        Queues files, in one transaction. A file already queued is only queued again if its
+        modification time changed, if the action changed, or if it failed
+
+        Args:
+            files: Iterable of (path, modification time) tuples
+            delete: True to remove the files from the index instead of indexing them
+
+        Returns:
+            The number of files queued
+
+        """
+        rows = [(str(path), mtime, int(delete)) for path, mtime in files]
+        nb_queued = 0
+        with self.__transaction():
+            for row in rows:
+                cursor = self.__conn.execute(
+                    """
+                    INSERT INTO work (path, mtime, deleted, status) VALUES (?, ?, ?, 'pending')
+                    ON CONFLICT(path) DO UPDATE SET
+                        mtime = excluded.mtime,
+                        deleted = excluded.deleted,
+                        dirty = CASE WHEN status = 'leased' THEN 1 ELSE 0 END,
+                        attempts = CASE WHEN status = 'leased' THEN attempts ELSE 0 END,
+                        status = CASE WHEN status = 'leased' THEN 'leased' ELSE 'pending' END
+                    WHERE mtime IS NOT excluded.mtime
+                        OR deleted != excluded.deleted
+                        OR status = 'failed'
+                    """,
+                    row,
+                )
+                nb_queued += cursor.rowcount
+        return nb_queued
+
+    def claim(self, max_items: int = config.WORK_CLAIM_BATCH) -> List[WorkItem]:
+        """
+        Claims pending files, and files whose lease has expired, in one transaction
+
+        Args:
+            max_items: Maximum number of files claimed
+
+        Returns:
+            The claimed files. Their leases are renewed until they are completed, failed or
+            released
+
+        """
+        if max_items <= 0:
+            return []
+
+        items = []
+        now = time.time()
+        with self.__transaction():
+            rows = self.__conn.execute(
+                """
+                SELECT path, mtime, deleted, status, worker, token, attempts FROM work
+                WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?)
+                ORDER BY rowid LIMIT ?
+                """,
+                (now, max_items),
+            ).fetchall()
+            for path, mtime, deleted, status, worker, token, attempts in rows:
+                if status == "leased":
+                    logger.warning(
+                        f"[WORK] Lease of '{path}' by '{worker}' expired, claiming it again"
+                    )
+                    self.nb_reclaimed += 1
+                    WORK_ITEMS.inc(result="reclaimed")
+                    if attempts >= self.max_attempts:
+                        # The file may be the cause of the crashes of its workers
+                        self.__conn.execute(
+                            "UPDATE work SET status = 'failed', worker = NULL, "
+                            "lease_expires = NULL, error = ? WHERE path = ?",
+                            (f"Lease expired {attempts} times", path),
+                        )
+                        logger.error(f"[WORK] Giving up '{path}' after {attempts} attempts")
+                        continue
+
+                self.__conn.execute(
+                    "UPDATE work SET status = 'leased', worker = ?, token = ?, lease_expires = ?, "
+                    "attempts = ?, dirty = 0 WHERE path = ?",
+                    (self.worker_id, token + 1, now + self.lease_seconds, attempts + 1, path),
+                )
+                items.append(WorkItem(Path(path), mtime, bool(deleted), token + 1, attempts + 1))
+
+            for item in items:
+                self.__held[str(item.path)] = item
+            self.nb_claimed += len(items)
+        WORK_ITEMS.inc(len(items), result="claimed")
+        return items
+
+    def heartbeat(self) -> List[WorkItem]:
+        """
+        Renews the leases of the files held by this worker. Called by the thread started by
+        `WorkQueue.start`
+
+        Returns:
+            The files whose lease was lost, because it expired and they have been claimed again
+
+        """
+        lost = []
+        expires = time.time() + self.lease_seconds
+        with self.__transaction():
+            for key, item in list(self.__held.items()):
+                cursor = self.__conn.execute(
+                    "UPDATE work SET lease_expires = ? "
+                    "WHERE path = ? AND token = ? AND status = 'leased'",
+                    (expires, key, item.token),
+                )
+                if cursor.rowcount == 0:
+                    lost.append(self.__held.pop(key))
+        for item in lost:
+            self.__lost(item)
+        return lost
+
+    def __lost(self, item: WorkItem):
+        logger.warning(f"[WORK] Lease of '{item.path}' lost, another worker may be processing it")
+        self.nb_lost += 1
+        WORK_ITEMS.inc(result="lost")
+        for listener in self.__listeners:
+            listener(item)
+
+    def holds(self, item: WorkItem) -> bool:
+        """
+        Tells if this worker still holds the lease of a claimed file
+
+        Args:
+            item: The claimed file
+
+        Returns:
+            True if the file is leased with the token of item, and the lease has not expired
+
+        """
+        with self.__lock:
+            row = self.__conn.execute(
+                "SELECT 1 FROM work WHERE path = ? AND token = ? AND status = 'leased' "
+                "AND lease_expires > ?",
+                (str(item.path), item.token, time.time()),
+            ).fetchone()
+        return row is not None
+
+    def __release_row(self, item: WorkItem) -> Optional[int]:
+        # Forgets a held file and returns its dirty flag. None if the lease was lost.
+        # The transaction must be open
+        self.__held.pop(str(item.path), None)
+        row = self.__conn.execute(
+            "SELECT dirty FROM work WHERE path = ? AND token = ? AND status = 'leased'",
+            (str(item.path), item.token),
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def complete(self, item: WorkItem) -> bool:
+        """
+        Marks a claimed file as done. A deleted file is removed from the queue. A file queued
+        again while it was processed becomes pending
+
+        Args:
+            item: The claimed file
+
+        Returns:
+            False if the lease had been lost, and the file is processed by another worker
+
+        """
+        with self.__transaction():
+            dirty = self.__release_row(item)
+            if dirty:
+                self.__conn.execute(
+                    "UPDATE work SET status = 'pending', worker = NULL, lease_expires = NULL, "
+                    "dirty = 0, attempts = 0, error = NULL WHERE path = ?",
+                    (str(item.path),),
+                )
+            elif dirty is not None and item.delete:
+                self.__conn.execute("DELETE FROM work WHERE path = ?", (str(item.path),))
+            elif dirty is not None:
+                self.__conn.execute(
+                    "UPDATE work SET status = 'done', worker = NULL, lease_expires = NULL, "
+                    "error = NULL WHERE path = ?",
+                    (str(item.path),),
+                )
+            if dirty is not None:
+                self.nb_completed += 1
+
+        if dirty is None:
+            self.__lost(item)
+            return False
+        WORK_ITEMS.inc(result="completed")
+        return True
+
+    def fail(self, item: WorkItem, error: str = "") -> bool:
+        """
+        Gives a claimed file back to the queue after a failure. It is marked as failed once it
+        has been claimed max_attempts times
+
+        Args:
+            item: The claimed file
+            error: Description of the failure
+
+        Returns:
+            False if the lease had been lost, and the file is processed by another worker
+
+        """
+        with self.__transaction():
+            dirty = self.__release_row(item)
+            if dirty is not None:
+                status = "pending" if dirty or item.attempts < self.max_attempts else "failed"
+                self.__conn.execute(
+                    "UPDATE work SET status = ?, worker = NULL, lease_expires = NULL, dirty = 0, "
+                    "attempts = CASE WHEN dirty THEN 0 ELSE attempts END, error = ? "
+                    "WHERE path = ?",
+                    (status, error, str(item.path)),
+                )
+                self.nb_failed += 1
+
+        if dirty is None:
+            self.__lost(item)
+            return False
+        if status == "failed":
+            logger.error(f"[WORK] Giving up '{item.path}' after {item.attempts} attempts: {error}")
+        WORK_ITEMS.inc(result="failed" if status == "failed" else "retried")
+        return True
+
+    def release(self, items: Iterable[WorkItem]):
+        """
+        Gives claimed files back to the queue without processing them, for instance when the
+        worker stops. The claim is not counted as an attempt
+
+        Args:
+            items: The claimed files
+
+        """
+        with self.__transaction():
+            for item in items:
+                if self.__release_row(item) is not None:
+                    self.__conn.execute(
+                        "UPDATE work SET status = 'pending', worker = NULL, lease_expires = NULL, "
+                        "attempts = attempts - 1 WHERE path = ?",
+                        (str(item.path),),
+                    )
+
+    def is_drained(self) -> bool:
+        """
+        Tells if all the queued files have been processed, by any worker
+
+        Returns:
+            True if no file is pending or leased
+
+        """
+        with self.__lock:
+            row = self.__conn.execute(
+                "SELECT COUNT(*) FROM work WHERE status IN ('pending', 'leased')"
+            ).fetchone()
+        return row[0] == 0
+
+    def stats(self) -> Dict[str, int]:
+        """
+        State of the queue, and activity of this worker since it was created
+
+        Returns:
+            A dictionary with the number of files in each state (pending, leased, done, failed),
+            the number of files held by this worker, and the number of files it claimed,
+            claimed after the expiry of a lease, completed, failed and whose lease it lost
+
+        """
+        with self.__lock:
+            counts = dict(
+                self.__conn.execute("SELECT status, COUNT(*) FROM work GROUP BY status").fetchall()
+            )
+            return {
+                "pending": counts.get("pending", 0),
+                "leased": counts.get("leased", 0),
+                "done": counts.get("done", 0),
+                "failed": counts.get("failed", 0),
+                "held": len(self.__held),
+                "claimed": self.nb_claimed,
+                "reclaimed": self.nb_reclaimed,
+                "completed": self.nb_completed,
+                "failures": self.nb_failed,
+                "lost": self.nb_lost,
+            }
@@ -1,15 +1,18 @@
+import argparse
 import sys
 
 import nltk
 import torch
 
-from .index_database import initialize_state_db
 from .config import config
 from . import logger
 from .DocumentIndexer import DocumentIndexer
+from .metrics import start_metrics_server
+from .QueryEncoder import QueryEncoder
+from .SearchService import SearchService, start_search_server
 
 
-def main(only_initial_scan: bool = False):
+def main(only_initial_scan: bool = False, serve: bool = False):
     torch.set_num_threads(config.TORCH_NUM_THREADS)
 
     # === Ensure NLTK punkt is available ===
@@ -17,16 +20,23 @@ def main(only_initial_scan: bool = False):
     nltk.download("punkt_tab", download_dir=config.STATE_DB_PATH.parent / "nltk")
     nltk.data.path.append(config.STATE_DB_PATH.parent / "nltk")
 
-    # Ensure state DB exists
-    initialize_state_db()
-
     # Ensure documents folder exists
     if not config.DOCS_PATH.exists():
         logger.error(f"Documents folder not found: '{config.DOCS_PATH}'")
         sys.exit(1)
 
+    if config.METRICS_PORT > 0:
+        start_metrics_server()
+
     indexer = DocumentIndexer()
 
+    if serve:
+        # The search service shares the embedding model and the Qdrant client of the indexer,
+        # and answers queries during the initial scan
+        service = SearchService(indexer.qdrant, QueryEncoder(indexer.model))
+        service.start()
+        start_search_server(service)
+
     # Initial full scan
     tot_nb_files = indexer.initial_scan()
 
@@ -38,4 +48,13 @@ def main(only_initial_scan: bool = False):
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(prog="python -m ragindexer")
+    parser.add_argument(
+        "command",
+        nargs="?",
+        choices=["index", "serve"],
+        default="index",
+        help="index: index the documents and watch them. serve: same, with the search service",
+    )
+    args = parser.parse_args()
+    main(serve=args.command == "serve")
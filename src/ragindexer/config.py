@@ -22,8 +22,87 @@ class Config(BaseSettings):
     MIN_EXPECTED_CHAR: int
     CHUNK_SIZE: int
     CHUNK_OVERLAP: int
+    CHUNKER: str = "char"
+    CHUNK_LANGUAGE: str = "auto"
+    CHUNK_MAX_TOKENS: int = 0
+    CHUNK_OVERLAP_TOKENS: int = 50
+    XLSX_WINDOW_CHARS: int = 0
+    DOCX_SECTION_CHARS: int = 20_000
     OCR_LANG: str
     TORCH_NUM_THREADS: int
+    EMBEDDING_BACKEND: str = "torch"
+    EMBEDDING_QUANTIZE: bool = True
+    EMBEDDING_QUANTIZATION_CONFIG: str = "avx512_vnni"
+    EMBEDDING_MIN_COSINE: float = 0.99
+    EMBEDDING_BATCH_CHUNKS: int = 256
+    EMBEDDING_BATCH_CHARS: int = 256_000
+    EMBEDDING_ENCODE_BATCH_SIZE: int = 32
+    EMBEDDING_CACHE_MAX_MB: int = 1024
+    PIPELINE_EXTRACT_WORKERS: int = 2
+    PIPELINE_CHUNK_WORKERS: int = 1
+    PIPELINE_EMBED_WORKERS: int = 1
+    PIPELINE_UPSERT_WORKERS: int = 2
+    PIPELINE_QUEUE_SIZE: int = 64
+    PIPELINE_MAX_FILES_IN_FLIGHT: int = 8
+    INCREMENTAL_REINDEX: bool = True
+    SCAN_WORKERS: int = 8
+    QDRANT_BATCH_POINTS: int = 256
+    QDRANT_BATCH_BYTES: int = 8_000_000
+    QDRANT_MAX_IN_FLIGHT: int = 4
+    QDRANT_MAX_RETRIES: int = 5
+    QDRANT_RETRY_BACKOFF: float = 0.5
+    QDRANT_QUANTIZATION: str = "none"
+    QDRANT_QUANTIZATION_QUANTILE: float = 0.99
+    QDRANT_QUANTIZATION_ALWAYS_RAM: bool = True
+    QDRANT_RESCORE: bool = True
+    QDRANT_OVERSAMPLING: float = 2.0
+    QDRANT_ON_DISK_VECTORS: bool = False
+    QDRANT_HNSW_M: int = 16
+    QDRANT_HNSW_EF_CONSTRUCT: int = 100
+    QDRANT_HNSW_ON_DISK: bool = False
+    QDRANT_INDEXING_THRESHOLD: int = 20000
+    QDRANT_DEFAULT_SEGMENT_NUMBER: int = 0
+    QDRANT_BULK_LOAD: bool = True
+    QDRANT_HYBRID: bool = False
+    QDRANT_DENSE_VECTOR_NAME: str = "dense"
+    QDRANT_SPARSE_VECTOR_NAME: str = "bm25"
+    QDRANT_PREFETCH_LIMIT: int = 50
+    BM25_K1: float = 1.2
+    BM25_B: float = 0.75
+    WATCHER_DEBOUNCE: float = 0.5
+    OCR_WORKERS: int = 2
+    OCR_PAGES_PER_TASK: int = 4
+    OCR_DPI: int = 300
+    OCR_ADAPTIVE: bool = False
+    OCR_DPI_LADDER: str = "150,300"
+    OCR_MIN_CONFIDENCE: float = 80.0
+    OCR_BLANK_THRESHOLD: float = 0.002
+    OCR_PSM: int = 3
+    OCR_OEM: int = 3
+    OCR_CACHE_MAX_MB: int = 512
+    PDF_TEXT_WORKERS: int = 2
+    PDF_PAGES_PER_TASK: int = 8
+    PDF_PAGE_TIMEOUT: float = 30.0
+    PDF_WORKER_MEMORY_MB: int = 2048
+    PDF_TIMEOUT_FALLBACK: str = "ocr"
+    METRICS_PORT: int = 0
+    METRICS_ADDR: str = "0.0.0.0"
+    SEARCH_PORT: int = 7860
+    SEARCH_ADDR: str = "0.0.0.0"
+    SEARCH_BATCH_SIZE: int = 32
+    SEARCH_BATCH_WAIT_MS: float = 2.0
+    SEARCH_QUERY_CACHE_SIZE: int = 10_000
+    SEARCH_RESULT_CACHE_SIZE: int = 2_000
+    SEARCH_RESULT_TTL: float = 60.0
+    SEARCH_DEFAULT_LIMIT: int = 10
+    SEARCH_MAX_LIMIT: int = 100
+    DISTRIBUTED: bool = False
+    WORKER_ID: str = ""
+    WORK_LEASE_SECONDS: float = 120.0
+    WORK_HEARTBEAT_SECONDS: float = 20.0
+    WORK_CLAIM_BATCH: int = 4
+    WORK_MAX_ATTEMPTS: int = 3
+    WORK_POLL_SECONDS: float = 1.0
 
 
 config = Config()
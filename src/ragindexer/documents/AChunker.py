@@ -0,0 +1,116 @@
+from abc import ABC, abstractmethod
+import threading
+from typing import Dict, List
+
+from nltk.tokenize import sent_tokenize
+
+from ..config import config
+from ..models import ChunkType
+
+
+# Frequent function words, used to guess the language of a text
+FRENCH_WORDS = set(
+    "le la les des du de un une et est dans pour que qui sur pas par au aux avec ce cette ne "
+    "nous vous".split()
+)
+ENGLISH_WORDS = set(
+    "the of and to in is that for it with as on be at by this are was from or an which you we "
+    "not".split()
+)
+
+
+def guess_language(text: str, max_words: int = 500) -> str:
+    """
+    Guesses if a text is French or English, by counting frequent function words
+
+    Args:
+        text: The text to analyse
+        max_words: Number of words of the text looked at
+
+    Returns:
+        The NLTK name of the language: "french" or "english"
+
+    """
+    words = text[: 10 * max_words].lower().split()[:max_words]
+    nb_french = sum(word in FRENCH_WORDS for word in words)
+    nb_english = sum(word in ENGLISH_WORDS for word in words)
+    return "english" if nb_english > nb_french else "french"
+
+
+class AChunker(ABC):
+    """
+    Splits the text of a page into chunks aligned on sentences.
+
+    The sentences are found by NLTK's punkt tokenizer for the language set by CHUNK_LANGUAGE.
+    With CHUNK_LANGUAGE=auto, the language is guessed for each text.
+
+    The chunker counts the chunks it produces, and those that are longer than the maximum
+    sequence length of the embedding model, and would therefore be truncated when encoded.
+
+    """
+
+    def __init__(self):
+        self.__stats_lock = threading.Lock()
+        self.__nb_chunks = 0
+        self.__nb_truncated = 0
+
+    def split_sentences(self, text: str) -> List[str]:
+        """
+        Splits a text into sentences
+
+        Args:
+            text: The text to split
+
+        Returns:
+            The list of sentences
+
+        """
+        language = config.CHUNK_LANGUAGE
+        if language == "auto":
+            language = guess_language(text)
+        return sent_tokenize(text, language=language)
+
+    def record_chunks(self, nb_chunks: int, nb_truncated: int):
+        """
+        Updates the statistics of the chunker
+
+        Args:
+            nb_chunks: Number of chunks produced
+            nb_truncated: Number of these chunks that exceed the maximum sequence length of the
+                model
+
+        """
+        with self.__stats_lock:
+            self.__nb_chunks += nb_chunks
+            self.__nb_truncated += nb_truncated
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Statistics since the chunker was created
+
+        Returns:
+            A dictionary with the number of chunks, the number of chunks that will be truncated
+            by the embedding model, and the truncation rate
+
+        """
+        with self.__stats_lock:
+            return {
+                "chunks": self.__nb_chunks,
+                "truncated": self.__nb_truncated,
+                "truncation_rate": (
+                    self.__nb_truncated / self.__nb_chunks if self.__nb_chunks > 0 else 0.0
+                ),
+            }
+
+    @abstractmethod
+    def chunk(self, text: str) -> List[ChunkType]:
+        """
+        Splits text into chunks. Empty chunks are discarded
+
+        Args:
+            text: The text to split
+
+        Returns:
+            The list of chunks
+
+        """
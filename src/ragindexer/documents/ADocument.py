@@ -1,12 +1,13 @@
 from abc import abstractmethod, ABC
 from pathlib import Path
-from typing import List, Tuple, Iterable
+import time
+from typing import List, Optional, Tuple, Iterable
 
-from nltk.tokenize import sent_tokenize
-from sentence_transformers import SentenceTransformer
-
-from ..config import config
-from ..models import ChunkType, EmbeddingType
+from ..index_database import file_hash
+from ..metrics import CHUNKING_SECONDS, CHUNKS, PAGE_EXTRACTION_SECONDS, PAGES
+from ..models import ChunkType
+from .AChunker import AChunker
+from .CharChunker import CharChunker
 
 
 class ADocument(ABC):
@@ -15,11 +16,13 @@ class ADocument(ABC):
 
     Args:
         abspath: Path to the file to handle
+        content_hash: Hash of the content of the file, if already computed by the caller
 
     """
 
-    def __init__(self, abspath: Path):
+    def __init__(self, abspath: Path, content_hash: Optional[str] = None):
         self.__abspath = abspath
+        self.__content_hash = content_hash
 
     def get_abs_path(self) -> Path:
         """
@@ -31,6 +34,19 @@ class ADocument(ABC):
         """
         return self.__abspath
 
+    def get_content_hash(self) -> str:
+        """
+        Get the hash of the content of the handled file, computed on first use if it was not
+        given to the constructor
+
+        Returns:
+            The SHA-256 of the file, as an hexadecimal string
+
+        """
+        if self.__content_hash is None:
+            self.__content_hash = file_hash(self.__abspath)
+        return self.__content_hash
+
     @abstractmethod
     def iterate_raw_text(self) -> Iterable[Tuple[int, str, dict]]:
         """
@@ -41,45 +57,61 @@ class ADocument(ABC):
 
         """
 
-    def __get_chunk_text(self, text: str, chunk_size: int, chunk_overlap: int) -> List[ChunkType]:
+    def iterate_pages(self) -> Iterable[Tuple[int, str, dict]]:
+        """
+        Iterate over the raw text of the pages, recording the time spent extracting each of them
+
+        Yields:
+            A tuple with the page number, the extracted text and the page metadata
+
         """
-        Splits text into overlapping chunks of ~chunk_size characters, aligned on sentences.
+        pages = iter(self.iterate_raw_text())
+        while True:
+            t0 = time.perf_counter()
+            try:
+                k_page, text, file_metadata = next(pages)
+            except StopIteration:
+                return
+            PAGE_EXTRACTION_SECONDS.observe(time.perf_counter() - t0)
+            PAGES.inc()
+            yield k_page, text, file_metadata
+
+    def chunk_text(self, text: str, chunker: Optional[AChunker] = None) -> List[ChunkType]:
         """
-        sentences = sent_tokenize(text)
-        chunks = []
-        current_chunk = ""
-        for sent in sentences:
-            if len(current_chunk) + len(sent) + 1 <= chunk_size:
-                current_chunk += " " + sent if current_chunk else sent
-            else:
-                chunks.append(current_chunk)
-                # Start new chunk: include overlap
-                overlap_text = (
-                    current_chunk[-chunk_overlap:]
-                    if chunk_overlap < len(current_chunk)
-                    else current_chunk
-                )
-                current_chunk = overlap_text + " " + sent
-
-        if current_chunk:
-            chunks.append(current_chunk)
+        Splits text into chunks aligned on sentences. Empty chunks are discarded.
+
+        Args:
+            text: The text to split
+            chunker: The chunker to use. Defaults to a `CharChunker`, that makes chunks of
+                ~CHUNK_SIZE characters
+
+        Returns:
+            The list of chunks
+
+        """
+        if chunker is None:
+            chunker = CharChunker()
+        with CHUNKING_SECONDS.time():
+            chunks = chunker.chunk(text)
+        CHUNKS.inc(len(chunks))
         return chunks
 
-    def __get_embeddings(
-        self, text: str, embedding_model: SentenceTransformer
-    ) -> Tuple[List[ChunkType], List[EmbeddingType]]:
-        chunks = self.__get_chunk_text(text, config.CHUNK_SIZE, config.CHUNK_OVERLAP)
-        embeddings = embedding_model.encode(chunks, device="cpu", show_progress_bar=False).tolist()
-        return chunks, embeddings
-
-    def process(
-        self, embedding_model: SentenceTransformer
-    ) -> Iterable[Tuple[int, List[ChunkType], List[EmbeddingType], dict]]:
-        for k_page, text, file_metadata in self.iterate_raw_text():
-            file_metadata["abspath"] = self.get_abs_path()
+    def iterate_chunks(
+        self, chunker: Optional[AChunker] = None
+    ) -> Iterable[Tuple[int, List[ChunkType], dict]]:
+        """
+        Iterate over the pages of the document and split them into chunks
 
-            chunks, embeddings = self.__get_embeddings(text, embedding_model)
-            while "" in chunks:
-                chunks.remove("")
+        Args:
+            chunker: The chunker to use. Defaults to a `CharChunker`
+
+        Yields:
+            A tuple with the page number, the list of chunks, and the page metadata
+
+        """
+        for k_page, text, file_metadata in self.iterate_pages():
+            # Each page gets its own copy, as pages may be processed after the next one is read
+            file_metadata = dict(file_metadata)
+            file_metadata["abspath"] = self.get_abs_path()
 
-            yield k_page, chunks, embeddings, file_metadata
+            yield k_page, self.chunk_text(text, chunker), file_metadata
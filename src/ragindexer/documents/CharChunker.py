@@ -0,0 +1,70 @@
+import threading
+from typing import List, Optional
+
+from ..config import config
+from ..models import ChunkType
+from .AChunker import AChunker
+
+
+class CharChunker(AChunker):
+    """
+    Packs sentences into overlapping chunks of ~CHUNK_SIZE characters, with CHUNK_OVERLAP
+    characters of the previous chunk at the beginning of the next one.
+
+    Args:
+        chunk_size: Maximum size of a chunk, in characters
+        chunk_overlap: Size of the overlap between consecutive chunks, in characters
+        tokenizer: If given, the tokenizer of the embedding model, used to count the chunks
+            that will be truncated
+        max_tokens: Maximum sequence length of the embedding model
+
+    """
+
+    def __init__(
+        self,
+        chunk_size: int = config.CHUNK_SIZE,
+        chunk_overlap: int = config.CHUNK_OVERLAP,
+        tokenizer=None,
+        max_tokens: Optional[int] = None,
+    ):
+        super().__init__()
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+
+        self.__lock = threading.Lock()
+
+    def chunk(self, text: str) -> List[ChunkType]:
+        chunks = []
+        parts: List[str] = []
+        length = 0
+        for sent in self.split_sentences(text):
+            if length + len(sent) + 1 <= self.chunk_size:
+                length += len(sent) + (1 if parts else 0)
+                parts.append(sent)
+            else:
+                current_chunk = " ".join(parts)
+                chunks.append(current_chunk)
+                # Start new chunk: include overlap
+                overlap_text = (
+                    current_chunk[-self.chunk_overlap :]
+                    if self.chunk_overlap < len(current_chunk)
+                    else current_chunk
+                )
+                parts = [overlap_text, sent] if overlap_text else [sent]
+                length = len(overlap_text) + 1 + len(sent) if overlap_text else len(sent)
+
+        if parts:
+            chunks.append(" ".join(parts))
+        chunks = [chunk for chunk in chunks if chunk != ""]
+
+        nb_truncated = 0
+        if self.tokenizer is not None and self.max_tokens is not None and chunks:
+            # The tokenizers of the models are not meant to be called by several threads at once
+            with self.__lock:
+                input_ids = self.tokenizer(chunks, add_special_tokens=True)["input_ids"]
+            nb_truncated = sum(len(ids) > self.max_tokens for ids in input_ids)
+        self.record_chunks(len(chunks), nb_truncated)
+
+        return chunks
@@ -1,26 +1,183 @@
-from typing import Iterable, Tuple
+from typing import Iterable, List, Tuple
 
 import docx
+from docx.table import Table
 
 from .. import logger
+from ..config import config
 from .ADocument import ADocument
 
 
+W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+MC_FALLBACK = "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+
+# Marks a page break in the text of a paragraph
+PAGE_BREAK = "\f"
+
+
+def _is_on(element) -> bool:
+    # Boolean properties like <w:pageBreakBefore/> can be turned off with w:val="0"
+    return element is not None and element.get(W + "val") not in ("0", "false", "off")
+
+
+def _iterate_paragraph(element) -> Iterable[str]:
+    # Pieces of text of a paragraph in document order, with PAGE_BREAK for the page breaks
+    for child in element:
+        tag = child.tag
+        if tag == W + "t":
+            yield child.text or ""
+        elif tag == W + "tab":
+            yield "\t"
+        elif tag in (W + "br", W + "cr"):
+            yield PAGE_BREAK if child.get(W + "type") == "page" else "\n"
+        elif tag == W + "lastRenderedPageBreak":
+            # Written by Word where it laid out a new page when the file was saved
+            yield PAGE_BREAK
+        elif tag == W + "pPr":
+            if _is_on(child.find(W + "pageBreakBefore")):
+                yield PAGE_BREAK
+        elif tag == MC_FALLBACK:
+            # Same content as the mc:Choice element, for older readers
+            continue
+        else:
+            yield from _iterate_paragraph(child)
+
+
+def paragraph_text(element) -> Tuple[List[str], bool]:
+    """
+    Extracts the text of a paragraph, split at its page breaks
+
+    Args:
+        element: The w:p element of the paragraph
+
+    Returns:
+        The text of the paragraph before the first page break, then between each page break,
+        and True if the paragraph ends a section that starts a new page
+
+    """
+    text = "".join(_iterate_paragraph(element))
+    sect_pr = element.find(W + "pPr/" + W + "sectPr")
+    new_page = False
+    if sect_pr is not None:
+        sect_type = sect_pr.find(W + "type")
+        new_page = sect_type is None or sect_type.get(W + "val") != "continuous"
+    return text.split(PAGE_BREAK), new_page
+
+
+def table_lines(table: Table) -> List[str]:
+    """
+    Extracts the text of a table, one line per row, the cells being separated by " | "
+
+    Args:
+        table: The table
+
+    Returns:
+        The lines of the non-empty rows
+
+    """
+    lines = []
+    for row in table.rows:
+        cells = []
+        previous = None
+        for cell in row.cells:
+            # Merged cells are returned once per grid column
+            if cell._tc is previous:
+                continue
+            previous = cell._tc
+            text = " ".join(cell.text.split())
+            if text:
+                cells.append(text)
+        if cells:
+            lines.append(" | ".join(cells))
+    return lines
+
+
 class DocDocument(ADocument):
-    def iterate_raw_text(self) -> Iterable[Tuple[str, dict]]:
+    """
+    Extracts the pages of a Word document.
+
+    Paragraphs and tables are read in document order and grouped into pages, using the page
+    breaks, the paragraphs with "page break before", the sections starting on a new page, and
+    the page layout recorded by Word when it saved the file. Consecutive breaks do not make
+    empty pages. A page longer than DOCX_SECTION_CHARS characters is cut between paragraphs,
+    so that documents without any break are split into sections of bounded size.
+
+    The text of the headers and footers, that is repeated on every page, is yielded once,
+    as the last page.
+
+    Args:
+        abspath: Path to the file to handle
+
+    """
+
+    def __iterate_blocks(self, doc) -> Iterable[str]:
+        # Text of the paragraphs and table rows, with PAGE_BREAK between the pages
+        for element in doc.element.body.iterchildren():
+            if element.tag == W + "p":
+                segments, new_page = paragraph_text(element)
+                for k, segment in enumerate(segments):
+                    if k > 0:
+                        yield PAGE_BREAK
+                    if segment.strip():
+                        yield segment.strip()
+                if new_page:
+                    yield PAGE_BREAK
+            elif element.tag == W + "tbl":
+                yield from table_lines(Table(element, doc))
+
+    def __headers_and_footers(self, doc) -> str:
+        lines = []
+        for section in doc.sections:
+            for part in (
+                section.header,
+                section.first_page_header,
+                section.even_page_header,
+                section.footer,
+                section.first_page_footer,
+                section.even_page_footer,
+            ):
+                if part.is_linked_to_previous:
+                    continue
+                for paragraph in part.paragraphs:
+                    lines.append(paragraph.text.strip())
+                for table in part.tables:
+                    lines.extend(table_lines(table))
+
+        # The same headers are often defined for each section
+        return "\n".join(dict.fromkeys(line for line in lines if line))
+
+    def iterate_raw_text(self) -> Iterable[Tuple[int, str, dict]]:
         try:
             doc = docx.Document(str(self.get_abs_path()))
         except Exception:
             logger.warning("Error while reading the file. Skipping")
             return None, {"ocr_used": False}
 
-        page_count = sum(p.contains_page_break for p in doc.paragraphs) + 1
-        logger.info(f"Reading {page_count} pages doc file")
-        avct = -1
-        for k_page, p in enumerate(doc.paragraphs):
-            new_avct = int(k_page / page_count * 100 / 10)
-            if new_avct != avct:
-                logger.info(f"Lecture page {k_page+1}/{page_count}")
-                avct = new_avct
+        k_page = 0
+        lines: List[str] = []
+        size = 0
+        for block in self.__iterate_blocks(doc):
+            if block == PAGE_BREAK:
+                if lines:
+                    yield k_page, "\n".join(lines), {"ocr_used": False}
+                    k_page += 1
+                    lines, size = [], 0
+                continue
+
+            if lines and size + len(block) > config.DOCX_SECTION_CHARS:
+                yield k_page, "\n".join(lines), {"ocr_used": False}
+                k_page += 1
+                lines, size = [], 0
+            lines.append(block)
+            size += len(block) + 1
+
+        if lines:
+            yield k_page, "\n".join(lines), {"ocr_used": False}
+            k_page += 1
+
+        headers = self.__headers_and_footers(doc)
+        if headers:
+            yield k_page, headers, {"ocr_used": False, "headers_and_footers": True}
+            k_page += 1
 
-            yield k_page, "\n".join(p.text).strip(), {"ocr_used": False}
+        logger.info(f"Read {k_page} pages from doc file")
@@ -1,10 +1,16 @@
 from pathlib import Path
-from typing import Iterable, List, Tuple
+from typing import Iterable, List, Optional, Tuple
 from solus import Singleton
 from sentence_transformers import SentenceTransformer
 
-from ..models import ChunkType, EmbeddingType
+from ..config import config
+from ..EmbeddingCache import EmbeddingCache
+from ..models import ChunkType, EmbeddingBatchType
 from .ADocument import ADocument
+from .AChunker import AChunker
+from .CharChunker import CharChunker
+from .TokenChunker import TokenChunker
+from .EmbeddingBatcher import EmbeddingBatcher
 from .XlsDocument import XlsDocument
 from .PdfDocument import PdfDocument
 from .MarkdownDocument import MarkdownDocument
@@ -15,6 +21,9 @@ class DocumentFactory(Singleton):
     def __init__(self):
         self.__association = {}
         self.__embedding_model = None
+        self.__embedding_cache = None
+        self.__batcher = None
+        self.__chunker = None
 
     def filter_file(self, path: Path) -> bool:
         if path.suffix not in self.__association.keys():
@@ -31,16 +40,92 @@ class DocumentFactory(Singleton):
     def getBuild(self, ext: str) -> ADocument:
         return self.__association[ext]
 
-    def set_embedding_model(self, embedding_model: SentenceTransformer):
+    def set_embedding_model(
+        self, embedding_model: SentenceTransformer, model_id: str = config.EMBEDDING_MODEL
+    ):
+        """
+        Sets the model used to compute the embeddings of all the documents
+
+        Args:
+            embedding_model: The embedding model
+            model_id: Identifier of the model and of its backend, that keys the embedding cache
+
+        """
         self.__embedding_model = embedding_model
+        if config.EMBEDDING_CACHE_MAX_MB > 0:
+            self.__embedding_cache = EmbeddingCache(model_id)
+        else:
+            self.__embedding_cache = None
+        self.__batcher = EmbeddingBatcher(embedding_model, cache=self.__embedding_cache)
+        self.__chunker = self.__make_chunker(embedding_model)
+
+    @staticmethod
+    def __make_chunker(embedding_model: SentenceTransformer) -> AChunker:
+        # The token chunker needs the tokenizer of the model
+        tokenizer = getattr(embedding_model, "tokenizer", None)
+        max_tokens = config.CHUNK_MAX_TOKENS or getattr(embedding_model, "max_seq_length", None)
+        if tokenizer is None or max_tokens is None:
+            return CharChunker()
+        elif config.CHUNKER == "token":
+            return TokenChunker(tokenizer, max_tokens)
+        else:
+            return CharChunker(tokenizer=tokenizer, max_tokens=max_tokens)
+
+    def get_chunker(self) -> AChunker:
+        """
+        Get the chunker shared by all the documents
+
+        Returns:
+            The chunker set by CHUNKER, built with the tokenizer of the embedding model
+
+        """
+        if self.__chunker is None:
+            self.__chunker = CharChunker()
+        return self.__chunker
+
+    def get_embedding_cache(self) -> Optional[EmbeddingCache]:
+        """
+        Get the embedding cache shared by all the documents
+
+        Returns:
+            The cache, or None if EMBEDDING_CACHE_MAX_MB is 0
+
+        """
+        return self.__embedding_cache
+
+    def get_batcher(self) -> EmbeddingBatcher:
+        """
+        Get the embedding batcher shared by all the documents
+
+        Returns:
+            The batcher built with the model given to set_embedding_model
+
+        """
+        return self.__batcher
 
     def processDocument(
         self, abspath: Path
-    ) -> Iterable[Tuple[int, List[ChunkType], List[EmbeddingType], dict]]:
+    ) -> Iterable[Tuple[int, List[ChunkType], EmbeddingBatchType, dict]]:
+        """
+        Compute the chunks and embeddings of a file. The pages of the file are encoded
+        in batches by the shared `EmbeddingBatcher`
+
+        Args:
+            abspath: Path to the file to process
+
+        Yields:
+            A tuple with the page number, the list of chunks, the corresponding embeddings
+            (one row per chunk), and the page metadata
+
+        """
         ext = abspath.suffix
         cls = self.getBuild(ext)
         doc: ADocument = cls(abspath)
-        for k_page, chunks, embeddings, file_metadata in doc.process(self.__embedding_model):
+        pages = (
+            ((k_page, file_metadata), chunks)
+            for k_page, chunks, file_metadata in doc.iterate_chunks(self.get_chunker())
+        )
+        for (k_page, file_metadata), chunks, embeddings in self.__batcher.embed_pages(pages):
             yield k_page, chunks, embeddings, file_metadata
 
 
@@ -0,0 +1,185 @@
+import threading
+import time
+from typing import Any, Iterable, List, Optional, Tuple
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+from .. import logger
+from ..config import config
+from ..EmbeddingCache import EmbeddingCache
+from ..metrics import EMBEDDING_BATCH_SIZE, ENCODE_SECONDS
+from ..models import ChunkType, EmbeddingBatchType
+
+
+class EmbeddingBatcher:
+    """
+    Groups the chunks of several pages (possibly coming from several files) into batches,
+    so that the embedding model is called once per batch instead of once per page.
+
+    Inside a batch, chunks are sorted by length before being encoded, which reduces the
+    padding added by the tokenizer. The embeddings of a batch are kept in one float32 array,
+    and those of each page are a view on it. Each page is identified by an opaque owner object
+    that is given back with the page's chunks and embeddings.
+
+    Args:
+        embedding_model: The model used to compute the embeddings
+        max_chunks: Maximum number of chunks in a batch
+        max_chars: Maximum cumulated number of characters in a batch.
+            0 disables cross-page batching: each page is encoded on its own
+        cache: If given, chunks found in this cache are not encoded again
+
+    """
+
+    def __init__(
+        self,
+        embedding_model: SentenceTransformer,
+        max_chunks: int = config.EMBEDDING_BATCH_CHUNKS,
+        max_chars: int = config.EMBEDDING_BATCH_CHARS,
+        cache: Optional[EmbeddingCache] = None,
+    ):
+        self.embedding_model = embedding_model
+        self.max_chunks = max_chunks
+        self.max_chars = max_chars
+        self.cache = cache
+
+        self.__stats_lock = threading.Lock()
+        self.__nb_chunks = 0
+        self.__nb_batches = 0
+        self.__encode_time = 0.0
+
+    def encode(self, chunks: List[ChunkType]) -> EmbeddingBatchType:
+        """
+        Encode a list of chunks in one call to the embedding model.
+        The chunks are sorted by length before encoding, and the embeddings are returned
+        in the original order. If the batcher has a cache, only the chunks missing from it
+        are given to the model.
+
+        Args:
+            chunks: List of chunks to encode
+
+        Returns:
+            The array of embeddings, with one row per chunk, in the same order as chunks
+
+        """
+        if self.cache is not None:
+            return self.cache.encode(chunks, self.__encode)
+        return self.__encode(chunks)
+
+    def __encode(self, chunks: List[ChunkType]) -> EmbeddingBatchType:
+        if len(chunks) == 0:
+            return np.empty(
+                (0, self.embedding_model.get_sentence_embedding_dimension()), dtype=np.float32
+            )
+
+        order = np.argsort([len(chunk) for chunk in chunks], kind="stable")
+        t0 = time.perf_counter()
+        sorted_embeddings = self.embedding_model.encode(
+            [chunks[i] for i in order],
+            batch_size=config.EMBEDDING_ENCODE_BATCH_SIZE,
+            device="cpu",
+            show_progress_bar=False,
+            convert_to_numpy=True,
+        )
+        dt = time.perf_counter() - t0
+        ENCODE_SECONDS.observe(dt)
+        EMBEDDING_BATCH_SIZE.set(len(chunks))
+
+        embeddings = np.empty(sorted_embeddings.shape, dtype=np.float32)
+        embeddings[order] = sorted_embeddings
+
+        with self.__stats_lock:
+            self.__nb_chunks += len(chunks)
+            self.__nb_batches += 1
+            self.__encode_time += dt
+
+        logger.debug(
+            f"[EMBED] Encoded {len(chunks)} chunks in {dt:.3f} s "
+            f"({len(chunks) / dt if dt > 0 else 0.0:.1f} chunks/s)"
+        )
+
+        return embeddings
+
+    def embed_pages(
+        self, pages: Iterable[Tuple[Any, List[ChunkType]]]
+    ) -> Iterable[Tuple[Any, List[ChunkType], EmbeddingBatchType]]:
+        """
+        Compute the embeddings of a stream of pages.
+        Pages are accumulated until the batch budget is reached, then encoded together.
+        A page is never split between two batches, and pages are yielded in the order
+        they were read.
+
+        Args:
+            pages: Iterable of (owner, chunks) tuples. owner is given back untouched
+
+        Yields:
+            A tuple with the owner, the chunks and the corresponding embeddings
+
+        """
+        pending: List[Tuple[Any, List[ChunkType]]] = []
+        nb_chunks = 0
+        nb_chars = 0
+        for owner, chunks in pages:
+            page_chars = sum(len(c) for c in chunks)
+            if pending and (
+                nb_chunks + len(chunks) > self.max_chunks or nb_chars + page_chars > self.max_chars
+            ):
+                yield from self.__encode_pending(pending)
+                pending = []
+                nb_chunks = 0
+                nb_chars = 0
+
+            pending.append((owner, chunks))
+            nb_chunks += len(chunks)
+            nb_chars += page_chars
+
+        if pending:
+            yield from self.__encode_pending(pending)
+
+    def __encode_pending(
+        self, pending: List[Tuple[Any, List[ChunkType]]]
+    ) -> Iterable[Tuple[Any, List[ChunkType], EmbeddingBatchType]]:
+        all_chunks = [chunk for _, chunks in pending for chunk in chunks]
+        all_embeddings = self.encode(all_chunks)
+
+        start = 0
+        for owner, chunks in pending:
+            stop = start + len(chunks)
+            # A view on the array of the batch: the embeddings are not copied
+            yield owner, chunks, all_embeddings[start:stop]
+            start = stop
+
+    def throughput(self) -> float:
+        """
+        Average encoding throughput since the creation of the batcher
+
+        Returns:
+            The number of chunks encoded per second of model time
+
+        """
+        with self.__stats_lock:
+            if self.__encode_time == 0.0:
+                return 0.0
+            return self.__nb_chunks / self.__encode_time
+
+    def stats(self) -> dict:
+        """
+        Statistics about the batches encoded since the creation of the batcher
+
+        Returns:
+            A dictionary with the number of chunks, batches, the encoding time in seconds
+            and the throughput in chunks/s
+
+        """
+        with self.__stats_lock:
+            nb_chunks, nb_batches, encode_time = (
+                self.__nb_chunks,
+                self.__nb_batches,
+                self.__encode_time,
+            )
+        return {
+            "chunks": nb_chunks,
+            "batches": nb_batches,
+            "encode_time": encode_time,
+            "chunks_per_second": nb_chunks / encode_time if encode_time > 0 else 0.0,
+        }
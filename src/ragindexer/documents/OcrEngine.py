@@ -0,0 +1,336 @@
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import pytesseract
+from pdf2image import convert_from_path
+from PIL import Image
+from solus import Singleton
+
+from .. import logger
+from ..config import config
+from ..metrics import ERRORS, OCR_BLANK_PAGES, OCR_PAGE_SECONDS, OCR_PAGES
+
+
+def dpi_ladder() -> List[int]:
+    """
+    Get the resolutions used to render the pages for OCR
+
+    Returns:
+        The increasing list of the resolutions of OCR_DPI_LADDER if OCR_ADAPTIVE is True,
+        or [OCR_DPI] otherwise
+
+    """
+    if not config.OCR_ADAPTIVE:
+        return [config.OCR_DPI]
+    return sorted(int(dpi) for dpi in config.OCR_DPI_LADDER.split(",") if dpi.strip())
+
+
+def is_blank_page(img: Image.Image, threshold: float) -> bool:
+    """
+    Tells if a page is blank, from the histogram of its image
+
+    Args:
+        img: Image of the page
+        threshold: Fraction of dark pixels under which the page is considered blank
+
+    Returns:
+        True if the page is blank or nearly blank
+
+    """
+    histogram = img.convert("L").histogram()
+    nb_dark = sum(histogram[:128])
+    return nb_dark < threshold * sum(histogram)
+
+
+def ocr_image(img: Image.Image, lang: str, tesseract_config: str) -> Tuple[str, float]:
+    """
+    Runs tesseract on an image
+
+    Args:
+        img: Image of the page
+        lang: Languages given to tesseract
+        tesseract_config: Options given to tesseract, like the page segmentation mode
+
+    Returns:
+        The text, with the lines of a paragraph separated by a newline and the paragraphs by
+        an empty line, and the mean confidence of tesseract in the words, between 0 and 100
+
+    """
+    data = pytesseract.image_to_data(
+        img, lang=lang, config=tesseract_config, output_type=pytesseract.Output.DICT
+    )
+
+    paragraphs: Dict[Tuple[int, int], Dict[int, List[str]]] = {}
+    confidences = []
+    for k, word in enumerate(data["text"]):
+        word = word.strip()
+        if not word:
+            continue
+        paragraph = paragraphs.setdefault((data["block_num"][k], data["par_num"][k]), {})
+        paragraph.setdefault(data["line_num"][k], []).append(word)
+        confidence = float(data["conf"][k])
+        if confidence >= 0:
+            confidences.append(confidence)
+
+    text = "\n\n".join(
+        "\n".join(" ".join(words) for words in lines.values()) for lines in paragraphs.values()
+    )
+    return text, sum(confidences) / len(confidences) if confidences else 0.0
+
+
+def ocr_page_range(
+    path: str,
+    first_page: int,
+    last_page: int,
+    dpis: List[int],
+    lang: str,
+    grayscale: bool = False,
+    min_confidence: float = 0.0,
+    blank_threshold: float = 0.0,
+    tesseract_config: str = "",
+) -> List[dict]:
+    """
+    Render a range of pages with a single call to poppler, then run tesseract on each of them.
+    A page whose confidence is below min_confidence is rendered again at the next resolution
+    of dpis, and the result with the best confidence is kept.
+    This function is executed in the worker processes of `OcrEngine`
+
+    Args:
+        path: Path to the pdf file
+        first_page: Number of the first page to OCR, starting at 1
+        last_page: Number of the last page to OCR (included)
+        dpis: Increasing list of the resolutions of the rendering
+        lang: Languages given to tesseract
+        grayscale: True to render the pages in grayscale
+        min_confidence: Mean confidence of tesseract under which a page is rendered again
+        blank_threshold: Fraction of dark pixels under which a page is considered blank, and
+            is not given to tesseract. 0 to give all the pages to tesseract
+        tesseract_config: Options given to tesseract, like the page segmentation mode
+
+    Returns:
+        For each page of the range, a dictionary with the OCR text (None if tesseract failed),
+        the resolution used (ocr_dpi), the confidence of tesseract (ocr_confidence, None for
+        blank pages), and the time spent on the page in seconds (duration). The time of the
+        first rendering is shared among the pages
+
+    """
+    t0 = time.perf_counter()
+    images = convert_from_path(
+        path, first_page=first_page, last_page=last_page, dpi=dpis[0], grayscale=grayscale
+    )
+    render_time = (time.perf_counter() - t0) / max(len(images), 1)
+
+    results = []
+    for k, img in enumerate(images):
+        t0 = time.perf_counter()
+        result = {"text": None, "ocr_dpi": dpis[0], "ocr_confidence": None}
+        try:
+            if blank_threshold > 0 and is_blank_page(img, blank_threshold):
+                result["text"] = ""
+            else:
+                text, confidence = ocr_image(img, lang, tesseract_config)
+                result.update(text=text, ocr_confidence=confidence)
+                for dpi in dpis[1:]:
+                    if result["ocr_confidence"] >= min_confidence:
+                        break
+                    k_page = first_page + k
+                    (hd_img,) = convert_from_path(
+                        path, first_page=k_page, last_page=k_page, dpi=dpi, grayscale=grayscale
+                    )
+                    try:
+                        text, confidence = ocr_image(hd_img, lang, tesseract_config)
+                    finally:
+                        hd_img.close()
+                    if confidence > result["ocr_confidence"]:
+                        result.update(text=text, ocr_dpi=dpi, ocr_confidence=confidence)
+        except Exception as e:
+            logger.error(f"OCR failed : {e}")
+            result["text"] = None
+        finally:
+            img.close()
+        result["duration"] = render_time + time.perf_counter() - t0
+        results.append(result)
+
+    return results
+
+
+def _split_in_ranges(k_pages: List[int], max_pages: int) -> List[Tuple[int, int]]:
+    ranges = []
+    for k_page in k_pages:
+        if ranges and ranges[-1][1] == k_page - 1 and k_page - ranges[-1][0] < max_pages:
+            ranges[-1] = (ranges[-1][0], k_page)
+        else:
+            ranges.append((k_page, k_page))
+    return ranges
+
+
+class OcrEngine(Singleton):
+    """
+    Runs the OCR of pdf pages in a pool of OCR_WORKERS processes.
+    Contiguous pages are grouped in ranges of at most OCR_PAGES_PER_TASK pages, each range
+    being rendered by poppler in one pass.
+
+    With OCR_ADAPTIVE=True, the pages are rendered in grayscale at the first resolution of
+    OCR_DPI_LADDER. Pages whose fraction of dark pixels is below OCR_BLANK_THRESHOLD are
+    considered blank, and are not given to tesseract. A page whose mean confidence is below
+    OCR_MIN_CONFIDENCE is rendered again at the next resolution of the ladder. Otherwise, the
+    pages are rendered in color at OCR_DPI. Tesseract is run with OCR_PSM and OCR_OEM.
+
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__executor: Optional[ProcessPoolExecutor] = None
+
+    def __get_executor(self) -> ProcessPoolExecutor:
+        with self.__lock:
+            if self.__executor is None:
+                # The indexer is multi-threaded: forking it directly could deadlock the workers
+                self.__executor = ProcessPoolExecutor(
+                    max_workers=config.OCR_WORKERS,
+                    mp_context=multiprocessing.get_context("forkserver"),
+                )
+            return self.__executor
+
+    def submit(self, path: Path, k_pages: List[int]) -> List["OcrTask"]:
+        """
+        Submits the OCR of the given pages of a pdf file to the pool, without waiting for it
+
+        Args:
+            path: Path to the pdf file
+            k_pages: Sorted list of the numbers of the pages to OCR, starting at 1
+
+        Returns:
+            The tasks OCRing the ranges of pages, in the order of the pages
+
+        """
+        if len(k_pages) == 0:
+            return []
+
+        executor = self.__get_executor()
+        adaptive = config.OCR_ADAPTIVE
+        return [
+            OcrTask(
+                first_page,
+                last_page,
+                executor.submit(
+                    ocr_page_range,
+                    str(path),
+                    first_page,
+                    last_page,
+                    dpi_ladder(),
+                    config.OCR_LANG,
+                    grayscale=adaptive,
+                    min_confidence=config.OCR_MIN_CONFIDENCE if adaptive else 0.0,
+                    blank_threshold=config.OCR_BLANK_THRESHOLD if adaptive else 0.0,
+                    tesseract_config=f"--psm {config.OCR_PSM} --oem {config.OCR_OEM}",
+                ),
+            )
+            for first_page, last_page in _split_in_ranges(k_pages, config.OCR_PAGES_PER_TASK)
+        ]
+
+    def iterate_pages(
+        self, path: Path, k_pages: List[int]
+    ) -> Iterable[Tuple[int, Optional[str], dict]]:
+        """
+        OCR the given pages of a pdf file. All the ranges are submitted at once to the pool,
+        and the results are yielded in the order of the pages
+
+        Args:
+            path: Path to the pdf file
+            k_pages: Sorted list of the numbers of the pages to OCR, starting at 1
+
+        Yields:
+            A tuple with the page number and the result of `OcrTask.page`
+
+        """
+        tasks = self.submit(path, k_pages)
+        try:
+            for task in tasks:
+                for k_page in range(task.first_page, task.last_page + 1):
+                    yield k_page, *task.page(k_page)
+        finally:
+            # The caller may stop reading before the end
+            for task in tasks:
+                task.cancel()
+
+
+class OcrTask:
+    """
+    OCR of a range of pages of a pdf file, running in the pool of `OcrEngine`
+
+    Args:
+        first_page: Number of the first page of the range, starting at 1
+        last_page: Number of the last page of the range
+        future: The future of `ocr_page_range`
+
+    """
+
+    def __init__(self, first_page: int, last_page: int, future: Future):
+        self.first_page = first_page
+        self.last_page = last_page
+        self.__future = future
+        self.__lock = threading.Lock()
+        self.__results: Optional[Dict[int, Tuple[Optional[str], dict]]] = None
+
+    def done(self) -> bool:
+        """
+        Tells if the OCR of the range is finished
+
+        Returns:
+            True if the results can be read without waiting
+
+        """
+        return self.__future.done()
+
+    def cancel(self):
+        """Cancels the OCR of the range, if it has not started yet"""
+        self.__future.cancel()
+
+    def page(self, k_page: int) -> Tuple[Optional[str], dict]:
+        """
+        Waits for the OCR of the range, and get the result of a page
+
+        Args:
+            k_page: Number of the page, starting at 1
+
+        Returns:
+            The OCR text (None if the OCR failed), and a dictionary with the resolution
+            (ocr_dpi) and the confidence of tesseract (ocr_confidence) for the page. The
+            dictionary is empty for blank pages and failed pages
+
+        """
+        with self.__lock:
+            if self.__results is None:
+                self.__results = self.__read_results()
+        return self.__results[k_page]
+
+    def __read_results(self) -> Dict[int, Tuple[Optional[str], dict]]:
+        try:
+            results = self.__future.result()
+        except Exception as e:
+            logger.error(f"OCR failed for pages {self.first_page}-{self.last_page} : {e}")
+            results = []
+
+        pages = {}
+        for k, k_page in enumerate(range(self.first_page, self.last_page + 1)):
+            result = results[k] if k < len(results) else {"text": None}
+            info = {}
+            if "duration" in result:
+                OCR_PAGE_SECONDS.observe(result["duration"])
+            if result["text"] is None:
+                ERRORS.inc(stage="ocr")
+            elif result["ocr_confidence"] is None:
+                OCR_BLANK_PAGES.inc()
+            else:
+                OCR_PAGES.inc()
+                info = {
+                    "ocr_dpi": result["ocr_dpi"],
+                    "ocr_confidence": round(result["ocr_confidence"], 1),
+                }
+            pages[k_page] = (result["text"], info)
+        return pages
@@ -1,96 +1,208 @@
 from pathlib import Path
-from typing import Iterable, Tuple
+import shutil
+import threading
+from collections import deque
+from typing import Deque, Iterable, List, Optional, Tuple
 
-import pytesseract
-from pdf2image import convert_from_path
 from pypdf import PdfReader
 
 from .. import logger
+from ..OcrCache import OcrCache
 from .ADocument import ADocument
+from .OcrEngine import OcrEngine, OcrTask
+from .PdfTextExtractor import PdfTextExtractor
 from ..config import config
 
 
-def ocr_pdf(path: Path, k_page: int, ocr_dir: Path) -> str:
-    ocr_dir.mkdir(parents=True, exist_ok=True)
+_ocr_cache_lock = threading.Lock()
+_ocr_cache: Optional[OcrCache] = None
 
-    # Convert the page to an image
-    ocr_txt = ocr_dir / f"page{k_page:05}.cache"
-    if ocr_txt.exists():
-        with open(ocr_txt, "r") as f:
-            txt = f.read()
 
-    else:
-        img = convert_from_path(path, first_page=k_page, last_page=k_page, dpi=300)[0]
+def get_ocr_cache() -> OcrCache:
+    """
+    Get the OCR cache shared by all the pdf documents, opened on first use
+
+    Returns:
+        The OCR cache
+
+    """
+    global _ocr_cache
+    with _ocr_cache_lock:
+        if _ocr_cache is None:
+            _ocr_cache = OcrCache()
+        return _ocr_cache
+
+
+def legacy_ocr_cache_dir(abspath: Path) -> Path:
+    # Folder of the OCR cache of a file, before the cache was keyed by the content of the files
+    if abspath.parts[0] == "/":
+        abspath = abspath.relative_to("/")
+    return config.STATE_DB_PATH.parent / "cache" / abspath.parent / (abspath.parts[-1] + ".ocr")
 
-        try:
-            txt = pytesseract.image_to_string(img, lang=config.OCR_LANG)
-            with open(ocr_txt, "w") as f:
-                f.write(txt)
-        except Exception as e:
-            logger.error(f"OCR failed : {e}")
-            txt = None
 
-    return txt
+def import_legacy_ocr_cache(abspath: Path, doc_hash: str, cache: OcrCache):
+    """
+    Moves the pages of the per-path OCR cache of a file into the OCR cache, and removes the
+    folder of the per-path cache
+
+    Args:
+        abspath: Path to the pdf file
+        doc_hash: Hash of the content of the file
+        cache: The OCR cache
+
+    """
+    ocr_dir = legacy_ocr_cache_dir(abspath)
+    if not ocr_dir.is_dir():
+        return
+
+    for ocr_txt in sorted(ocr_dir.glob("page*.cache")):
+        with open(ocr_txt, "r") as f:
+            cache.put_page(doc_hash, int(ocr_txt.stem[4:]) - 1, f.read())
+    logger.info(f"Imported OCR cache '{ocr_dir}'")
+    shutil.rmtree(ocr_dir, ignore_errors=True)
 
 
 class PdfDocument(ADocument):
-    def __init__(self, abspath):
-        super().__init__(abspath)
-
-        if abspath.parts[0] == "/":
-            self.ocr_dir = (
-                config.STATE_DB_PATH.parent
-                / "cache"
-                / abspath.parent.relative_to("/")
-                / (abspath.parts[-1] + ".ocr")
-            )
-        else:
-            self.ocr_dir = (
-                config.STATE_DB_PATH.parent
-                / "cache"
-                / abspath.parent
-                / (abspath.parts[-1] + ".ocr")
-            )
-
-        if self.ocr_dir.exists():
-            logger.info(f"Reusing OCR cache for {self.ocr_dir}")
-            self.using_ocr = True
-        else:
-            self.using_ocr = False
+    """
+    Extracts the pages of a pdf file.
+
+    The text layer is extracted by `PdfTextExtractor`. The pages with less than MIN_EXPECTED_CHAR
+    characters, and those whose extraction timed out or crashed (unless PDF_TIMEOUT_FALLBACK is
+    "skip"), are OCRed by `OcrEngine`. The numbers of the pages whose extraction failed are
+    kept in failed_pages.
+    The pages are yielded as soon as they are available, in order: the pages needing OCR are
+    OCRed while the text layer of the next ones is read.
+
+    The OCR results are stored in the `OcrCache`, keyed by the content of the file. The cache
+    also remembers which pages needed OCR: when an unchanged file is indexed again, the text
+    layer of these pages is not probed, and their text is read from the cache.
+    The metadata of the OCRed pages give the resolution of the rendering and the confidence
+    of tesseract.
+
+    Args:
+        abspath: Path to the file to handle
+        content_hash: Hash of the content of the file, if already computed by the caller
+
+    """
 
-    def iterate_raw_text(self) -> Iterable[Tuple[str, dict]]:
+    def __init__(self, abspath: Path, content_hash: Optional[str] = None):
+        super().__init__(abspath, content_hash)
+
+        self.failed_pages: List[int] = []
+
+    def iterate_raw_text(self) -> Iterable[Tuple[int, str, dict]]:
         path = self.get_abs_path()
         try:
             reader = PdfReader(path)
             nb_pages = len(reader.pages)
+            doc_hash = self.get_content_hash()
         except Exception:
             logger.error("Error while reading the file. Skipping")
             return None, {"ocr_used": False}
 
+        cache = get_ocr_cache()
+        import_legacy_ocr_cache(path, doc_hash, cache)
+
+        ocr_used = [False] * nb_pages
+        known_ocr_pages = cache.get_ocr_pages(doc_hash)
+        if known_ocr_pages is None:
+            probe_pages = list(range(nb_pages))
+        else:
+            logger.info(f"Reusing OCR cache for {len(known_ocr_pages)} pages of '{path}'")
+            for k_page in known_ocr_pages:
+                ocr_used[k_page] = True
+            probe_pages = [k_page for k_page in range(nb_pages) if not ocr_used[k_page]]
+
+        # The text layer is read in worker processes, and the pages needing OCR are submitted
+        # to the OCR pool as soon as they are found. The pages are yielded in order, each one
+        # as soon as it and the previous ones are available
         logger.info(f"Reading {nb_pages} pages pdf file")
-        file_metadata = {"ocr_used": False}
+        text_pages = iter(PdfTextExtractor().iterate_pages(path, probe_pages))
+        # Pages not yielded yet, as [page, text, ocr_used, info] lists. The text of a page being
+        # OCRed is its `OcrTask`, None until it is submitted
+        pending: Deque[list] = deque()
+        to_ocr: List[list] = []
+        tasks: List[OcrTask] = []
         avct = -1
-        for k_page, page in enumerate(reader.pages):
-            new_avct = int(k_page / nb_pages * 100 / 10)
-            if new_avct != avct:
-                logger.info(f"Lecture page {k_page+1}/{nb_pages}")
-                avct = new_avct
-
-            try:
-                txt = page.extract_text() or ""
-            except Exception as e:
-                logger.error(f"While extracting text: {e}")
-                txt = ""
-
-            if len(txt) < config.MIN_EXPECTED_CHAR:
-                if not self.using_ocr:
-                    self.using_ocr = True
-                    logger.info(f"Using OCR for '{self.get_abs_path()}' in '{self.ocr_dir}")
-
-                file_metadata["ocr_used"] = True
-                txt = ocr_pdf(path, k_page + 1, self.ocr_dir)
-
-            if txt is None or txt == "":
-                continue
-
-            yield k_page, txt, file_metadata
+        try:
+            for k_page in range(nb_pages):
+                entry = [k_page, None, ocr_used[k_page], {}]
+                if not ocr_used[k_page]:
+                    _, txt, failed = next(text_pages)
+                    new_avct = int(k_page / nb_pages * 100 / 10)
+                    if new_avct != avct:
+                        logger.info(f"Lecture page {k_page+1}/{nb_pages}")
+                        avct = new_avct
+
+                    if failed:
+                        self.failed_pages.append(k_page)
+                    if failed and config.PDF_TIMEOUT_FALLBACK == "skip":
+                        entry[1] = ""
+                    elif len(txt or "") < config.MIN_EXPECTED_CHAR:
+                        ocr_used[k_page] = entry[2] = True
+                    else:
+                        entry[1] = txt
+
+                if ocr_used[k_page]:
+                    cached = cache.get_pages(doc_hash, [k_page]).get(k_page)
+                    if cached is None:
+                        to_ocr.append(entry)
+                    else:
+                        entry[1], entry[3] = cached
+                pending.append(entry)
+
+                # Consecutive pages are OCRed together, up to OCR_PAGES_PER_TASK pages
+                if to_ocr and (to_ocr[-1] is not entry or len(to_ocr) >= config.OCR_PAGES_PER_TASK):
+                    tasks.extend(self.__submit_ocr(path, to_ocr))
+                    to_ocr = []
+                yield from self.__ready_pages(pending, doc_hash, block=False)
+
+            if self.failed_pages:
+                logger.warning(
+                    f"[PDF] Text extraction failed for pages {[k + 1 for k in self.failed_pages]} "
+                    f"of '{path}'. "
+                    f"Pages {'skipped' if config.PDF_TIMEOUT_FALLBACK == 'skip' else 'OCRed'}"
+                )
+            if known_ocr_pages is None:
+                cache.set_ocr_pages(doc_hash, [k for k in range(nb_pages) if ocr_used[k]])
+
+            tasks.extend(self.__submit_ocr(path, to_ocr))
+            yield from self.__ready_pages(pending, doc_hash, block=True)
+        finally:
+            # The caller may stop reading before the end
+            text_pages.close()
+            for task in tasks:
+                task.cancel()
+
+    def __submit_ocr(self, path: Path, entries: List[list]) -> List[OcrTask]:
+        if not entries:
+            return []
+        logger.info(f"Using OCR on {len(entries)} pages for '{path}'")
+        tasks = OcrEngine().submit(path, [k_page + 1 for k_page, _, _, _ in entries])
+        by_page = {
+            k_page: task for task in tasks for k_page in range(task.first_page, task.last_page + 1)
+        }
+        for entry in entries:
+            entry[1] = by_page[entry[0] + 1]
+        return tasks
+
+    def __ready_pages(
+        self, pending: Deque[list], doc_hash: str, block: bool
+    ) -> Iterable[Tuple[int, str, dict]]:
+        # Yields the first pending pages whose text is available. With block=True, waits for
+        # the OCR of all the pending pages
+        while pending:
+            k_page, txt, ocr_used, info = pending[0]
+            if isinstance(txt, OcrTask):
+                if not block and not txt.done():
+                    return
+                txt, info = txt.page(k_page + 1)
+                if txt is not None:
+                    get_ocr_cache().put_page(doc_hash, k_page, txt, info)
+            elif txt is None:
+                # Waiting to be submitted to the OCR
+                return
+            pending.popleft()
+
+            if txt:
+                yield k_page, txt, {"ocr_used": ocr_used, **info}
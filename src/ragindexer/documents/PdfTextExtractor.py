@@ -0,0 +1,186 @@
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+from pypdf import PdfReader
+from solus import Singleton
+
+from .. import logger
+from ..config import config
+from ..metrics import ERRORS
+from .OcrEngine import _split_in_ranges
+
+
+def extract_worker(conn, memory_mb: int):
+    """
+    Main loop of the worker processes of `PdfTextExtractor`.
+    Receives (path, first_page, last_page) requests, and sends back the text of each page
+    as soon as it is extracted. The text is None if the extraction failed
+
+    Args:
+        conn: End of the pipe connected to the parent process
+        memory_mb: Limit of the address space of the process, in MB. 0 for no limit
+
+    """
+    if memory_mb > 0:
+        import resource
+
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    reader_path, reader = None, None
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+
+        path, first_page, last_page = request
+        for k_page in range(first_page, last_page + 1):
+            try:
+                if path != reader_path:
+                    reader_path, reader = None, None
+                    reader = PdfReader(path)
+                    reader_path = path
+                txt = reader.pages[k_page].extract_text() or ""
+            except Exception as e:
+                # MemoryError included, when the limit of the process is reached
+                logger.error(f"While extracting text of page {k_page + 1} of '{path}': {e}")
+                txt = None
+            conn.send(txt)
+
+
+class _Worker:
+    # A worker process, and the pipe to talk to it
+    def __init__(self):
+        # The indexer is multi-threaded: forking it directly could deadlock the workers
+        ctx = multiprocessing.get_context("forkserver")
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=extract_worker,
+            args=(child_conn, config.PDF_WORKER_MEMORY_MB),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class PdfTextExtractor(Singleton):
+    """
+    Extracts the text layer of pdf pages in PDF_TEXT_WORKERS worker processes, so that a
+    pathological page cannot block the indexer.
+
+    The pages are split in ranges of at most PDF_PAGES_PER_TASK pages, that are extracted
+    concurrently. Each worker process is limited to PDF_WORKER_MEMORY_MB MB of memory, and each
+    page to PDF_PAGE_TIMEOUT seconds. A worker that times out or crashes is killed and replaced,
+    and the rest of its range is extracted by the new one.
+    With PDF_TEXT_WORKERS=0, the pages are extracted in the calling thread, without any limit.
+
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__executor: Optional[ThreadPoolExecutor] = None
+        # Each thread of the executor drives its own worker process
+        self.__local = threading.local()
+
+    def __get_executor(self) -> ThreadPoolExecutor:
+        with self.__lock:
+            if self.__executor is None:
+                self.__executor = ThreadPoolExecutor(
+                    max_workers=config.PDF_TEXT_WORKERS, thread_name_prefix="pdf-text"
+                )
+            return self.__executor
+
+    def __get_worker(self) -> _Worker:
+        worker = getattr(self.__local, "worker", None)
+        if worker is None or not worker.process.is_alive():
+            worker = _Worker()
+            self.__local.worker = worker
+        return worker
+
+    def __kill_worker(self):
+        self.__local.worker.kill()
+        self.__local.worker = None
+
+    def __extract_range(
+        self, path: str, first_page: int, last_page: int
+    ) -> List[Tuple[Optional[str], bool]]:
+        results = []
+        k_page = first_page
+        while k_page <= last_page:
+            worker = self.__get_worker()
+            worker.conn.send((path, k_page, last_page))
+            while k_page <= last_page:
+                failure = None
+                if not worker.conn.poll(config.PDF_PAGE_TIMEOUT):
+                    failure = f"timed out after {config.PDF_PAGE_TIMEOUT} s"
+                else:
+                    try:
+                        results.append((worker.conn.recv(), False))
+                        k_page += 1
+                        continue
+                    except (EOFError, OSError):
+                        failure = "crashed"
+
+                logger.error(f"[PDF] Text extraction of page {k_page + 1} of '{path}' {failure}")
+                ERRORS.inc(stage="pdf_text")
+                self.__kill_worker()
+                results.append((None, True))
+                k_page += 1
+                break
+        return results
+
+    def iterate_pages(
+        self, path: Path, k_pages: List[int]
+    ) -> Iterable[Tuple[int, Optional[str], bool]]:
+        """
+        Extracts the text layer of pages of a pdf file. All the ranges are submitted at once,
+        and the results are yielded in the order of the pages
+
+        Args:
+            path: Path to the pdf file
+            k_pages: Sorted list of the numbers of the pages to extract, starting at 0
+
+        Yields:
+            A tuple with the page number, the text of the page (None if the extraction failed),
+            and True if the extraction timed out or crashed the worker
+
+        """
+        if len(k_pages) == 0:
+            return
+
+        if config.PDF_TEXT_WORKERS == 0:
+            reader = PdfReader(path)
+            for k_page in k_pages:
+                try:
+                    txt = reader.pages[k_page].extract_text() or ""
+                except Exception as e:
+                    logger.error(f"While extracting text: {e}")
+                    txt = None
+                yield k_page, txt, False
+            return
+
+        executor = self.__get_executor()
+        futures = [
+            (first_page, executor.submit(self.__extract_range, str(path), first_page, last_page))
+            for first_page, last_page in _split_in_ranges(k_pages, config.PDF_PAGES_PER_TASK)
+        ]
+
+        try:
+            for first_page, future in futures:
+                for k, (txt, failed) in enumerate(future.result()):
+                    yield first_page + k, txt, failed
+        finally:
+            # The caller may stop reading before the end
+            for _, future in futures:
+                future.cancel()
@@ -0,0 +1,101 @@
+import threading
+from typing import List, Tuple
+
+from ..config import config
+from ..models import ChunkType
+from .AChunker import AChunker
+
+
+class TokenChunker(AChunker):
+    """
+    Packs sentences into chunks of at most max_tokens tokens of the embedding model, so that
+    no chunk is truncated by the model, and chunks are as large as the model allows.
+    The last sentences of a chunk, up to overlap_tokens tokens, are repeated at the beginning
+    of the next one.
+
+    The sentences of a text are tokenized in one batched call to the tokenizer. A sentence longer
+    than max_tokens is cut at token boundaries.
+
+    Args:
+        tokenizer: The tokenizer of the embedding model
+        max_tokens: Maximum sequence length of the embedding model, special tokens included
+        overlap_tokens: Size of the overlap between consecutive chunks, in tokens
+
+    """
+
+    def __init__(
+        self, tokenizer, max_tokens: int, overlap_tokens: int = config.CHUNK_OVERLAP_TOKENS
+    ):
+        super().__init__()
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+
+        # Room left for the tokens added by the model, like [CLS] and [SEP]
+        self.budget = max_tokens - tokenizer.num_special_tokens_to_add()
+
+        # The tokenizers of the models are not meant to be called by several threads at once
+        self.__lock = threading.Lock()
+
+    def __split_long_sentence(self, sentence: str) -> List[Tuple[str, int]]:
+        if not getattr(self.tokenizer, "is_fast", False):
+            # Offsets are only available with the fast tokenizers: the sentence will be truncated
+            return [(sentence, self.budget + 1)]
+
+        with self.__lock:
+            offsets = self.tokenizer(
+                sentence, add_special_tokens=False, return_offsets_mapping=True
+            )["offset_mapping"]
+        pieces = []
+        for k in range(0, len(offsets), self.budget):
+            window = offsets[k : k + self.budget]
+            pieces.append((sentence[window[0][0] : window[-1][1]], len(window)))
+        return pieces
+
+    def chunk(self, text: str) -> List[ChunkType]:
+        sentences = [sent for sent in self.split_sentences(text) if sent.strip()]
+        if not sentences:
+            return []
+
+        with self.__lock:
+            input_ids = self.tokenizer(sentences, add_special_tokens=False)["input_ids"]
+
+        units: List[Tuple[str, int]] = []
+        for sent, ids in zip(sentences, input_ids):
+            if len(ids) > self.budget:
+                units.extend(self.__split_long_sentence(sent))
+            else:
+                units.append((sent, len(ids)))
+
+        chunks = []
+        parts: List[Tuple[str, int]] = []
+        nb_tokens = 0
+        for sent, sent_tokens in units:
+            if parts and nb_tokens + sent_tokens > self.budget:
+                chunks.append(" ".join(part for part, _ in parts))
+
+                # Start new chunk: include the last sentences as overlap
+                overlap: List[Tuple[str, int]] = []
+                overlap_size = 0
+                for part, part_tokens in reversed(parts):
+                    if overlap_size + part_tokens > self.overlap_tokens:
+                        break
+                    overlap.append((part, part_tokens))
+                    overlap_size += part_tokens
+                if overlap_size + sent_tokens > self.budget:
+                    overlap, overlap_size = [], 0
+                parts = overlap[::-1]
+                nb_tokens = overlap_size
+
+            parts.append((sent, sent_tokens))
+            nb_tokens += sent_tokens
+
+        if parts:
+            chunks.append(" ".join(part for part, _ in parts))
+
+        # Joining sentences may change their tokenization a little: count the actual lengths
+        with self.__lock:
+            chunk_ids = self.tokenizer(chunks, add_special_tokens=True)["input_ids"]
+        self.record_chunks(len(chunks), sum(len(ids) > self.max_tokens for ids in chunk_ids))
+
+        return chunks
@@ -1,12 +1,44 @@
-from typing import Iterable, Tuple
+from typing import Iterable, List, Tuple
 
 import openpyxl
 
 from .. import logger
+from ..config import config
 from .ADocument import ADocument
 
 
+def format_row(row: tuple, max_chars: int) -> str:
+    """
+    Formats the non-empty cells of a row, separated by spaces
+
+    Args:
+        row: Values of the cells
+        max_chars: Maximum length of the text, longer rows are truncated
+
+    Returns:
+        The text of the row, empty if all the cells are empty
+
+    """
+    return " ".join(str(cell) for cell in row if cell is not None)[:max_chars]
+
+
 class XlsDocument(ADocument):
+    """
+    Streams the rows of a workbook, read with openpyxl in read-only mode.
+
+    The rows of each sheet are grouped in windows of at most XLSX_WINDOW_CHARS characters
+    (CHUNK_SIZE if 0), each window being yielded as a page as soon as it is full. Every window
+    starts with the name of the sheet and its first non-empty row, which usually holds the
+    column headers, cut to half of the window. Rows longer than the rest of the window are
+    truncated. The page metadata give the sheet name and the range of rows of the window,
+    numbered as in the spreadsheet, and are recorded in the payload of the chunks. The memory
+    used does not depend on the size of the workbook.
+
+    Args:
+        abspath: Path to the file to handle
+
+    """
+
     def iterate_raw_text(self) -> Iterable[Tuple[int, str, dict]]:
         try:
             wb = openpyxl.load_workbook(self.get_abs_path(), read_only=True, data_only=True)
@@ -14,18 +46,51 @@ class XlsDocument(ADocument):
             logger.warning("Error while reading the file. Skipping")
             return None, {"ocr_used": False}
 
-        nb_sheets = len(wb.worksheets)
-        logger.info(f"Reading {nb_sheets} pages excel file")
-        avct = -1
-        all_text = []
-        for k_sheet, sheet in enumerate(wb.worksheets):
-            new_avct = int(k_sheet / nb_sheets * 100 / 10)
-            if new_avct != avct:
+        window_chars = config.XLSX_WINDOW_CHARS or config.CHUNK_SIZE
+        try:
+            nb_sheets = len(wb.worksheets)
+            logger.info(f"Reading {nb_sheets} pages excel file")
+            k_window = 0
+            for k_sheet, sheet in enumerate(wb.worksheets):
                 logger.info(f"Lecture page {k_sheet+1}/{nb_sheets}")
-                avct = new_avct
 
-            for row in sheet.iter_rows(values_only=True):
-                row_text = [str(cell) for cell in row if cell is not None]
-                if row_text:
-                    all_text.append(" ".join(row_text))
-            yield k_sheet, "\n".join(all_text).strip(), {"ocr_used": False}
+                header = None
+                row_chars = window_chars
+                rows: List[str] = []
+                size = 0
+                first_row = last_row = 0
+                for k_row, row in enumerate(sheet.iter_rows(values_only=True), start=1):
+                    row_text = format_row(row, row_chars)
+                    if not row_text:
+                        continue
+                    if header is None:
+                        # The header takes at most half of the window, the rows get the rest
+                        header = f"{sheet.title}\n{row_text}"[: window_chars // 2]
+                        row_chars = window_chars - len(header) - 1
+                        continue
+
+                    if rows and len(header) + size + len(row_text) + 1 > window_chars:
+                        yield k_window, "\n".join([header] + rows), {
+                            "ocr_used": False,
+                            "sheet": sheet.title,
+                            "rows": (first_row, last_row),
+                        }
+                        k_window += 1
+                        rows, size = [], 0
+                    if not rows:
+                        first_row = k_row
+                    last_row = k_row
+                    rows.append(row_text)
+                    size += len(row_text) + 1
+
+                if header is not None:
+                    # Last window of the sheet. A sheet with a single row only has its header
+                    yield k_window, "\n".join([header] + rows), {
+                        "ocr_used": False,
+                        "sheet": sheet.title,
+                        "rows": (first_row, last_row),
+                    }
+                    k_window += 1
+        finally:
+            # In read-only mode, the file stays open until the workbook is closed
+            wb.close()
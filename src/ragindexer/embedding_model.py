@@ -0,0 +1,192 @@
+import json
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+from . import logger
+from .config import config
+
+
+# Sentences embedded by both backends to check the accuracy of the fast one.
+# The default model is bilingual, so the set mixes English and French
+GUARDRAIL_SENTENCES = [
+    "The quarterly report shows a 12% increase in revenue compared to last year.",
+    "Please find attached the signed contract and the invoice for March.",
+    "The patient was prescribed 500 mg of amoxicillin three times a day.",
+    "Installation requires Python 3.11 or later and a working Docker setup.",
+    "The meeting has been moved to Thursday at 10am in room B204.",
+    "Le rapport trimestriel montre une hausse de 12 % du chiffre d'affaires.",
+    "Veuillez trouver ci-joint le contrat signé ainsi que la facture de mars.",
+    "La réunion du conseil municipal est reportée au mois prochain.",
+    "Le locataire doit restituer les clés à la fin du bail.",
+    "Les résultats de l'analyse sanguine sont dans les normes.",
+    "Tesseract OCR extracts text from scanned pages.",
+    "Qdrant stores the vectors and their payloads.",
+    "Merci pour votre retour rapide, bonne journée.",
+    "Error 404: the requested page could not be found.",
+    "Total TTC : 1 254,30 €",
+    "Chapter 3 - Results and discussion",
+]
+
+
+def model_cache_folder() -> Path:
+    """
+    Get the folder where the embedding models are downloaded and exported
+
+    Returns:
+        The models folder, next to the state DB
+
+    """
+    return config.STATE_DB_PATH.parent / "models"
+
+
+def _fast_model_file(backend: str, quantize: bool) -> str:
+    if backend == "onnx":
+        if quantize:
+            return f"onnx/model_qint8_{config.EMBEDDING_QUANTIZATION_CONFIG}.onnx"
+        return "onnx/model.onnx"
+    elif backend == "openvino":
+        if quantize:
+            return "openvino/openvino_model_qint8_quantized.xml"
+        return "openvino/openvino_model.xml"
+    else:
+        raise ValueError(f"Unknown embedding backend '{backend}'")
+
+
+def _export_fast_model(backend: str, quantize: bool, export_dir: Path):
+    # Export of the model to the backend format, then quantization of the exported model
+    logger.info(f"[EMBED] Exporting '{config.EMBEDDING_MODEL}' to {backend} in '{export_dir}'")
+    model = SentenceTransformer(
+        config.EMBEDDING_MODEL,
+        trust_remote_code=config.EMBEDDING_MODEL_TRUST_REMOTE_CODE,
+        backend=backend,
+        cache_folder=model_cache_folder(),
+    )
+    model.save_pretrained(str(export_dir))
+    if not quantize:
+        return
+
+    logger.info(f"[EMBED] Quantizing the {backend} model to int8")
+    if backend == "onnx":
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+
+        export_dynamic_quantized_onnx_model(
+            model,
+            quantization_config=config.EMBEDDING_QUANTIZATION_CONFIG,
+            model_name_or_path=str(export_dir),
+        )
+    else:
+        from optimum.intel import OVQuantizationConfig
+        from sentence_transformers import export_static_quantized_openvino_model
+
+        export_static_quantized_openvino_model(
+            model,
+            quantization_config=OVQuantizationConfig(),
+            model_name_or_path=str(export_dir),
+        )
+
+
+def _load_fast_model(backend: str, quantize: bool) -> SentenceTransformer:
+    model_name = config.EMBEDDING_MODEL.replace("/", "--")
+    export_dir = model_cache_folder() / f"{model_name}-{backend}"
+    file_name = _fast_model_file(backend, quantize)
+    if not (export_dir / file_name).exists():
+        _export_fast_model(backend, quantize, export_dir)
+
+    return SentenceTransformer(
+        str(export_dir),
+        trust_remote_code=config.EMBEDDING_MODEL_TRUST_REMOTE_CODE,
+        backend=backend,
+        model_kwargs={"file_name": file_name},
+    )
+
+
+def _load_torch_model() -> SentenceTransformer:
+    return SentenceTransformer(
+        config.EMBEDDING_MODEL,
+        trust_remote_code=config.EMBEDDING_MODEL_TRUST_REMOTE_CODE,
+        backend="torch",
+        cache_folder=model_cache_folder(),
+    )
+
+
+def compare_models(
+    reference: SentenceTransformer, candidate: SentenceTransformer, sentences: List[str]
+) -> float:
+    """
+    Compares the embeddings computed by two models
+
+    Args:
+        reference: The reference model
+        candidate: The model to check
+        sentences: The sentences to embed
+
+    Returns:
+        The lowest cosine similarity between the embeddings of a sentence by the two models
+
+    """
+    ref = np.asarray(reference.encode(sentences, normalize_embeddings=True), dtype=np.float32)
+    cand = np.asarray(candidate.encode(sentences, normalize_embeddings=True), dtype=np.float32)
+    return float(np.min(np.sum(ref * cand, axis=1)))
+
+
+def load_embedding_model() -> Tuple[SentenceTransformer, str]:
+    """
+    Loads the embedding model with the backend set by EMBEDDING_BACKEND.
+
+    With the onnx and openvino backends, the model is exported (and quantized to int8 if
+    EMBEDDING_QUANTIZE is True) once, in the models folder. Before being used, the fast model
+    has to give embeddings whose cosine similarity with those of the torch backend is at least
+    EMBEDDING_MIN_COSINE on a set of sample sentences. The result of this check is stored with
+    the exported model. If the check fails, or if the backend cannot be loaded, the torch
+    backend is used.
+
+    Returns:
+        The model, and an identifier of the model and of its backend
+
+    """
+    backend = config.EMBEDDING_BACKEND
+    if backend == "torch":
+        return _load_torch_model(), config.EMBEDDING_MODEL
+
+    quantize = config.EMBEDDING_QUANTIZE
+    model_id = f"{config.EMBEDDING_MODEL}@{backend}{'-qint8' if quantize else ''}"
+    try:
+        fast_model = _load_fast_model(backend, quantize)
+    except Exception as e:
+        logger.warning(f"[EMBED] Cannot load the {backend} backend, using torch: {e}")
+        return _load_torch_model(), config.EMBEDDING_MODEL
+
+    # The check is only run once per exported model
+    model_name = config.EMBEDDING_MODEL.replace("/", "--")
+    check_path = model_cache_folder() / f"{model_name}-{backend}" / "guardrail.json"
+    checks = {}
+    if check_path.exists():
+        with open(check_path, "r") as f:
+            checks = json.load(f)
+
+    file_name = _fast_model_file(backend, quantize)
+    torch_model = None
+    if file_name not in checks:
+        torch_model = _load_torch_model()
+        checks[file_name] = compare_models(torch_model, fast_model, GUARDRAIL_SENTENCES)
+        with open(check_path, "w") as f:
+            json.dump(checks, f, indent=2)
+
+    similarity = checks[file_name]
+    if similarity < config.EMBEDDING_MIN_COSINE:
+        logger.warning(
+            f"[EMBED] The {backend} model gives a cosine similarity of {similarity:.4f} with the "
+            f"torch model, below {config.EMBEDDING_MIN_COSINE}. Using torch"
+        )
+        if torch_model is None:
+            torch_model = _load_torch_model()
+        return torch_model, config.EMBEDDING_MODEL
+
+    logger.info(
+        f"[EMBED] Using the {backend} model '{file_name}' "
+        f"(cosine similarity with torch: {similarity:.4f})"
+    )
+    return fast_model, model_id
@@ -1,120 +1,507 @@
+import hashlib
 import os
 import sqlite3
+import threading
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
 from . import logger
 from .config import config
 
 
-def initialize_state_db():
+def file_hash(path: Path) -> str:
     """
-    Initialize the sqlite database
+    Computes the hash of the content of a file
 
-    """
-    os.makedirs(os.path.dirname(config.STATE_DB_PATH), exist_ok=True)
+    Args:
+        path: Path to the file
 
-    logger.info(f"Using sqlite database '{config.STATE_DB_PATH}'")
+    Returns:
+        The SHA-256 of the file, as an hexadecimal string
 
-    conn = sqlite3.connect(config.STATE_DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        """
-        CREATE TABLE IF NOT EXISTS files (
-            path TEXT PRIMARY KEY,
-            last_modified REAL
-        )
     """
-    )
-    conn.commit()
-    conn.close()
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
 
 
-def get_stored_timestamp(relpath: Path) -> Optional[float]:
+def journal_mode() -> str:
     """
-    Get the stored timestamp for the given path
-
-    Args:
-        relpath: Path to a file that has already been processed
+    Journal mode of the sqlite databases of the indexer. WAL needs the memory shared by the
+    processes using a database, so in distributed mode, where the databases may be used by
+    several nodes through a network filesystem, the rollback journal is used instead
 
     Returns:
-        The timestamp of last processing if found. None otherwise
+        The value of the journal_mode pragma
 
     """
-    conn = sqlite3.connect(config.STATE_DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT last_modified FROM files WHERE path = ?", (str(relpath),))
-    row = c.fetchone()
-    conn.close()
-    return row[0] if row else None
+    return "DELETE" if config.DISTRIBUTED else "WAL"
 
 
-def set_stored_timestamp(relpath: Path, ts: float):
+class StateDB:
     """
-    Stores the processing timestamp for the given path
+    The sqlite database that keeps track of the indexed files.
+
+    The object owns a single connection, opened in WAL mode and shared by all the threads of the
+    indexer. sqlite keeps the compiled statements of this connection in cache, so each query is
+    only prepared once. In distributed mode, the database is shared by all the workers and uses
+    a rollback journal (see `journal_mode`).
 
     Args:
-        relpath: Path to a file that has already been processed
-        ts: The timestamp of last processing
+        db_path: Path to the sqlite database
 
     """
-    conn = sqlite3.connect(config.STATE_DB_PATH)
-    c = conn.cursor()
-    c.execute("REPLACE INTO files (path, last_modified) VALUES (?, ?)", (str(relpath), ts))
-    conn.commit()
-    conn.close()
 
+    def __init__(self, db_path: Path = config.STATE_DB_PATH):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
 
-def delete_stored_file(relpath: Path):
-    """
-    Delete the given path
+        logger.info(f"Using sqlite database '{db_path}'")
 
-    Args:
-        relpath: Path to a file that has already been processed
+        self.__lock = threading.RLock()
+        self.__conn = sqlite3.connect(
+            db_path, timeout=30.0, check_same_thread=False, cached_statements=256
+        )
+        self.__conn.execute(f"PRAGMA journal_mode={journal_mode()}")
+        self.__conn.execute("PRAGMA synchronous=NORMAL")
+        self.__conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                last_modified REAL,
+                content_hash TEXT
+            )
+        """
+        )
+        # Databases created before the content hash was recorded
+        columns = [row[1] for row in self.__conn.execute("PRAGMA table_info(files)")]
+        if "content_hash" not in columns:
+            self.__conn.execute("ALTER TABLE files ADD COLUMN content_hash TEXT")
+        self.__conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS chunks (
+                path TEXT,
+                page INTEGER,
+                chunk_index INTEGER,
+                point_id TEXT,
+                chunk_hash TEXT,
+                PRIMARY KEY (path, page, chunk_index)
+            )
+        """
+        )
+        # Vocabulary of the sparse lexical vectors: the IDs are the indices of the vectors
+        # stored in Qdrant, so tokens are never removed
+        self.__conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS vocabulary (
+                token_id INTEGER PRIMARY KEY,
+                token TEXT UNIQUE
+            )
+        """
+        )
+        self.__conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS lexical_stats (
+                name TEXT PRIMARY KEY,
+                value INTEGER
+            )
+        """
+        )
+        # Number of tokens of each point with a sparse vector, so that the statistics follow the
+        # points replaced, deleted or renamed
+        tables = [row[0] for row in self.__conn.execute("SELECT name FROM sqlite_master")]
+        if "chunk_lengths" not in tables:
+            # The statistics of databases created before cannot be updated: they start again
+            self.__conn.execute("DELETE FROM lexical_stats")
+        self.__conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS chunk_lengths (
+                point_id TEXT PRIMARY KEY,
+                path TEXT,
+                nb_tokens INTEGER
+            )
+        """
+        )
+        self.__conn.execute("CREATE INDEX IF NOT EXISTS chunk_lengths_path ON chunk_lengths (path)")
+        self.__conn.commit()
 
-    """
-    conn = sqlite3.connect(config.STATE_DB_PATH)
-    c = conn.cursor()
-    c.execute("DELETE FROM files WHERE path = ?", (str(relpath),))
-    conn.commit()
-    conn.close()
+    def close(self):
+        """Closes the connection to the database"""
+        with self.__lock:
+            self.__conn.close()
 
+    def get_stored_timestamp(self, relpath: Path) -> Optional[float]:
+        """
+        Get the stored timestamp for the given path
 
-def delete_all_files():
-    """
-    Delete all files
+        Args:
+            relpath: Path to a file that has already been processed
 
-    """
-    conn = sqlite3.connect(config.STATE_DB_PATH)
-    c = conn.cursor()
-    c.execute("DELETE FROM files")
-    conn.commit()
-    conn.close()
+        Returns:
+            The timestamp of last processing if found. None otherwise
 
+        """
+        with self.__lock:
+            row = self.__conn.execute(
+                "SELECT last_modified FROM files WHERE path = ?", (str(relpath),)
+            ).fetchone()
+        return row[0] if row else None
 
-def list_stored_files(absolute: bool = False) -> list[Path]:
-    """
-    List all paths stored in the database
+    def load_timestamps(self) -> Dict[str, float]:
+        """
+        Get the stored timestamps of all the files, in one query
 
-    Args:
-        absolute: True to return absolute paths
+        Returns:
+            A dictionary giving the timestamp of last processing of each stored path
 
-    Returns:
-        The list of all paths stored in the database
+        """
+        with self.__lock:
+            rows = self.__conn.execute("SELECT path, last_modified FROM files").fetchall()
+        return dict(rows)
 
-    """
-    conn = sqlite3.connect(config.STATE_DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT path FROM files")
-    rows = c.fetchall()
-    conn.close()
-
-    files_list = []
-    for (stored_path,) in rows:
-        relpath = Path(stored_path)
-        if absolute:
-            files_list.append(config.DOCS_PATH / relpath)
-        else:
-            files_list.append(relpath)
-
-    return files_list
+    def get_content_hash(self, relpath: Path) -> Optional[str]:
+        """
+        Get the hash of the content of the given path, when it was last processed
+
+        Args:
+            relpath: Path to a file that has already been processed
+
+        Returns:
+            The hash computed by `file_hash` if found. None otherwise
+
+        """
+        with self.__lock:
+            row = self.__conn.execute(
+                "SELECT content_hash FROM files WHERE path = ?", (str(relpath),)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_stored_timestamp(self, relpath: Path, ts: float, content_hash: Optional[str] = None):
+        """
+        Stores the processing timestamp for the given path
+
+        Args:
+            relpath: Path to a file that has already been processed
+            ts: The timestamp of last processing
+            content_hash: The hash of the content of the file, computed by `file_hash`
+
+        """
+        with self.__lock, self.__conn:
+            self.__conn.execute(
+                "REPLACE INTO files (path, last_modified, content_hash) VALUES (?, ?, ?)",
+                (str(relpath), ts, content_hash),
+            )
+
+    def set_stored_timestamps(self, timestamps: Iterable[Tuple[Path, float]]):
+        """
+        Stores the processing timestamps of several paths, in one transaction.
+        The content hashes already stored for these paths are kept
+
+        Args:
+            timestamps: Iterable of (path, timestamp of last processing) tuples
+
+        """
+        with self.__lock, self.__conn:
+            self.__conn.executemany(
+                "INSERT INTO files (path, last_modified) VALUES (?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET last_modified = excluded.last_modified",
+                [(str(relpath), ts) for relpath, ts in timestamps],
+            )
+
+    def delete_stored_file(self, relpath: Path):
+        """
+        Delete the given path
+
+        Args:
+            relpath: Path to a file that has already been processed
+
+        """
+        self.delete_stored_files([relpath])
+
+    def delete_stored_files(self, relpaths: Iterable[Path]):
+        """
+        Delete several paths, in one transaction
+
+        Args:
+            relpaths: Paths to files that have already been processed
+
+        """
+        rows = [(str(relpath),) for relpath in relpaths]
+        with self.__lock, self.__conn:
+            self.__conn.executemany("DELETE FROM files WHERE path = ?", rows)
+            self.__conn.executemany("DELETE FROM chunks WHERE path = ?", rows)
+
+    def delete_all_files(self):
+        """
+        Delete all files
+
+        """
+        with self.__lock, self.__conn:
+            self.__conn.execute("DELETE FROM files")
+            self.__conn.execute("DELETE FROM chunks")
+
+    def find_stored_files(self, relpath: Path) -> List[Path]:
+        """
+        Find the stored paths of a file, or of all the files under a directory
+
+        Args:
+            relpath: Path to a file or a directory
+
+        Returns:
+            The stored paths equal to relpath, or located under it
+
+        """
+        prefix = os.path.join(str(relpath), "")
+        with self.__lock:
+            rows = self.__conn.execute(
+                "SELECT path FROM files WHERE path = ? OR substr(path, 1, ?) = ?",
+                (str(relpath), len(prefix), prefix),
+            ).fetchall()
+        return [Path(stored_path) for (stored_path,) in rows]
+
+    def rename_stored_files(
+        self,
+        renames: Iterable[Tuple[Path, Path]],
+        point_id: Optional[Callable[[Path, int, int], str]] = None,
+    ):
+        """
+        Renames several paths, in one transaction. The chunks manifests follow the files.
+        Rows already stored under the new paths are replaced
+
+        Args:
+            renames: Iterable of (old path, new path) tuples
+            point_id: Function giving the ID of the point of a chunk from the path of its file,
+                its page and its index, when the points have been moved to new IDs
+
+        """
+        rows = [(str(destpath), str(srcpath)) for srcpath, destpath in renames]
+        with self.__lock, self.__conn:
+            self.__conn.executemany("DELETE FROM files WHERE path = ?", [r[:1] for r in rows])
+            self.__conn.executemany("DELETE FROM chunks WHERE path = ?", [r[:1] for r in rows])
+            self.__conn.executemany("UPDATE files SET path = ? WHERE path = ?", rows)
+            self.__conn.executemany("UPDATE chunks SET path = ? WHERE path = ?", rows)
+            if point_id is not None:
+                for destpath, _ in rows:
+                    chunks = self.__conn.execute(
+                        "SELECT page, chunk_index FROM chunks WHERE path = ?", (destpath,)
+                    ).fetchall()
+                    self.__conn.executemany(
+                        "UPDATE chunks SET point_id = ? "
+                        "WHERE path = ? AND page = ? AND chunk_index = ?",
+                        [
+                            (point_id(Path(destpath), page, idx), destpath, page, idx)
+                            for page, idx in chunks
+                        ],
+                    )
+
+    def get_chunk_manifest(self, relpath: Path) -> Dict[Tuple[int, int], Tuple[str, str]]:
+        """
+        Get the chunks recorded in Qdrant for the given path
+
+        Args:
+            relpath: Path to a file that has already been processed
+
+        Returns:
+            A dictionary giving, for each (page, chunk index), the Qdrant point ID and the hash of
+            the chunk text
+
+        """
+        with self.__lock:
+            rows = self.__conn.execute(
+                "SELECT page, chunk_index, point_id, chunk_hash FROM chunks WHERE path = ?",
+                (str(relpath),),
+            ).fetchall()
+        return {(page, idx): (point_id, chunk_hash) for page, idx, point_id, chunk_hash in rows}
+
+    def set_chunk_manifest(self, relpath: Path, manifest: Dict[Tuple[int, int], Tuple[str, str]]):
+        """
+        Replace the chunks recorded in Qdrant for the given path
+
+        Args:
+            relpath: Path to a file that has already been processed
+            manifest: A dictionary giving, for each (page, chunk index), the Qdrant point ID and
+                the hash of the chunk text
+
+        """
+        with self.__lock, self.__conn:
+            self.__conn.execute("DELETE FROM chunks WHERE path = ?", (str(relpath),))
+            self.__conn.executemany(
+                "INSERT INTO chunks (path, page, chunk_index, point_id, chunk_hash) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (str(relpath), page, idx, point_id, chunk_hash)
+                    for (page, idx), (point_id, chunk_hash) in manifest.items()
+                ],
+            )
+
+    def list_stored_files(self, absolute: bool = False) -> list[Path]:
+        """
+        List all paths stored in the database
+
+        Args:
+            absolute: True to return absolute paths
+
+        Returns:
+            The list of all paths stored in the database
+
+        """
+        with self.__lock:
+            rows = self.__conn.execute("SELECT path FROM files").fetchall()
+
+        files_list = []
+        for (stored_path,) in rows:
+            relpath = Path(stored_path)
+            if absolute:
+                files_list.append(config.DOCS_PATH / relpath)
+            else:
+                files_list.append(relpath)
+
+        return files_list
+
+    def load_vocabulary(self) -> Dict[str, int]:
+        """
+        Get the vocabulary of the sparse lexical vectors
+
+        Returns:
+            A dictionary giving the ID of each token
+
+        """
+        with self.__lock:
+            rows = self.__conn.execute("SELECT token, token_id FROM vocabulary").fetchall()
+        return dict(rows)
+
+    def add_tokens(self, tokens: Iterable[str]) -> Dict[str, int]:
+        """
+        Adds tokens to the vocabulary of the sparse lexical vectors, in one transaction
+
+        Args:
+            tokens: The tokens to add. Tokens already in the vocabulary keep their ID
+
+        Returns:
+            A dictionary giving the ID of each token
+
+        """
+        rows = [(token,) for token in tokens]
+        with self.__lock, self.__conn:
+            self.__conn.executemany("INSERT OR IGNORE INTO vocabulary (token) VALUES (?)", rows)
+            ids = {}
+            # Stay below the default limit of 999 parameters per query
+            for k in range(0, len(rows), 500):
+                batch = [token for (token,) in rows[k : k + 500]]
+                ids.update(
+                    self.__conn.execute(
+                        "SELECT token, token_id FROM vocabulary WHERE token IN "
+                        f"({','.join('?' * len(batch))})",
+                        batch,
+                    ).fetchall()
+                )
+        return ids
+
+    def get_lexical_stats(self) -> Tuple[int, int]:
+        """
+        Get the statistics of the points with a sparse lexical vector
+
+        Returns:
+            The number of points, and their total number of tokens
+
+        """
+        with self.__lock:
+            stats = dict(self.__conn.execute("SELECT name, value FROM lexical_stats").fetchall())
+        return stats.get("chunks", 0), stats.get("tokens", 0)
+
+    def set_chunk_lengths(self, lengths: Iterable[Tuple[str, Path, int]]):
+        """
+        Records the number of tokens of points with a sparse vector, and updates the statistics
+        of the sparse lexical vectors, in one transaction. A point already recorded is replaced
+
+        Args:
+            lengths: Iterable of (point ID, path of the file, number of tokens) tuples
+
+        """
+        rows = {str(point_id): (str(path), nb_tokens) for point_id, path, nb_tokens in lengths}
+        point_ids = list(rows)
+        with self.__lock, self.__conn:
+            old = self.__select_chunk_lengths(point_ids)
+            self.__conn.executemany(
+                "INSERT INTO chunk_lengths (point_id, path, nb_tokens) VALUES (?, ?, ?) "
+                "ON CONFLICT(point_id) DO UPDATE SET "
+                "path = excluded.path, nb_tokens = excluded.nb_tokens",
+                [(point_id, path, nb_tokens) for point_id, (path, nb_tokens) in rows.items()],
+            )
+            self.__add_lexical_stats(
+                len(rows) - len(old),
+                sum(nb_tokens for _, nb_tokens in rows.values()) - sum(old.values()),
+            )
+
+    def delete_chunk_lengths(self, point_ids: Iterable[str]):
+        """
+        Removes deleted points from the statistics of the sparse lexical vectors
+
+        Args:
+            point_ids: IDs of the deleted points
+
+        """
+        point_ids = list({str(point_id) for point_id in point_ids})
+        with self.__lock, self.__conn:
+            old = self.__select_chunk_lengths(point_ids)
+            self.__conn.executemany(
+                "DELETE FROM chunk_lengths WHERE point_id = ?", [(point_id,) for point_id in old]
+            )
+            self.__add_lexical_stats(-len(old), -sum(old.values()))
+
+    def delete_source_chunk_lengths(self, path: Optional[Path] = None):
+        """
+        Removes the points of a file from the statistics of the sparse lexical vectors
+
+        Args:
+            path: Path of the file, as recorded with the lengths. None removes all the points
+
+        """
+        where, args = ("", ()) if path is None else (" WHERE path = ?", (str(path),))
+        with self.__lock, self.__conn:
+            nb_chunks, nb_tokens = self.__conn.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(nb_tokens), 0) FROM chunk_lengths{where}", args
+            ).fetchone()
+            self.__conn.execute(f"DELETE FROM chunk_lengths{where}", args)
+            self.__add_lexical_stats(-nb_chunks, -nb_tokens)
+
+    def rename_chunk_lengths(self, renames: Iterable[Tuple[str, str, Path]]):
+        """
+        Moves the recorded lengths of points copied under a new ID and a new path
+
+        Args:
+            renames: Iterable of (old point ID, new point ID, new path) tuples
+
+        """
+        renames = [(str(old_id), str(new_id), str(path)) for old_id, new_id, path in renames]
+        with self.__lock, self.__conn:
+            # Points replaced by the renamed ones
+            replaced = self.__select_chunk_lengths([new_id for _, new_id, _ in renames])
+            self.__conn.executemany(
+                "DELETE FROM chunk_lengths WHERE point_id = ?",
+                [(point_id,) for point_id in replaced],
+            )
+            self.__add_lexical_stats(-len(replaced), -sum(replaced.values()))
+            self.__conn.executemany(
+                "UPDATE chunk_lengths SET point_id = ?, path = ? WHERE point_id = ?",
+                [(new_id, path, old_id) for old_id, new_id, path in renames],
+            )
+
+    def __select_chunk_lengths(self, point_ids: List[str]) -> Dict[str, int]:
+        lengths = {}
+        # Stay below the default limit of 999 parameters per query
+        for k in range(0, len(point_ids), 500):
+            batch = point_ids[k : k + 500]
+            lengths.update(
+                self.__conn.execute(
+                    "SELECT point_id, nb_tokens FROM chunk_lengths WHERE point_id IN "
+                    f"({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+            )
+        return lengths
+
+    def __add_lexical_stats(self, nb_chunks: int, nb_tokens: int):
+        self.__conn.executemany(
+            "INSERT INTO lexical_stats (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            [("chunks", nb_chunks), ("tokens", nb_tokens)],
+        )
@@ -0,0 +1,393 @@
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+
+from . import logger
+from .config import config
+
+
+# Buckets of the duration histograms, in seconds. OCR and extraction of large files may take
+# much longer than the usual Prometheus defaults
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Buckets of the search latency, finer around the usual p99 targets
+SEARCH_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(labelnames: Tuple[str, ...], labelvalues: Tuple[str, ...]) -> str:
+    if not labelnames:
+        return ""
+    pairs = []
+    for name, value in zip(labelnames, labelvalues):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class AMetric:
+    """
+    Base class of the metrics. A metric holds one value per combination of label values
+
+    Args:
+        name: Name of the metric
+        help: Description of the metric
+        labelnames: Names of the labels of the metric
+
+    """
+
+    type_name = ""
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric '{self.name}' expects labels {self.labelnames}, got {labels}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        """
+        Current values of the metric
+
+        Returns:
+            A list of (suffix of the sample name, formatted labels, value) tuples
+
+        """
+        raise NotImplementedError
+
+    def render(self) -> str:
+        """
+        Renders the metric in the Prometheus text exposition format
+
+        Returns:
+            The HELP and TYPE lines, followed by one line per sample
+
+        """
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type_name}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class Counter(AMetric):
+    """A value that only goes up, like a number of processed files"""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self.__values: Dict[Tuple[str, ...], float] = {}
+        if not self.labelnames:
+            self.__values[()] = 0.0
+
+    def inc(self, amount: float = 1.0, **labels):
+        """
+        Increments the counter
+
+        Args:
+            amount: Value added to the counter
+            labels: Values of the labels of the metric
+
+        """
+        key = self._key(labels)
+        with self._lock:
+            self.__values[key] = self.__values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        """
+        Current value of the counter
+
+        Args:
+            labels: Values of the labels of the metric
+
+        Returns:
+            The value of the counter
+
+        """
+        with self._lock:
+            return self.__values.get(self._key(labels), 0.0)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        with self._lock:
+            return [
+                ("", _format_labels(self.labelnames, key), value)
+                for key, value in sorted(self.__values.items())
+            ]
+
+
+class Gauge(AMetric):
+    """
+    A value that goes up and down. Instead of being set, the value can be read from a function
+    each time the metrics are collected, like the size of a queue
+
+    """
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.__value = 0.0
+        self.__function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float):
+        """
+        Sets the value of the gauge
+
+        Args:
+            value: The new value
+
+        """
+        with self._lock:
+            self.__value = value
+
+    def set_function(self, function: Optional[Callable[[], float]]):
+        """
+        Sets the function called to read the value of the gauge when the metrics are collected
+
+        Args:
+            function: Function without arguments returning the value. None to use the value
+                given to `Gauge.set`
+
+        """
+        with self._lock:
+            self.__function = function
+
+    def value(self) -> float:
+        """
+        Current value of the gauge
+
+        Returns:
+            The value of the gauge
+
+        """
+        with self._lock:
+            function = self.__function
+            value = self.__value
+        if function is not None:
+            try:
+                value = function()
+            except Exception as e:
+                logger.warning(f"[METRICS] Cannot read the value of '{self.name}': {e}")
+        return value
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        return [("", "", self.value())]
+
+
+class Histogram(AMetric):
+    """
+    Distribution of observed values, like durations, counted in cumulative buckets
+
+    Args:
+        name: Name of the metric
+        help: Description of the metric
+        buckets: Upper bounds of the buckets, in increasing order
+
+    """
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = DURATION_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.__counts = [0] * len(self.buckets)
+        self.__sum = 0.0
+
+    def observe(self, value: float):
+        """
+        Records a value
+
+        Args:
+            value: The observed value
+
+        """
+        with self._lock:
+            self.__sum += value
+            for k, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.__counts[k] += 1
+                    break
+
+    @contextmanager
+    def time(self):
+        """Context manager that observes the time spent in its body, in seconds"""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0)
+
+    def count(self) -> int:
+        """
+        Number of observed values
+
+        Returns:
+            The number of calls to `Histogram.observe`
+
+        """
+        with self._lock:
+            return sum(self.__counts)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        with self._lock:
+            counts = list(self.__counts)
+            total = self.__sum
+        samples = []
+        cumulated = 0
+        for bound, nb in zip(self.buckets, counts):
+            cumulated += nb
+            samples.append(("_bucket", f'{{le="{_format_value(bound)}"}}', cumulated))
+        samples.append(("_sum", "", total))
+        samples.append(("_count", "", cumulated))
+        return samples
+
+
+class MetricsRegistry:
+    """Set of metrics exposed together"""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__metrics: Dict[str, AMetric] = {}
+
+    def register(self, metric: AMetric) -> AMetric:
+        """
+        Adds a metric to the registry
+
+        Args:
+            metric: The metric to add
+
+        Returns:
+            The metric
+
+        """
+        with self.__lock:
+            if metric.name in self.__metrics:
+                raise ValueError(f"Metric '{metric.name}' is already registered")
+            self.__metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """
+        Renders all the metrics in the Prometheus text exposition format
+
+        Returns:
+            The text served on the /metrics endpoint
+
+        """
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+        return "".join(metric.render() for metric in metrics)
+
+
+REGISTRY = MetricsRegistry()
+
+PAGE_EXTRACTION_SECONDS = REGISTRY.register(
+    Histogram("ragindexer_page_extraction_seconds", "Time to extract the raw text of a page")
+)
+OCR_PAGE_SECONDS = REGISTRY.register(
+    Histogram("ragindexer_ocr_page_seconds", "Time to OCR a page, rendering included")
+)
+CHUNKING_SECONDS = REGISTRY.register(
+    Histogram("ragindexer_chunking_seconds", "Time to split the text of a page into chunks")
+)
+ENCODE_SECONDS = REGISTRY.register(
+    Histogram("ragindexer_encode_seconds", "Time to encode a batch of chunks")
+)
+UPSERT_SECONDS = REGISTRY.register(
+    Histogram("ragindexer_upsert_seconds", "Time to upload a batch of points to Qdrant")
+)
+SEARCH_SECONDS = REGISTRY.register(
+    Histogram("ragindexer_search_seconds", "Time to answer a search query", buckets=SEARCH_BUCKETS)
+)
+
+FILES = REGISTRY.register(Counter("ragindexer_files_total", "Files indexed"))
+PAGES = REGISTRY.register(Counter("ragindexer_pages_total", "Pages extracted"))
+CHUNKS = REGISTRY.register(Counter("ragindexer_chunks_total", "Chunks produced"))
+OCR_PAGES = REGISTRY.register(Counter("ragindexer_ocr_pages_total", "Pages OCRed"))
+OCR_BLANK_PAGES = REGISTRY.register(
+    Counter("ragindexer_ocr_blank_pages_total", "Blank pages not given to tesseract")
+)
+ERRORS = REGISTRY.register(
+    Counter("ragindexer_errors_total", "Errors, by pipeline stage", labelnames=("stage",))
+)
+SEARCH_CACHE = REGISTRY.register(
+    Counter(
+        "ragindexer_search_cache_total",
+        "Lookups in the caches of the search service",
+        labelnames=("cache", "result"),
+    )
+)
+WORK_ITEMS = REGISTRY.register(
+    Counter(
+        "ragindexer_work_items_total",
+        "Files of the work queue handled by this worker, by result",
+        labelnames=("result",),
+    )
+)
+
+WATCHER_BACKLOG = REGISTRY.register(
+    Gauge("ragindexer_watcher_backlog", "Filesystem events waiting to be dispatched")
+)
+QDRANT_REQUESTS_IN_FLIGHT = REGISTRY.register(
+    Gauge("ragindexer_qdrant_requests_in_flight", "Batches of points being sent to Qdrant")
+)
+EMBEDDING_BATCH_SIZE = REGISTRY.register(
+    Gauge("ragindexer_embedding_batch_size", "Number of chunks of the last encoded batch")
+)
+QUERY_BATCH_SIZE = REGISTRY.register(
+    Gauge("ragindexer_query_batch_size", "Number of queries of the last encoded batch")
+)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are too frequent to be logged
+        pass
+
+
+def start_metrics_server(
+    port: int = config.METRICS_PORT, addr: str = config.METRICS_ADDR
+) -> ThreadingHTTPServer:
+    """
+    Serves the metrics in the Prometheus text format on http://addr:port/metrics,
+    from a daemon thread
+
+    Args:
+        port: Port of the HTTP server. 0 picks a free port
+        addr: Address the server listens on
+
+    Returns:
+        The HTTP server. Call its shutdown method to stop it
+
+    """
+    server = ThreadingHTTPServer((addr, port), _MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    logger.info(f"[METRICS] Serving metrics on http://{addr}:{server.server_address[1]}/metrics")
+    return server
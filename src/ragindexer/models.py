@@ -1,8 +1,12 @@
-from typing import List
+import numpy as np
+import numpy.typing as npt
 
 
 # Definition of a chunk
 ChunkType = str
 
-# Definition of an embedding
-EmbeddingType = List[float]
+# Definition of an embedding: a float32 vector
+EmbeddingType = npt.NDArray[np.float32]
+
+# Embeddings of a list of chunks: a contiguous float32 array, with one row per chunk
+EmbeddingBatchType = npt.NDArray[np.float32]
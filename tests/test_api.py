@@ -20,7 +20,7 @@ class TestIngestWatch(unittest.TestCase):
         doc_index = DocumentIndexer()
         doc_index.qdrant.empty_collection()
 
-        config.STATE_DB_PATH.unlink(missing_ok=True)
+        doc_index.state_db.delete_all_files()
 
         tot_nb_files = main(only_initial_scan=True)
         self.assertGreaterEqual(tot_nb_files, 0)
@@ -0,0 +1,59 @@
+import unittest
+
+import nltk
+from sentence_transformers import SentenceTransformer
+
+from ragindexer.config import config
+from ragindexer.documents.AChunker import guess_language
+from ragindexer.documents.CharChunker import CharChunker
+from ragindexer.documents.TokenChunker import TokenChunker
+
+
+TEXT = " ".join(
+    f"Le paragraphe {k} du rapport décrit les résultats obtenus par l'équipe en {2000 + k}."
+    for k in range(200)
+)
+
+
+class TestChunkers(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        nltk.download("punkt_tab", download_dir=config.STATE_DB_PATH.parent / "nltk")
+        nltk.data.path.append(config.STATE_DB_PATH.parent / "nltk")
+        cls.model = SentenceTransformer(
+            config.EMBEDDING_MODEL,
+            trust_remote_code=config.EMBEDDING_MODEL_TRUST_REMOTE_CODE,
+            backend="torch",
+        )
+
+    def test_language(self):
+        self.assertEqual(guess_language(TEXT), "french")
+        self.assertEqual(
+            guess_language("The weather is fine, and it will rain tomorrow"), "english"
+        )
+
+    def test_token_chunker(self):
+        max_tokens = 128
+        chunker = TokenChunker(self.model.tokenizer, max_tokens, overlap_tokens=30)
+        chunks = chunker.chunk(TEXT + " " + 300 * "mot ")
+
+        for chunk in chunks:
+            self.assertLessEqual(len(self.model.tokenizer(chunk)["input_ids"]), max_tokens)
+        self.assertEqual(chunker.stats()["truncation_rate"], 0.0)
+
+        # Consecutive chunks overlap on whole sentences
+        self.assertTrue(chunks[1].startswith(chunks[0].split(". ")[-1][:20]))
+
+    def test_char_chunker(self):
+        chunker = CharChunker(
+            chunk_size=1000, tokenizer=self.model.tokenizer, max_tokens=self.model.max_seq_length
+        )
+        chunks = chunker.chunk(TEXT)
+
+        for chunk in chunks:
+            self.assertLessEqual(len(chunk), 1000 + config.CHUNK_OVERLAP)
+        self.assertEqual(chunker.stats()["chunks"], len(chunks))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from docx import Document
+from docx.enum.text import WD_BREAK
+
+from ragindexer.config import config
+from ragindexer.documents.DocDocument import DocDocument
+
+
+class TestDocDocument(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmpdir.name) / "contract.docx"
+
+        doc = Document()
+        doc.sections[0].header.is_linked_to_previous = False
+        doc.sections[0].header.paragraphs[0].text = "ACME - Confidential"
+        doc.add_heading("Article 1", level=1)
+        doc.add_paragraph("The tenant pays the rent on the first day of each month.")
+        paragraph = doc.add_paragraph("The landlord repairs the roof.")
+        paragraph.add_run().add_break(WD_BREAK.PAGE)
+        paragraph.add_run("The deposit is returned within two months.")
+        # Consecutive breaks do not make empty pages
+        doc.add_paragraph().add_run().add_break(WD_BREAK.PAGE)
+        doc.add_heading("Article 2", level=1)
+        table = doc.add_table(rows=2, cols=2)
+        table.cell(0, 0).text = "Rent"
+        table.cell(0, 1).text = "800 EUR"
+        table.cell(1, 0).merge(table.cell(1, 1)).text = "Charges included"
+        for k in range(20):
+            doc.add_paragraph(f"Clause {k} of the appendix, which is a rather long paragraph.")
+        doc.save(self.path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_pages(self):
+        pages = list(DocDocument(self.path).iterate_raw_text())
+        self.assertEqual([k for k, _, _ in pages], [0, 1, 2, 3])
+
+        self.assertEqual(
+            pages[0][1],
+            "Article 1\nThe tenant pays the rent on the first day of each month.\n"
+            "The landlord repairs the roof.",
+        )
+        self.assertEqual(pages[1][1], "The deposit is returned within two months.")
+        self.assertTrue(pages[2][1].startswith("Article 2\nRent | 800 EUR\nCharges included\n"))
+        self.assertIn("Clause 19 of the appendix", pages[2][1])
+        self.assertEqual(pages[3][1], "ACME - Confidential")
+        self.assertTrue(pages[3][2]["headers_and_footers"])
+
+    def test_sections(self):
+        section_chars = config.DOCX_SECTION_CHARS
+        config.DOCX_SECTION_CHARS = 300
+        try:
+            pages = list(DocDocument(self.path).iterate_raw_text())
+        finally:
+            config.DOCX_SECTION_CHARS = section_chars
+
+        self.assertGreater(len(pages), 4)
+        for _, text, _ in pages:
+            self.assertLessEqual(len(text), 300)
+        all_text = "\n".join(text for _, text, _ in pages)
+        for k in range(20):
+            self.assertEqual(all_text.count(f"Clause {k} of"), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
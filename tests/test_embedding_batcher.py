@@ -0,0 +1,44 @@
+import unittest
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+from ragindexer.config import config
+from ragindexer.documents.EmbeddingBatcher import EmbeddingBatcher
+
+
+class TestEmbeddingBatcher(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model = SentenceTransformer(
+            config.EMBEDDING_MODEL,
+            trust_remote_code=config.EMBEDDING_MODEL_TRUST_REMOTE_CODE,
+            backend="torch",
+        )
+
+    def test_owners(self):
+        pages = [
+            (("a.pdf", 0), ["Aujourd'hui, le temps est beau.", "Il pleuvra demain."]),
+            (("a.pdf", 1), []),
+            (("b.docx", 0), ["Master raven on a perched tree"]),
+            (("b.docx", 1), ["Maintenant, il y a du soleil, mais demain ce sera un mauvais temps"]),
+        ]
+        batcher = EmbeddingBatcher(self.model, max_chunks=3, max_chars=10_000)
+        results = list(batcher.embed_pages(pages))
+
+        self.assertEqual([owner for owner, _, _ in results], [owner for owner, _ in pages])
+        for (_, chunks), (_, res_chunks, embeddings) in zip(pages, results):
+            self.assertEqual(chunks, res_chunks)
+            self.assertEqual(len(chunks), len(embeddings))
+            if chunks:
+                expected = self.model.encode(chunks, device="cpu", show_progress_bar=False)
+                np.testing.assert_allclose(embeddings, expected, atol=1e-4)
+
+        stats = batcher.stats()
+        self.assertEqual(stats["chunks"], 4)
+        self.assertEqual(stats["batches"], 2)
+        self.assertGreater(batcher.throughput(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+from pathlib import Path
+import tempfile
+import unittest
+
+import numpy as np
+
+from ragindexer.EmbeddingCache import EmbeddingCache
+
+
+def fake_encode(chunks):
+    return np.array([[len(chunk), 1.0, 2.0, 3.0] for chunk in chunks], dtype=np.float32)
+
+
+class TestEmbeddingCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = Path(self.tmp_dir.name) / "embeddings_cache.db"
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_hit_miss(self):
+        cache = EmbeddingCache("model", db_path=self.db_path)
+        encoded = []
+
+        def encode(chunks):
+            encoded.extend(chunks)
+            return fake_encode(chunks)
+
+        embeddings = cache.encode(["a", "bb", "a"], encode)
+        np.testing.assert_array_equal(embeddings, fake_encode(["a", "bb", "a"]))
+        self.assertEqual(encoded, ["a", "bb"])
+
+        embeddings = cache.encode(["a", "bb", "ccc"], encode)
+        np.testing.assert_array_equal(embeddings, fake_encode(["a", "bb", "ccc"]))
+        self.assertEqual(embeddings.dtype, np.float32)
+        self.assertEqual(encoded, ["a", "bb", "ccc"])
+
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 4)
+
+        # The cache is persistent, but does not mix models
+        np.testing.assert_array_equal(
+            EmbeddingCache("model", db_path=self.db_path).get_many(["bb"])[0],
+            fake_encode(["bb"])[0],
+        )
+        self.assertEqual(EmbeddingCache("other", db_path=self.db_path).get_many(["bb"]), [None])
+
+    def test_eviction(self):
+        # Room for 10 vectors of 4 float32
+        cache = EmbeddingCache("model", db_path=self.db_path, max_bytes=10 * 16)
+        cache.encode([f"chunk {k}" for k in range(10)], fake_encode)
+
+        # Refresh the first chunk, so that it is not the least recently used anymore
+        cache.get_many(["chunk 0"])
+        cache.encode(["new chunk"], fake_encode)
+
+        self.assertLessEqual(cache.stats()["size"], 10 * 16)
+        self.assertIsNotNone(cache.get_many(["chunk 0"])[0])
+        self.assertIsNone(cache.get_many(["chunk 1"])[0])
+        self.assertIsNotNone(cache.get_many(["new chunk"])[0])
+
+    def test_shared(self):
+        # Each cache has its own connection, like separate processes
+        first = EmbeddingCache("model", db_path=self.db_path, max_bytes=10 * 16)
+        second = EmbeddingCache("model", db_path=self.db_path, max_bytes=10 * 16)
+        first.encode([f"first {k}" for k in range(6)], fake_encode)
+        self.assertEqual(second.stats()["size"], 6 * 16)
+
+        # The vectors stored by the other cache count in the size of the cache, and the least
+        # recently used ones are evicted whichever cache stored them
+        second.encode([f"second {k}" for k in range(6)], fake_encode)
+        self.assertLessEqual(first.stats()["size"], 10 * 16)
+        self.assertEqual(first.stats()["size"], second.stats()["size"])
+        self.assertIsNone(second.get_many(["first 0"])[0])
+        self.assertIsNotNone(first.get_many(["second 5"])[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
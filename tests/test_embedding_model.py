@@ -0,0 +1,108 @@
+import json
+from pathlib import Path
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from ragindexer import embedding_model
+from ragindexer.config import config
+from ragindexer.embedding_model import compare_models, load_embedding_model
+
+
+class StubModel:
+    """Stand-in for SentenceTransformer: the fast backends add `error` to the torch embeddings"""
+
+    error = 0.0
+    fail_backends = ()
+    loaded = []
+
+    def __init__(self, model_name_or_path, backend="torch", model_kwargs=None, **kwargs):
+        if backend in self.fail_backends:
+            raise RuntimeError(f"No {backend} runtime")
+        self.backend = backend
+        self.loaded.append(backend)
+
+    def save_pretrained(self, path: str):
+        (Path(path) / "onnx").mkdir(parents=True, exist_ok=True)
+        (Path(path) / "onnx" / "model.onnx").touch()
+
+    def encode(self, sentences, normalize_embeddings=False, **kwargs):
+        embeddings = np.array([[len(s), 1.0, 0.0] for s in sentences], dtype=np.float32)
+        if self.backend != "torch":
+            embeddings[:, 2] += self.error * embeddings[:, 0]
+        if normalize_embeddings:
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings
+
+
+class TestEmbeddingModel(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.saved = (
+            config.STATE_DB_PATH,
+            config.EMBEDDING_BACKEND,
+            config.EMBEDDING_QUANTIZE,
+            config.EMBEDDING_MIN_COSINE,
+        )
+        config.STATE_DB_PATH = Path(self.tmp_dir.name) / "index_state.db"
+        config.EMBEDDING_BACKEND = "onnx"
+        config.EMBEDDING_QUANTIZE = False
+        config.EMBEDDING_MIN_COSINE = 0.99
+        StubModel.error = 0.0
+        StubModel.fail_backends = ()
+        StubModel.loaded = []
+        patcher = mock.patch.object(embedding_model, "SentenceTransformer", StubModel)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        (
+            config.STATE_DB_PATH,
+            config.EMBEDDING_BACKEND,
+            config.EMBEDDING_QUANTIZE,
+            config.EMBEDDING_MIN_COSINE,
+        ) = self.saved
+        self.tmp_dir.cleanup()
+
+    def test_compare_models(self):
+        sentences = ["a", "bb", "ccc"]
+        self.assertAlmostEqual(compare_models(StubModel("m"), StubModel("m"), sentences), 1.0, 6)
+        StubModel.error = 0.5
+        similarity = compare_models(StubModel("m"), StubModel("m", backend="onnx"), sentences)
+        self.assertLess(similarity, 0.99)
+
+    def test_guardrail_passes(self):
+        StubModel.error = 0.001
+        model, model_id = load_embedding_model()
+        self.assertEqual(model.backend, "onnx")
+        self.assertEqual(model_id, f"{config.EMBEDDING_MODEL}@onnx")
+
+        # The result of the check is stored with the exported model, and not computed again
+        check_path = next(embedding_model.model_cache_folder().glob("*-onnx/guardrail.json"))
+        with open(check_path) as f:
+            self.assertGreaterEqual(json.load(f)["onnx/model.onnx"], 0.99)
+        StubModel.loaded = []
+        model, _ = load_embedding_model()
+        self.assertEqual(StubModel.loaded, ["onnx"])
+
+    def test_guardrail_fails(self):
+        StubModel.error = 0.5
+        model, model_id = load_embedding_model()
+        self.assertEqual(model.backend, "torch")
+        self.assertEqual(model_id, config.EMBEDDING_MODEL)
+
+        # The stored result of the check also falls back to torch
+        model, _ = load_embedding_model()
+        self.assertEqual(model.backend, "torch")
+
+    def test_backend_unavailable(self):
+        StubModel.fail_backends = ("onnx",)
+        model, model_id = load_embedding_model()
+        self.assertEqual(model.backend, "torch")
+        self.assertEqual(model_id, config.EMBEDDING_MODEL)
+
+
+if __name__ == "__main__":
+    unittest.main()
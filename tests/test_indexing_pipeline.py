@@ -0,0 +1,160 @@
+from pathlib import Path
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from ragindexer.config import config
+from ragindexer.index_database import StateDB
+from ragindexer.IndexingPipeline import IndexingPipeline
+
+
+class FakeDocument:
+    # Events set when the extraction of a file starts, and waited for before it goes on, by name
+    gates = {}
+
+    def __init__(self, filepath: Path, content_hash=None):
+        self.filepath = filepath
+
+    def iterate_pages(self):
+        text = self.filepath.read_text()
+        if self.filepath.name in self.gates:
+            started, release = self.gates[self.filepath.name]
+            started.set()
+            release.wait(5)
+        yield 0, text, {}
+
+    def chunk_text(self, text: str, chunker=None):
+        return text.split()
+
+
+class FakeBatcher:
+    def embed_pages(self, pages):
+        for owner, chunks in pages:
+            yield owner, chunks, np.ones((len(chunks), 4), dtype=np.float32)
+
+    def stats(self):
+        return {"chunks_per_second": 0.0}
+
+
+class FakeChunker:
+    def stats(self):
+        return {"truncated": 0, "chunks": 0, "truncation_rate": 0.0}
+
+
+class FakeDocFactory:
+    def getBuild(self, suffix: str):
+        return FakeDocument
+
+    def get_chunker(self):
+        return FakeChunker()
+
+    def get_batcher(self):
+        return FakeBatcher()
+
+    def get_embedding_cache(self):
+        return None
+
+
+class FakeQdrant:
+    def __init__(self):
+        self.points = {}
+
+    def record_embeddings(self, k_page, chunks, embeddings, file_metadata, **kwargs):
+        for idx, chunk in zip(kwargs["chunk_indices"], chunks):
+            self.points[(str(file_metadata["abspath"]), k_page, idx)] = chunk
+
+    def flush(self, filepath=None) -> bool:
+        return True
+
+    def delete(self, ids):
+        pass
+
+    def delete_by_source(self, filepath: Path):
+        self.points = {key: v for key, v in self.points.items() if key[0] != str(filepath)}
+
+    def rename_sources(self, renames):
+        renames = {str(old): str(new) for old, new in renames}
+        self.points = {
+            (renames.get(source, source), *slot): v for (source, *slot), v in self.points.items()
+        }
+
+
+class TestIndexingPipeline(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.docs = Path(self.tmp_dir.name)
+        self.saved = config.INCREMENTAL_REINDEX
+        config.INCREMENTAL_REINDEX = True
+        self.state_db = StateDB(self.docs / "state" / "index_state.db")
+        self.qdrant = FakeQdrant()
+        self.pipeline = IndexingPipeline(FakeDocFactory(), self.qdrant, self.state_db)
+        self.pipeline.start()
+
+    def tearDown(self):
+        FakeDocument.gates = {}
+        self.pipeline.stop()
+        self.state_db.close()
+        config.INCREMENTAL_REINDEX = self.saved
+        self.tmp_dir.cleanup()
+
+    def test_index(self):
+        path = self.docs / "a.txt"
+        path.write_text("one two three")
+        job = self.pipeline.submit(path)
+        self.assertTrue(job.wait(5))
+        self.assertFalse(job.failed)
+        self.assertEqual(len(self.qdrant.points), 3)
+        self.assertIsNotNone(self.state_db.get_stored_timestamp(path))
+
+    def test_complete_failure(self):
+        path = self.docs / "a.txt"
+        path.write_text("one two three")
+        with mock.patch.object(
+            self.state_db, "set_chunk_manifest", side_effect=RuntimeError("disk full")
+        ):
+            job = self.pipeline.submit(path)
+
+            # The job is finished as failed, and the pipeline does not hang
+            waiter = threading.Thread(target=self.pipeline.wait_idle, daemon=True)
+            waiter.start()
+            waiter.join(5)
+            self.assertFalse(waiter.is_alive())
+        self.assertTrue(job.wait(0))
+        self.assertTrue(job.failed)
+        self.assertIsNone(self.state_db.get_stored_timestamp(path))
+
+        # The file can be indexed again
+        job = self.pipeline.submit(path)
+        self.assertTrue(job.wait(5))
+        self.assertFalse(job.failed)
+
+    def test_rename_during_indexing(self):
+        old, new = self.docs / "a.txt", self.docs / "b.txt"
+        old.write_text("one two three")
+        started, release = threading.Event(), threading.Event()
+        FakeDocument.gates = {"a.txt": (started, release)}
+        job = self.pipeline.submit(old)
+        self.assertTrue(started.wait(5))
+        old.rename(new)
+
+        # The renaming waits for the indexation of the old path
+        renaming = threading.Thread(
+            target=self.pipeline.submit, args=(new,), kwargs={"moved_from": old}
+        )
+        renaming.start()
+        renaming.join(0.2)
+        self.assertTrue(renaming.is_alive())
+        release.set()
+        renaming.join(5)
+        self.pipeline.wait_idle()
+
+        self.assertFalse(job.failed)
+        self.assertEqual(self.state_db.list_stored_files(), [new])
+        self.assertEqual({source for source, _, _ in self.qdrant.points}, {str(new)})
+
+
+if __name__ == "__main__":
+    unittest.main()
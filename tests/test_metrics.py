@@ -0,0 +1,61 @@
+import unittest
+import urllib.error
+import urllib.request
+
+from ragindexer.metrics import (
+    Counter,
+    Gauge,
+    Histogram,
+    MetricsRegistry,
+    start_metrics_server,
+)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        registry = MetricsRegistry()
+        errors = registry.register(Counter("errors_total", "Errors", labelnames=("stage",)))
+        backlog = registry.register(Gauge("backlog", "Backlog"))
+        durations = registry.register(Histogram("duration_seconds", "Durations", (0.1, 1.0)))
+
+        errors.inc(stage="ocr")
+        errors.inc(2, stage="embed")
+        backlog.set_function(lambda: 7)
+        for value in (0.05, 0.5, 0.7, 3.0):
+            durations.observe(value)
+
+        text = registry.render()
+        self.assertIn("# TYPE errors_total counter", text)
+        self.assertIn('errors_total{stage="embed"} 2', text)
+        self.assertIn('errors_total{stage="ocr"} 1', text)
+        self.assertIn("backlog 7", text)
+        self.assertIn('duration_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('duration_seconds_bucket{le="1"} 3', text)
+        self.assertIn('duration_seconds_bucket{le="+Inf"} 4', text)
+        self.assertIn("duration_seconds_sum 4.25", text)
+        self.assertIn("duration_seconds_count 4", text)
+
+        with self.assertRaises(ValueError):
+            errors.inc()
+        with self.assertRaises(ValueError):
+            registry.register(Gauge("backlog", "Backlog"))
+
+    def test_server(self):
+        server = start_metrics_server(port=0, addr="127.0.0.1")
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}"
+            with urllib.request.urlopen(f"{url}/metrics") as response:
+                self.assertEqual(response.status, 200)
+                text = response.read().decode("utf-8")
+            self.assertIn("# TYPE ragindexer_files_total counter", text)
+            self.assertIn("# TYPE ragindexer_encode_seconds histogram", text)
+
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(f"{url}/other")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+from pathlib import Path
+import random
+import sqlite3
+import tempfile
+import unittest
+
+from ragindexer.OcrCache import OcrCache
+
+
+class TestOcrCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = Path(self.tmp_dir.name) / "ocr_cache.db"
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_pages(self):
+        cache = OcrCache(db_path=self.db_path)
+        self.assertIsNone(cache.get_ocr_pages("abc"))
+        cache.set_ocr_pages("abc", [0, 2])
+        cache.put_page("abc", 0, "Première page", {"ocr_dpi": 150, "ocr_confidence": 91.5})
+        cache.put_page("abc", 2, "")
+        cache.close()
+
+        # The cache persists, and only depends on the content hash
+        cache = OcrCache(db_path=self.db_path)
+        self.assertEqual(cache.get_ocr_pages("abc"), [0, 2])
+        self.assertEqual(
+            cache.get_pages("abc", [0, 1, 2]),
+            {0: ("Première page", {"ocr_dpi": 150, "ocr_confidence": 91.5}), 2: ("", {})},
+        )
+        self.assertEqual(cache.get_pages("def", [0]), {})
+        self.assertEqual(cache.stats()["hits"], 2)
+        self.assertEqual(cache.stats()["misses"], 2)
+        cache.close()
+
+    def test_eviction(self):
+        # Random text, that zlib does not compress much
+        text = random.Random(0).randbytes(500).hex()
+        cache = OcrCache(db_path=self.db_path, max_bytes=2000)
+        for k in range(10):
+            cache.set_ocr_pages(f"doc{k}", [0])
+            cache.put_page(f"doc{k}", 0, text + str(k))
+            self.assertLessEqual(cache.stats()["size"], 2000)
+
+        # The most recent file is kept, the oldest ones are evicted
+        self.assertEqual(cache.get_pages("doc9", [0]), {0: (text + "9", {})})
+        self.assertIsNone(cache.get_ocr_pages("doc0"))
+        cache.close()
+
+    def test_shared(self):
+        text = random.Random(0).randbytes(500).hex()
+        # Each cache has its own connection, like separate processes
+        caches = [OcrCache(db_path=self.db_path, max_bytes=2000) for _ in range(2)]
+        for k in range(10):
+            cache = caches[k % 2]
+            cache.set_ocr_pages(f"doc{k}", [0])
+            cache.put_page(f"doc{k}", 0, text + str(k))
+            self.assertLessEqual(caches[0].stats()["size"], 2000)
+            self.assertEqual(caches[0].stats()["size"], caches[1].stats()["size"])
+
+        # The least recently used files are evicted whichever cache stored them
+        self.assertIsNone(caches[1].get_ocr_pages("doc0"))
+        self.assertEqual(caches[0].get_pages("doc9", [0]), {0: (text + "9", {})})
+        for cache in caches:
+            cache.close()
+
+    def test_legacy_schema(self):
+        # Caches written before the OCR information was stored have no info column
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("CREATE TABLE pages (doc_hash TEXT, page INTEGER, text BLOB)")
+        conn.commit()
+        conn.close()
+
+        cache = OcrCache(db_path=self.db_path)
+        cache.put_page("abc", 0, "Texte", {"ocr_dpi": 300})
+        self.assertEqual(cache.get_pages("abc", [0]), {0: ("Texte", {"ocr_dpi": 300})})
+        cache.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+from unittest.mock import patch
+
+from PIL import Image, ImageDraw
+
+from ragindexer.config import config
+from ragindexer.documents.OcrEngine import dpi_ladder, is_blank_page, ocr_image
+
+
+class TestOcrEngine(unittest.TestCase):
+    def setUp(self):
+        self.adaptive = config.OCR_ADAPTIVE
+        self.ladder = config.OCR_DPI_LADDER
+
+    def tearDown(self):
+        config.OCR_ADAPTIVE = self.adaptive
+        config.OCR_DPI_LADDER = self.ladder
+
+    def test_dpi_ladder(self):
+        config.OCR_ADAPTIVE = True
+        config.OCR_DPI_LADDER = "300, 150"
+        self.assertEqual(dpi_ladder(), [150, 300])
+
+        config.OCR_ADAPTIVE = False
+        self.assertEqual(dpi_ladder(), [config.OCR_DPI])
+
+    def test_blank_page(self):
+        img = Image.new("RGB", (200, 300), "white")
+        self.assertTrue(is_blank_page(img, 0.002))
+
+        # A few specks of dust
+        draw = ImageDraw.Draw(img)
+        draw.point([(10, 10), (50, 60)], fill="black")
+        self.assertTrue(is_blank_page(img, 0.002))
+
+        draw.rectangle((20, 20, 120, 40), fill="black")
+        self.assertFalse(is_blank_page(img, 0.002))
+
+    def test_ocr_image(self):
+        data = {
+            "text": ["", "Hello", "world", "Second", "line", "", "Other"],
+            "conf": [-1, 90, 80, 70, 60, -1, 100],
+            "block_num": [1, 1, 1, 1, 1, 1, 2],
+            "par_num": [1, 1, 1, 1, 1, 1, 1],
+            "line_num": [1, 1, 1, 2, 2, 2, 1],
+        }
+        img = Image.new("RGB", (10, 10), "white")
+        with patch("pytesseract.image_to_data", return_value=data):
+            text, confidence = ocr_image(img, "eng", "--psm 3")
+
+        self.assertEqual(text, "Hello world\nSecond line\n\nOther")
+        self.assertAlmostEqual(confidence, 80.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
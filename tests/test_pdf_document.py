@@ -0,0 +1,96 @@
+from concurrent.futures import Future
+from pathlib import Path
+import tempfile
+import unittest
+from unittest import mock
+
+from ragindexer.config import config
+from ragindexer.documents import ADocument as a_document
+from ragindexer.documents import PdfDocument as pdf_document
+from ragindexer.documents.OcrEngine import OcrEngine, OcrTask
+from ragindexer.documents.PdfDocument import PdfDocument
+from ragindexer.documents.PdfTextExtractor import PdfTextExtractor
+from ragindexer.OcrCache import OcrCache
+
+
+class FakeReader:
+    def __init__(self, path):
+        self.pages = [None] * 5
+
+
+class TestPdfDocument(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(__file__).parent / "inputs" / "docs" / "Marina Robledo.pdf"
+        self.cache = OcrCache(db_path=Path(self.tmp_dir.name) / "ocr_cache.db")
+        self.saved = config.MIN_EXPECTED_CHAR
+        config.MIN_EXPECTED_CHAR = 10
+
+        # Pages 1 and 2 have no text layer
+        self.texts = ["Text of page 0", "", "", "Text of page 3", "Text of page 4"]
+        self.nb_read = 0
+        self.ocr_submits = []
+
+        for patcher in [
+            mock.patch.object(pdf_document, "PdfReader", FakeReader),
+            mock.patch.object(pdf_document, "get_ocr_cache", lambda: self.cache),
+            mock.patch.object(PdfTextExtractor, "iterate_pages", self.read_pages),
+            mock.patch.object(OcrEngine, "submit", self.submit_ocr),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        config.MIN_EXPECTED_CHAR = self.saved
+        self.cache.close()
+        self.tmp_dir.cleanup()
+
+    def read_pages(self, path, k_pages):
+        for k_page in k_pages:
+            self.nb_read += 1
+            yield k_page, self.texts[k_page], False
+
+    def submit_ocr(self, path, k_pages):
+        self.ocr_submits.append((k_pages, self.nb_read))
+        future = Future()
+        future.set_result(
+            [
+                {"text": f"OCR of page {k - 1}", "ocr_dpi": 300, "ocr_confidence": 90.0}
+                for k in k_pages
+            ]
+        )
+        return [OcrTask(k_pages[0], k_pages[-1], future)]
+
+    def test_streaming(self):
+        pages = iter(PdfDocument(self.path).iterate_raw_text())
+
+        # The first page is yielded before the next ones are read
+        self.assertEqual(next(pages), (0, "Text of page 0", {"ocr_used": False}))
+        self.assertEqual(self.nb_read, 1)
+
+        # The consecutive pages without text are OCRed together, as soon as the run ends
+        rest = list(pages)
+        self.assertEqual(self.ocr_submits, [([2, 3], 4)])
+        self.assertEqual([k_page for k_page, _, _ in rest], [1, 2, 3, 4])
+        self.assertEqual(
+            rest[0],
+            (1, "OCR of page 1", {"ocr_used": True, "ocr_dpi": 300, "ocr_confidence": 90.0}),
+        )
+
+        # Indexed again, the OCR pages are read from the cache, and their text layer not probed
+        self.nb_read = 0
+        pages = list(PdfDocument(self.path).iterate_raw_text())
+        self.assertEqual([text for _, text, _ in pages], [text for _, text, _ in [pages[0]] + rest])
+        self.assertEqual(self.nb_read, 3)
+        self.assertEqual(len(self.ocr_submits), 1)
+
+    def test_content_hash(self):
+        # The hash computed by the indexing pipeline is reused, and the file not hashed again
+        with mock.patch.object(a_document, "file_hash") as hasher:
+            list(PdfDocument(self.path, "0123abcd").iterate_raw_text())
+        hasher.assert_not_called()
+        self.assertEqual(self.cache.get_ocr_pages("0123abcd"), [1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
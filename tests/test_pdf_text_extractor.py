@@ -0,0 +1,46 @@
+import unittest
+from pathlib import Path
+
+from pypdf import PdfReader
+
+from ragindexer.config import config
+from ragindexer.documents.PdfTextExtractor import PdfTextExtractor
+
+
+class TestPdfTextExtractor(unittest.TestCase):
+    def setUp(self):
+        self.path = Path(__file__).parent / "inputs" / "docs" / "Marina Robledo.pdf"
+        self.k_pages = list(range(len(PdfReader(self.path).pages)))
+        self.settings = (
+            config.PDF_TEXT_WORKERS,
+            config.PDF_PAGES_PER_TASK,
+            config.PDF_PAGE_TIMEOUT,
+        )
+
+    def tearDown(self):
+        config.PDF_TEXT_WORKERS, config.PDF_PAGES_PER_TASK, config.PDF_PAGE_TIMEOUT = self.settings
+
+    def test_workers(self):
+        config.PDF_TEXT_WORKERS = 0
+        expected = list(PdfTextExtractor().iterate_pages(self.path, self.k_pages))
+
+        config.PDF_TEXT_WORKERS = 2
+        config.PDF_PAGES_PER_TASK = 1
+        pages = list(PdfTextExtractor().iterate_pages(self.path, self.k_pages))
+        self.assertEqual(pages, expected)
+        self.assertEqual([k for k, _, _ in pages], self.k_pages)
+
+    def test_timeout(self):
+        config.PDF_TEXT_WORKERS = 2
+        # Too short for any worker to answer
+        config.PDF_PAGE_TIMEOUT = 1e-6
+        pages = list(PdfTextExtractor().iterate_pages(self.path, self.k_pages))
+        self.assertEqual(pages, [(k, None, True) for k in self.k_pages])
+
+        config.PDF_PAGE_TIMEOUT = 30.0
+        pages = list(PdfTextExtractor().iterate_pages(self.path, self.k_pages))
+        self.assertFalse(any(failed for _, _, failed in pages))
+
+
+if __name__ == "__main__":
+    unittest.main()
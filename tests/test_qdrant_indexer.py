@@ -0,0 +1,87 @@
+from pathlib import Path
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+from qdrant_client import QdrantClient
+from qdrant_client.models import FieldCondition, Filter, MatchValue
+
+from ragindexer import QdrantIndexer as qdrant_indexer
+from ragindexer.config import config
+from ragindexer.index_database import StateDB
+from ragindexer.QdrantIndexer import QdrantIndexer
+
+
+class LaggingClient:
+    """In-process Qdrant that applies the updates sent with wait=False only at the next update
+    sent with wait=True, like a server under load"""
+
+    READS = {"scroll", "count", "retrieve", "query_points", "get_collection", "collection_exists"}
+
+    def __init__(self):
+        self.client = QdrantClient(location=":memory:")
+        self.unapplied = []
+
+    def upload_collection(self, **kwargs):
+        if kwargs.get("wait", True):
+            self.apply()
+            self.client.upload_collection(**kwargs)
+        else:
+            self.unapplied.append(kwargs)
+
+    def apply(self):
+        for kwargs in self.unapplied:
+            self.client.upload_collection(**{**kwargs, "wait": True})
+        self.unapplied = []
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        if name in self.READS:
+            return method
+
+        def update(*args, **kwargs):
+            if kwargs.get("wait", True):
+                self.apply()
+            return method(*args, **kwargs)
+
+        return update
+
+
+class TestQdrantIndexer(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.saved = (config.QDRANT_URL, config.QDRANT_HYBRID)
+        config.QDRANT_URL = ":memory:"
+        config.QDRANT_HYBRID = False
+        self.client = LaggingClient()
+        patcher = mock.patch.object(qdrant_indexer, "QdrantClient", lambda **kwargs: self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.state_db = StateDB(Path(self.tmp_dir.name) / "index_state.db")
+        self.qdrant = QdrantIndexer(vector_size=4, state_db=self.state_db)
+
+    def tearDown(self):
+        self.state_db.close()
+        config.QDRANT_URL, config.QDRANT_HYBRID = self.saved
+        self.tmp_dir.cleanup()
+
+    def count(self, source: Path) -> int:
+        filter_ = Filter(must=[FieldCondition(key="source", match=MatchValue(value=str(source)))])
+        return self.client.count(config.COLLECTION_NAME, count_filter=filter_).count
+
+    def test_rename_after_upsert(self):
+        old, new = Path("/docs/a.txt"), Path("/docs/b.txt")
+        chunks = ["one", "two", "three"]
+        self.qdrant.record_embeddings(
+            0, chunks, np.ones((3, 4), dtype=np.float32), {"abspath": old}
+        )
+
+        # The points just upserted are all moved
+        self.qdrant.rename_sources([(old, new)])
+        self.assertEqual(self.count(old), 0)
+        self.assertEqual(self.count(new), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
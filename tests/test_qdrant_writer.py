@@ -0,0 +1,115 @@
+import threading
+import unittest
+
+import numpy as np
+from qdrant_client.models import SparseVector
+
+from ragindexer.config import config
+from ragindexer.QdrantWriter import QdrantWriter
+
+
+class FakeClient:
+    def __init__(self, nb_failures: int = 0):
+        self.lock = threading.Lock()
+        self.batches = []
+        self.nb_failures = nb_failures
+        # Batches acknowledged, but not applied until a request with wait=True
+        self.nb_applied = 0
+
+    def upload_collection(self, collection_name, vectors, payload, ids, **kwargs):
+        with self.lock:
+            if self.nb_failures > 0:
+                self.nb_failures -= 1
+                raise ConnectionError("Qdrant unavailable")
+            self.batches.append((list(ids), vectors))
+
+    def delete(self, collection_name, points_selector, wait=True):
+        with self.lock:
+            if wait:
+                self.nb_applied = len(self.batches)
+
+
+def make_points(source: str, nb: int):
+    ids = [str(k) for k in range(nb)]
+    vectors = np.ones((nb, 2), dtype=np.float32)
+    payloads = [{"source": source, "text": f"chunk {k}"} for k in range(nb)]
+    return ids, vectors, payloads
+
+
+class TestQdrantWriter(unittest.TestCase):
+    def setUp(self):
+        self.backoff = config.QDRANT_RETRY_BACKOFF
+        config.QDRANT_RETRY_BACKOFF = 0.0
+
+    def tearDown(self):
+        config.QDRANT_RETRY_BACKOFF = self.backoff
+
+    def test_batches(self):
+        client = FakeClient()
+        writer = QdrantWriter(client)
+        writer.add(*make_points("a.pdf", config.QDRANT_BATCH_POINTS + 1))
+
+        self.assertTrue(writer.flush("a.pdf"))
+        self.assertEqual(writer.nb_in_flight(), 0)
+        self.assertEqual(
+            sorted(len(ids) for ids, _ in client.batches), [1, config.QDRANT_BATCH_POINTS]
+        )
+        for _, vectors in client.batches:
+            self.assertEqual(vectors.dtype, np.float32)
+
+    def test_retries(self):
+        client = FakeClient(nb_failures=config.QDRANT_MAX_RETRIES)
+        writer = QdrantWriter(client)
+        writer.add(*make_points("a.pdf", 3))
+        self.assertTrue(writer.flush("a.pdf"))
+        self.assertEqual(len(client.batches), 1)
+
+        client.nb_failures = config.QDRANT_MAX_RETRIES + 1
+        writer.add(*make_points("b.pdf", 3))
+        self.assertFalse(writer.flush("b.pdf"))
+        self.assertTrue(writer.flush("b.pdf"))
+
+    def test_failures_kept_by_global_flush(self):
+        client = FakeClient(nb_failures=config.QDRANT_MAX_RETRIES + 1)
+        writer = QdrantWriter(client)
+        writer.add(*make_points("a.pdf", 3))
+
+        # A flush without a source, like the one of a deletion, does not drop the failure of a.pdf
+        self.assertFalse(writer.flush())
+        writer.add(*make_points("b.pdf", 3))
+        self.assertTrue(writer.flush("b.pdf"))
+        self.assertFalse(writer.flush())
+        self.assertFalse(writer.flush("a.pdf"))
+        self.assertTrue(writer.flush())
+        self.assertTrue(writer.flush("a.pdf"))
+
+    def test_applied(self):
+        client = FakeClient()
+        written = []
+        writer = QdrantWriter(client, on_written=lambda ids, payloads: written.extend(ids))
+        writer.add(*make_points("a.pdf", config.QDRANT_BATCH_POINTS + 1))
+
+        # The points are visible, and reported as written, once flushed
+        self.assertTrue(writer.flush("a.pdf"))
+        self.assertEqual(client.nb_applied, 2)
+        self.assertEqual(len(written), config.QDRANT_BATCH_POINTS + 1)
+
+        # Nothing to wait for
+        self.assertTrue(writer.flush())
+        self.assertEqual(len(written), config.QDRANT_BATCH_POINTS + 1)
+
+    def test_named_vectors(self):
+        client = FakeClient()
+        writer = QdrantWriter(client, vector_name="dense", sparse_vector_name="bm25")
+        ids, vectors, payloads = make_points("a.pdf", 2)
+        sparse = [SparseVector(indices=[3, 7], values=[1.0, 0.5]), None]
+        writer.add(ids, vectors, payloads, sparse)
+        self.assertTrue(writer.flush("a.pdf"))
+
+        ((_, named),) = client.batches
+        self.assertEqual(named[0], {"dense": [1.0, 1.0], "bm25": sparse[0]})
+        self.assertEqual(named[1], {"dense": [1.0, 1.0]})
+
+
+if __name__ == "__main__":
+    unittest.main()
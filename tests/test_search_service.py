@@ -0,0 +1,144 @@
+import json
+import threading
+import unittest
+import urllib.error
+import urllib.request
+
+import numpy as np
+from qdrant_client.models import FieldCondition, Filter, MatchAny, MatchValue, ScoredPoint
+
+from ragindexer.QueryEncoder import QueryEncoder
+from ragindexer.SearchService import SearchService, filter_sources, start_search_server
+
+
+class FakeModel:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.batches = []
+
+    def encode(self, sentences, **kwargs):
+        with self.lock:
+            self.batches.append(list(sentences))
+        return np.array([[len(sentence), 1.0] for sentence in sentences], dtype=np.float32)
+
+
+class FakeQdrant:
+    def __init__(self):
+        self.listeners = []
+        self.nb_searches = 0
+        self.points = {"a.pdf": "1", "b.pdf": "2"}
+
+    def add_change_listener(self, listener):
+        self.listeners.append(listener)
+
+    def search(self, query_vector, limit=10, query_filter=None, query_text=None):
+        self.nb_searches += 1
+        sources = filter_sources(query_filter) or set(self.points)
+        return [
+            ScoredPoint(
+                id=point_id, version=0, score=float(query_vector[0]), payload={"source": src}
+            )
+            for src, point_id in sorted(self.points.items())
+            if src in sources
+        ][:limit]
+
+
+class TestSearchService(unittest.TestCase):
+    def setUp(self):
+        self.model = FakeModel()
+        self.qdrant = FakeQdrant()
+        self.encoder = QueryEncoder(self.model, max_batch=16, max_wait=0.2, cache_size=100)
+        self.service = SearchService(self.qdrant, self.encoder, cache_size=100, ttl=60.0)
+        self.service.start()
+
+    def tearDown(self):
+        self.service.stop()
+
+    def test_micro_batching(self):
+        results = {}
+
+        def query(k: int):
+            results[k] = self.encoder.encode("q" * k)
+
+        threads = [threading.Thread(target=query, args=(k,)) for k in range(1, 9)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # The 8 queries arrived within the waiting window, and were encoded in one pass
+        self.assertEqual(len(self.model.batches), 1)
+        self.assertEqual(sorted(self.model.batches[0]), sorted("q" * k for k in range(1, 9)))
+        for k in range(1, 9):
+            self.assertEqual(results[k][0], k)
+
+        self.encoder.encode("qqq")
+        self.assertEqual(len(self.model.batches), 1)
+        self.assertEqual(self.encoder.stats()["hits"], 1)
+
+    def test_result_cache(self):
+        only_b = Filter(must=[FieldCondition(key="source", match=MatchValue(value="b.pdf"))])
+        self.assertEqual(len(self.service.search("query")), 2)
+        self.assertEqual(len(self.service.search("query", query_filter=only_b)), 1)
+        self.service.search("query")
+        self.assertEqual(self.qdrant.nb_searches, 2)
+
+        # Deleting points of a file that is not in a result keeps the result
+        self.qdrant.listeners[0]({"c.pdf"}, set(), False)
+        self.service.search("query", query_filter=only_b)
+        self.assertEqual(self.qdrant.nb_searches, 2)
+
+        # New points of a.pdf may change the unfiltered search, not the one restricted to b.pdf
+        self.qdrant.listeners[0]({"a.pdf"}, {"3"}, True)
+        self.service.search("query", query_filter=only_b)
+        self.assertEqual(self.qdrant.nb_searches, 2)
+        self.service.search("query")
+        self.assertEqual(self.qdrant.nb_searches, 3)
+
+        # Deleted points invalidate the results that contain them
+        self.qdrant.listeners[0](set(), {"2"}, False)
+        self.service.search("query", query_filter=only_b)
+        self.assertEqual(self.qdrant.nb_searches, 4)
+
+        self.qdrant.listeners[0](None, set(), False)
+        self.assertEqual(self.service.stats()["results"]["size"], 0)
+
+    def test_filter_sources(self):
+        self.assertIsNone(filter_sources(None))
+        self.assertIsNone(
+            filter_sources(Filter(must=[FieldCondition(key="page", match=MatchValue(value=1))]))
+        )
+        query_filter = Filter(
+            must=[
+                FieldCondition(key="source", match=MatchAny(any=["a.pdf", "b.pdf"])),
+                FieldCondition(key="source", match=MatchValue(value="b.pdf")),
+            ]
+        )
+        self.assertEqual(filter_sources(query_filter), {"b.pdf"})
+
+    def test_http(self):
+        server = start_search_server(self.service, port=0, addr="127.0.0.1")
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        try:
+            request = {
+                "query": "query",
+                "limit": 5,
+                "filter": {"must": [{"key": "source", "match": {"value": "a.pdf"}}]},
+            }
+            with urllib.request.urlopen(f"{url}/search", data=json.dumps(request).encode()) as r:
+                results = json.loads(r.read())["results"]
+            self.assertEqual(results, [{"id": "1", "score": 5.0, "payload": {"source": "a.pdf"}}])
+
+            with self.assertRaises(urllib.error.HTTPError) as cm:
+                urllib.request.urlopen(f"{url}/search", data=b'{"limit": 5}')
+            self.assertEqual(cm.exception.code, 400)
+
+            with urllib.request.urlopen(f"{url}/stats") as r:
+                self.assertEqual(json.loads(r.read())["results"]["misses"], 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+from pathlib import Path
+import tempfile
+import unittest
+
+from ragindexer.index_database import StateDB
+from ragindexer.SparseEncoder import SparseEncoder, tokenize
+
+
+class TestSparseEncoder(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = Path(self.tmp_dir.name) / "index_state.db"
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_tokenize(self):
+        self.assertEqual(
+            tokenize("Facture INV-2024/0042 réglée à Noël, 3 €"),
+            ["facture", "inv-2024/0042", "inv", "2024", "0042", "reglee", "noel", "3"],
+        )
+
+    def test_encode(self):
+        state_db = StateDB(self.db_path)
+        encoder = SparseEncoder(state_db)
+        short, long = encoder.encode_documents(
+            ["invoice INV-42", "invoice " + " ".join(f"word{k}" for k in range(30))],
+            ["p1", "p2"],
+            Path("/docs/a.txt"),
+        )
+        self.assertEqual(len(short.indices), len(short.values))
+        self.assertEqual(short.indices, sorted(short.indices))
+
+        # The term weighs more in the short chunk than in the long one
+        vocabulary = state_db.load_vocabulary()
+        invoice = vocabulary["invoice"]
+        self.assertGreater(
+            short.values[short.indices.index(invoice)], long.values[long.indices.index(invoice)]
+        )
+        self.assertEqual(state_db.get_lexical_stats(), (2, 35))
+        state_db.close()
+
+        # The vocabulary is persisted, and unknown words of the queries are ignored
+        state_db = StateDB(self.db_path)
+        encoder = SparseEncoder(state_db)
+        self.assertEqual(encoder.vocabulary_size(), len(vocabulary))
+        query = encoder.encode_query("Invoice inv-42 unknown")
+        self.assertEqual(
+            query.indices,
+            sorted([invoice, vocabulary["inv-42"], vocabulary["inv"], vocabulary["42"]]),
+        )
+        self.assertEqual(query.values, [1.0] * 4)
+        (vector,) = encoder.encode_documents(["invoice"], ["p3"], Path("/docs/b.txt"))
+        self.assertEqual(vector.indices, [invoice])
+        self.assertEqual(state_db.get_lexical_stats(), (3, 36))
+        state_db.close()
+
+    def test_lexical_stats(self):
+        state_db = StateDB(self.db_path)
+        encoder = SparseEncoder(state_db)
+        encoder.encode_documents(["one two three", "four five"], ["p1", "p2"], Path("/docs/a.txt"))
+        encoder.encode_documents(["six seven"], ["p3"], Path("/docs/b.txt"))
+        self.assertEqual(state_db.get_lexical_stats(), (3, 7))
+
+        # The statistics follow the points replaced, deleted and renamed
+        encoder.encode_documents(["one"], ["p1"], Path("/docs/a.txt"))
+        self.assertEqual(state_db.get_lexical_stats(), (3, 5))
+        state_db.delete_chunk_lengths(["p2", "unknown"])
+        self.assertEqual(state_db.get_lexical_stats(), (2, 3))
+        state_db.rename_chunk_lengths([("p1", "p3", Path("/docs/b.txt"))])
+        self.assertEqual(state_db.get_lexical_stats(), (1, 1))
+        state_db.delete_source_chunk_lengths(Path("/docs/a.txt"))
+        self.assertEqual(state_db.get_lexical_stats(), (1, 1))
+        state_db.delete_source_chunk_lengths(Path("/docs/b.txt"))
+        self.assertEqual(state_db.get_lexical_stats(), (0, 0))
+        state_db.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+from pathlib import Path
+import tempfile
+import unittest
+
+from ragindexer.index_database import StateDB
+
+
+class TestStateDB(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.state_db = StateDB(Path(self.tmp_dir.name) / "index_state.db")
+
+    def tearDown(self):
+        self.state_db.close()
+        self.tmp_dir.cleanup()
+
+    def test_bulk(self):
+        paths = [Path(f"/docs/file{k}.pdf") for k in range(5)]
+        self.state_db.set_stored_timestamps([(path, float(k)) for k, path in enumerate(paths)])
+        self.assertEqual(self.state_db.get_stored_timestamp(paths[3]), 3.0)
+
+        # Updating the timestamps keeps the content hashes
+        self.state_db.set_stored_timestamp(paths[4], 4.0, "hash4")
+        self.state_db.set_stored_timestamps([(paths[4], 5.0)])
+        self.assertEqual(self.state_db.get_stored_timestamp(paths[4]), 5.0)
+        self.assertEqual(self.state_db.get_content_hash(paths[4]), "hash4")
+
+        self.state_db.set_chunk_manifest(paths[0], {(0, 0): ("id0", "hash0")})
+        self.state_db.delete_stored_files(paths[:2])
+
+        timestamps = self.state_db.load_timestamps()
+        self.assertEqual(sorted(timestamps.keys()), [str(path) for path in paths[2:]])
+        self.assertIsNone(self.state_db.get_stored_timestamp(paths[0]))
+        self.assertEqual(self.state_db.get_chunk_manifest(paths[0]), {})
+
+    def test_manifest(self):
+        path = Path("/docs/file.pdf")
+        self.state_db.set_chunk_manifest(path, {(0, 0): ("id0", "hash0"), (0, 1): ("id1", "hash1")})
+        self.state_db.set_chunk_manifest(path, {(1, 0): ("id2", "hash2")})
+        self.assertEqual(self.state_db.get_chunk_manifest(path), {(1, 0): ("id2", "hash2")})
+
+    def test_rename(self):
+        paths = [Path("/docs/dir/a.pdf"), Path("/docs/dir/sub/b.pdf"), Path("/docs/dir2/c.pdf")]
+        for path in paths:
+            self.state_db.set_stored_timestamp(path, 1.0, content_hash=path.name)
+            self.state_db.set_chunk_manifest(path, {(0, 0): (f"id-{path.name}", "hash")})
+
+        found = self.state_db.find_stored_files(Path("/docs/dir"))
+        self.assertEqual(sorted(found), paths[:2])
+
+        self.state_db.rename_stored_files(
+            [(path, Path("/docs/moved") / path.relative_to("/docs/dir")) for path in found]
+        )
+        moved = Path("/docs/moved/sub/b.pdf")
+        self.assertIsNone(self.state_db.get_stored_timestamp(paths[1]))
+        self.assertEqual(self.state_db.get_content_hash(moved), "b.pdf")
+        self.assertEqual(self.state_db.get_chunk_manifest(moved), {(0, 0): ("id-b.pdf", "hash")})
+        self.assertEqual(self.state_db.find_stored_files(Path("/docs/dir2")), [paths[2]])
+
+        # The points of the chunks can get new IDs, derived from the new path
+        renamed = Path("/docs/c2.pdf")
+        self.state_db.rename_stored_files(
+            [(paths[2], renamed)], point_id=lambda path, page, idx: f"{path.name}-{page}-{idx}"
+        )
+        self.assertEqual(
+            self.state_db.get_chunk_manifest(renamed), {(0, 0): ("c2.pdf-0-0", "hash")}
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+from pathlib import Path
+import tempfile
+import threading
+import time
+import unittest
+from typing import Optional
+
+from ragindexer.WatcherQueue import WatcherQueue
+
+
+class TestWatcherQueue(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.lock = threading.Lock()
+        self.dispatched = []
+        self.queue = WatcherQueue(self.dispatch, window=0.2)
+        self.queue.start()
+
+    def tearDown(self):
+        self.queue.stop()
+        self.tmp_dir.cleanup()
+
+    def dispatch(self, path: Path, deleted: bool, moved_from: Optional[Path]):
+        with self.lock:
+            self.dispatched.append((path.name, deleted, moved_from))
+
+    def wait_dispatched(self, nb: int, timeout: float = 5.0):
+        t0 = time.monotonic()
+        while time.monotonic() - t0 < timeout:
+            with self.lock:
+                if len(self.dispatched) >= nb:
+                    return
+            time.sleep(0.05)
+
+    def test_coalesce(self):
+        path = Path(self.tmp_dir.name) / "doc.md"
+        for k in range(5):
+            path.write_text(k * "text ")
+            self.queue.push(path)
+        self.wait_dispatched(1)
+        time.sleep(0.3)
+
+        self.assertEqual(self.dispatched, [("doc.md", False, None)])
+        self.assertEqual(self.queue.stats()["coalesced"], 4)
+
+    def test_net_effect(self):
+        # Created then deleted before being indexed
+        path = Path(self.tmp_dir.name) / "tmp.md"
+        path.write_text("text")
+        self.queue.push(path)
+        path.unlink()
+        self.queue.push(path, deleted=True)
+
+        # Deleted then recreated
+        other = Path(self.tmp_dir.name) / "other.md"
+        self.queue.push(other, deleted=True)
+        other.write_text("text")
+        self.queue.push(other)
+
+        self.wait_dispatched(2)
+        self.assertEqual(
+            sorted(self.dispatched), [("other.md", False, None), ("tmp.md", True, None)]
+        )
+
+    def test_unstable(self):
+        # A file still being written is not dispatched
+        path = Path(self.tmp_dir.name) / "big.md"
+        path.write_text("text")
+        self.queue.push(path)
+        for k in range(6):
+            time.sleep(0.1)
+            path.write_text(k * "more text ")
+        with self.lock:
+            self.assertEqual(self.dispatched, [])
+
+        self.wait_dispatched(1)
+        self.assertEqual(self.dispatched, [("big.md", False, None)])
+
+    def test_move(self):
+        # Modified, then renamed twice: the index entries of the first path are reused
+        path = Path(self.tmp_dir.name) / "a.md"
+        path.write_text("text")
+        self.queue.push(path)
+        path.rename(path.with_name("b.md"))
+        self.queue.push_move(path, path.with_name("b.md"))
+        path.with_name("b.md").rename(path.with_name("c.md"))
+        self.queue.push_move(path.with_name("b.md"), path.with_name("c.md"))
+
+        self.wait_dispatched(1)
+        time.sleep(0.3)
+        self.assertEqual(self.dispatched, [("c.md", False, path)])
+
+
+if __name__ == "__main__":
+    unittest.main()
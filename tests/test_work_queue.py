@@ -0,0 +1,147 @@
+from pathlib import Path
+import tempfile
+import threading
+import time
+import unittest
+
+from ragindexer.WorkQueue import WorkQueue
+
+
+class TestWorkQueue(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = Path(self.tmp_dir.name) / "work_queue.db"
+        self.queues = []
+
+    def tearDown(self):
+        for work_queue in self.queues:
+            work_queue.close()
+        self.tmp_dir.cleanup()
+
+    def make_queue(self, worker_id: str, **kwargs) -> WorkQueue:
+        # Each worker has its own connection, like separate processes
+        work_queue = WorkQueue(db_path=self.db_path, worker_id=worker_id, **kwargs)
+        self.queues.append(work_queue)
+        return work_queue
+
+    def test_exclusive_claims(self):
+        self.make_queue("init").enqueue((Path(f"/docs/{k}.txt"), 1.0) for k in range(200))
+        workers = [self.make_queue(f"w{k}") for k in range(4)]
+        claimed = {worker.worker_id: [] for worker in workers}
+
+        def work(worker: WorkQueue):
+            while True:
+                items = worker.claim(3)
+                if not items:
+                    return
+                for item in items:
+                    claimed[worker.worker_id].append(item.path)
+                    self.assertTrue(worker.complete(item))
+
+        threads = [threading.Thread(target=work, args=(worker,)) for worker in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        paths = [path for paths in claimed.values() for path in paths]
+        self.assertEqual(len(paths), 200)
+        self.assertEqual(len(set(paths)), 200)
+        self.assertTrue(workers[0].is_drained())
+        self.assertEqual(workers[0].stats()["done"], 200)
+
+    def test_lease_expiry(self):
+        crashed = self.make_queue("crashed", lease_seconds=0.2)
+        other = self.make_queue("other", lease_seconds=0.2)
+        crashed.enqueue([(Path("/docs/a.txt"), 1.0)])
+        (old_item,) = crashed.claim()
+        self.assertEqual(other.claim(), [])
+
+        # The lease is not renewed, and the file is claimed again once it has expired
+        time.sleep(0.3)
+        (item,) = other.claim()
+        self.assertEqual(item.path, Path("/docs/a.txt"))
+        self.assertEqual(item.attempts, 2)
+        self.assertGreater(item.token, old_item.token)
+        self.assertEqual(other.stats()["reclaimed"], 1)
+
+        # The fencing token keeps the first worker from completing the file
+        self.assertFalse(crashed.complete(old_item))
+        self.assertEqual(crashed.heartbeat(), [])
+        self.assertTrue(other.complete(item))
+        self.assertEqual(other.stats()["done"], 1)
+
+    def test_lost_lease(self):
+        worker = self.make_queue("worker", lease_seconds=0.2)
+        other = self.make_queue("other", lease_seconds=0.2)
+        lost = []
+        worker.add_lost_listener(lost.append)
+        worker.enqueue([(Path("/docs/a.txt"), 1.0)])
+        (old_item,) = worker.claim()
+        self.assertTrue(worker.holds(old_item))
+
+        # An expired lease is not held anymore, even before the file is claimed again
+        time.sleep(0.3)
+        self.assertFalse(worker.holds(old_item))
+        (item,) = other.claim()
+        self.assertTrue(other.holds(item))
+        self.assertFalse(other.holds(old_item))
+
+        # The worker is told about the lease lost when it tries to renew it
+        self.assertEqual(worker.heartbeat(), [old_item])
+        self.assertEqual(lost, [old_item])
+
+    def test_heartbeat(self):
+        worker = self.make_queue("worker", lease_seconds=0.3, heartbeat_seconds=0.05)
+        other = self.make_queue("other", lease_seconds=0.3)
+        worker.enqueue([(Path("/docs/a.txt"), 1.0)])
+        worker.start()
+        try:
+            (item,) = worker.claim()
+            time.sleep(0.6)
+            self.assertEqual(other.claim(), [])
+            self.assertTrue(worker.complete(item))
+        finally:
+            worker.stop()
+
+    def test_requeue(self):
+        worker = self.make_queue("worker", max_attempts=2)
+        path = Path("/docs/a.txt")
+        worker.enqueue([(path, 1.0)])
+        self.assertEqual(worker.enqueue([(path, 1.0)]), 0)
+
+        # Modified while it is indexed: indexed again afterwards
+        (item,) = worker.claim()
+        self.assertEqual(worker.enqueue([(path, 2.0)]), 1)
+        self.assertEqual(worker.claim(), [])
+        self.assertTrue(worker.complete(item))
+        (item,) = worker.claim()
+        self.assertEqual(item.mtime, 2.0)
+
+        # Retried until max_attempts, then kept failed until it is queued again
+        self.assertTrue(worker.fail(item, "error"))
+        (item,) = worker.claim()
+        self.assertTrue(worker.fail(item, "error"))
+        self.assertEqual(worker.claim(), [])
+        self.assertEqual(worker.stats()["failed"], 1)
+        self.assertTrue(worker.is_drained())
+        self.assertEqual(worker.enqueue([(path, 2.0)]), 1)
+
+        # A deleted file leaves the queue once removed from the index
+        worker.enqueue([(path, None)], delete=True)
+        (item,) = worker.claim()
+        self.assertTrue(item.delete)
+        self.assertTrue(worker.complete(item))
+        self.assertEqual(sum(worker.stats()[s] for s in ("pending", "done", "failed")), 0)
+
+    def test_release(self):
+        worker = self.make_queue("worker")
+        worker.enqueue([(Path("/docs/a.txt"), 1.0)])
+        worker.claim()
+        worker.stop()
+        (item,) = self.make_queue("other").claim()
+        self.assertEqual(item.attempts, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
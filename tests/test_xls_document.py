@@ -0,0 +1,73 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from openpyxl import Workbook
+
+from ragindexer.config import config
+from ragindexer.documents.XlsDocument import XlsDocument
+
+
+class TestXlsDocument(unittest.TestCase):
+    def setUp(self):
+        self.window_chars = config.XLSX_WINDOW_CHARS
+        config.XLSX_WINDOW_CHARS = 200
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmpdir.name) / "accounts.xlsx"
+        wb = Workbook()
+        ws = wb.active
+        ws.title = "Invoices"
+        ws.append(["Date", "Client", "Amount"])
+        for k in range(50):
+            ws.append([f"2024-01-{k % 28 + 1:02}", f"Client {k}", 100 + k])
+        ws = wb.create_sheet("Notes")
+        ws.append(["Comment"])
+        wb.save(self.path)
+
+    def tearDown(self):
+        config.XLSX_WINDOW_CHARS = self.window_chars
+        self.tmpdir.cleanup()
+
+    def test_windows(self):
+        pages = list(XlsDocument(self.path).iterate_raw_text())
+
+        invoices = [(k, text, meta) for k, text, meta in pages if meta["sheet"] == "Invoices"]
+        self.assertGreater(len(invoices), 1)
+        self.assertEqual([k for k, _, _ in pages], list(range(len(pages))))
+
+        next_row = 2
+        for _, text, meta in invoices:
+            self.assertLessEqual(len(text), config.XLSX_WINDOW_CHARS)
+            self.assertTrue(text.startswith("Invoices\nDate Client Amount\n"))
+            self.assertEqual(meta["rows"][0], next_row)
+            next_row = meta["rows"][1] + 1
+        self.assertEqual(next_row, 52)
+
+        # Each row is indexed once, not once per following sheet
+        all_text = "\n".join(text for _, text, _ in pages)
+        self.assertEqual(all_text.count("Client 7 "), 1)
+
+        _, text, meta = pages[-1]
+        self.assertEqual(meta["sheet"], "Notes")
+        self.assertEqual(text, "Notes\nComment")
+
+    def test_long_rows(self):
+        wb = Workbook()
+        ws = wb.active
+        ws.title = "Wide"
+        ws.append(["header " * 100])
+        ws.append(["row " * 100])
+        ws.append(["short row"])
+        wb.save(self.path)
+
+        pages = list(XlsDocument(self.path).iterate_raw_text())
+        self.assertEqual(len(pages), 2)
+        for _, text, _ in pages:
+            self.assertLessEqual(len(text), config.XLSX_WINDOW_CHARS)
+            self.assertTrue(text.startswith("Wide\nheader header"))
+        self.assertTrue(pages[1][1].endswith("\nshort row"))
+
+
+if __name__ == "__main__":
+    unittest.main()